@@ -148,7 +148,6 @@ if __name__=="__main__":
     if args.bg_energy:
         energy_function = fbe.CombinedEnergy([], getDefaultEnergies(trajectory.at_timestep(0)))
     
-    sm = lambda : None #Dummy object http://stackoverflow.com/a/2827734/5069869
     ftraj = []
     f_energies = []
     f_fns = []
@@ -162,10 +161,9 @@ if __name__=="__main__":
             for fn, cg in pool.imap(read_cg_bg, file_iter):
                 ftraj.append(cg)
                 if args.bg_energy:
-                    sm.bg = cg
-                    e = energy_function.eval_energy(sm, background = False)
-                    f_energies.append(e)
                     f_fns.append(fn)
+        if args.bg_energy:
+            f_energies = list(energy_function.eval_energy_many(ftraj, background = False))
         print("Fair ensemble with {} builds".format(len(ftraj)))        
         if args.bg_energy:
             with open("energies_of_bg", "w") as f:
@@ -265,10 +263,7 @@ if __name__=="__main__":
             plt.clf()
             plt.close()
         rmsds = trajectory._get_descriptor("rmsd_to_reference")
-        t_energies = []
-        for cg in trajectory._cgs:
-            sm.bg = cg
-            t_energies.append(energy_function.eval_energy(sm, background = False))
+        t_energies = list(energy_function.eval_energy_many(trajectory._cgs, background = False))
         plt.plot(rmsds, t_energies, 'o')
         plt.xlabel("RMSD to reference")
         plt.ylabel("Energy")
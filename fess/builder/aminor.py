@@ -5,10 +5,11 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install
 __metaclass__=object
 
 try:
-    from colelctions.abc import Set
+    from collections.abc import Set
 except ImportError:
     from collections import Set
 
+import forgi.threedee.classification.aminor as ftca
 import forgi.threedee.utilities.graph_pdb as ftug
 import forgi.threedee.utilities.vector as ftuv
 import forgi.utilities.debug as fud
@@ -18,10 +19,17 @@ import warnings
 import logging
 import numpy as np
 import scipy.stats
+import scipy.ndimage
 import os.path
+import hashlib
+import pkgutil
+import json
 
 from logging_exceptions import log_to_exception
 
+from .energy_abcs import coordinate_fingerprint
+from fess import data_file
+
 log=logging.getLogger(__name__)
 
 try:
@@ -38,15 +46,14 @@ def total_prob(individual_probs):
     This function tries for interaction of the loop with
     all stems (except adjacent ones) and returns p1+(1-p1)*p2+...
     where p1, p2, ... are the individual probabilities.
+    This equals 1-(1-p1)*(1-p2)*...
     """
     log.debug("Entering 'total_prob'")
-    total_prob = 0
-    for p in individual_probs:
-        log.debug("Adding p = %f to total_prob = %f", p, total_prob)
-        total_prob += (1-total_prob)*p
+    individual_probs = np.fromiter(individual_probs, dtype=float)
+    total_prob = 1 - np.prod(1 - individual_probs)
     log.debug("total_prob: Returning: %s", total_prob)
     if total_prob>1:
-        log.error("Probability >1 for %s %s with domain %s", cg.name, loop, domain)
+        log.error("Probability >1 for individual probabilities %s", individual_probs)
         assert False
     return total_prob
 
@@ -62,25 +69,370 @@ def iter_probs(loop, cg, prob_fun, cutoff_dist, domain = None):
         This is required to make sure at least one value is yielded in cases
         where no stem is close enough for interactions.
 
-    For params: See the documentation of total_prob
+    For params: See the documentation of total_prob and loop_probs
     """
     log.debug("Entering '_iter_probs'")
+    for p in loop_probs(loop, cg, prob_fun, cutoff_dist, domain):
+        yield p
+    yield 0 #Always yield at least one number, so max(_iter_probs(...)) does not raise an error
+
+def loop_probs(loop, cg, prob_fun, cutoff_dist, domain = None):
+    """
+    The interaction probabilities of the loop with all stems closer than cutoff_dist.
+
+    :param prob_fun: A function like a 3D scipy.stats.gaussian_kde. It is called
+                     once with a 3xN array of relative orientations
+                     (see relative_orientations) and returns N probabilities.
+    :param domain: A list of element names. If given, only stems in the domain are considered.
+    :returns: An array of probabilities, one for every stem closer than cutoff_dist.
+    """
     if domain is not None:
-        stems = (s for s in domain if s[0]=="s")
+        stems = [s for s in domain if s[0]=="s"]
     else:
-        stems = cg.stem_iterator()
-    for s in stems:
-        if s in cg.edges[loop]:
-            continue
-        if not ftuv.elements_closer_than(cg.coords[loop][0],
-                                 cg.coords[loop][1],
-                                 cg.coords[s][0],
-                                 cg.coords[s][1],
-                                 cutoff_dist):
-            continue
-        point = get_relative_orientation(cg, loop, s)
-        p, = prob_fun(point)
+        stems = list(cg.stem_iterator())
+    stems = [s for s in stems if s not in cg.edges[loop]]
+    if not stems:
+        return np.zeros(0)
+    points = relative_orientations(cg, loop, stems)
+    points = points[points[:,0]<cutoff_dist]
+    if len(points)==0:
+        return np.zeros(0)
+    probs = np.ravel(prob_fun(points.T))
+    for point, p in zip(points, probs):
         if p>1:
             warnings.warn("Probability at %s is %f>1 for %s %s with domain %s" %(point, p, cg.name, loop, domain))
-        yield(p)
-    yield 0 #Always yield at least one number, so max(_iter_probs(...)) does not raise an error
+    return probs
+
+def closest_points(s1_p0, s1_p1, s2_p0, s2_p1):
+    """
+    Like ftuv.line_segment_distance, for many segments s1 and
+    a single segment s2 or an equal number of segments s2.
+
+    :param s1_p0, s1_p1: Nx3 arrays, start and end of the first segments
+    :param s2_p0, s2_p1: Start and end of the second segment,
+                         or Nx3 arrays with the starts and ends of N segments.
+    :returns: A tuple of Nx3 arrays (i1, i2) containing the points i1 on
+              the segments s1 closest to the points i2 on the segments s2.
+    """
+    SMALL_NUM = 0.000001
+    u = s1_p1 - s1_p0
+    v = np.broadcast_to(np.asarray(s2_p1) - s2_p0, u.shape)
+    w = s1_p0 - s2_p0
+    a = np.sum(u*u, axis=1)
+    b = np.sum(u*v, axis=1)
+    c = np.sum(v*v, axis=1)
+    d = np.sum(u*w, axis=1)
+    e = np.sum(v*w, axis=1)
+    D = a*c - b*b
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        # The closest points on the infinite lines,
+        # or on the s=0 edge if the lines are almost parallel.
+        parallel = D < SMALL_NUM
+        sN = np.where(parallel, 0., b*e - c*d)
+        sD = np.where(parallel, 1., D)
+        tN = np.where(parallel, e, a*e - b*d)
+        tD = np.where(parallel, c, D)
+        s_low = ~parallel & (sN < 0.)
+        s_high = ~parallel & ~s_low & (sN > sD)
+        sN = np.where(s_low, 0., np.where(s_high, sD, sN))
+        tN = np.where(s_low, e, np.where(s_high, e + b, tN))
+        tD = np.where(s_low | s_high, c, tD)
+
+        # Recompute sc for the t=0 and t=1 edges
+        t_low = tN < 0.
+        t_high = ~t_low & (tN > tD)
+        s_edge = np.where(t_low, -d, -d + b)
+        at_edge = t_low | t_high
+        sN = np.where(at_edge, np.where(s_edge < 0., 0., np.where(s_edge > a, sD, s_edge)), sN)
+        sD = np.where(at_edge & (s_edge >= 0.) & (s_edge <= a), a, sD)
+        tN = np.where(t_low, 0., np.where(t_high, tD, tN))
+
+        sc = np.where(np.abs(sN) < SMALL_NUM, 0., sN/sD)
+        tc = np.where(np.abs(tN) < SMALL_NUM, 0., tN/tD)
+    return s1_p0 + sc[:,np.newaxis]*u, s2_p0 + tc[:,np.newaxis]*v
+
+def _angles(vec1, vec2):
+    """
+    Row-wise angles between the vectors of two Nx3 arrays. NaN for zero vectors.
+    """
+    with np.errstate(divide="ignore", invalid="ignore"):
+        cos = np.sum(vec1*vec2, axis=1)/(np.linalg.norm(vec1, axis=1)*np.linalg.norm(vec2, axis=1))
+    return np.arccos(np.clip(cos, -1., 1.))
+
+def relative_orientations(cg, loop, stems):
+    """
+    Like ftca.get_relative_orientation for the loop and each of the stems,
+    computed for all stems at once.
+
+    :returns: An Nx3 array. The columns are dist, angle1 and angle2.
+              For a distance of 0, angle1 and angle2 are NaN.
+    """
+    stem_starts = np.array([cg.coords[s][0] for s in stems])
+    stem_vecs = np.array([cg.coords[s][1] for s in stems]) - stem_starts
+    twists = np.array([cg.twists[s] for s in stems])
+    stem_lens = np.array([cg.stem_length(s) for s in stems], dtype=float)
+
+    point_on_stem, point_on_loop = closest_points(stem_starts, stem_starts+stem_vecs,
+                                                  cg.coords[loop][0], cg.coords[loop][1])
+    conn_vecs = point_on_loop - point_on_stem
+    dists = np.linalg.norm(conn_vecs, axis=1)
+    # The direction of the stem vector is irrelevant, so
+    # choose the smaller of the two angles between two lines
+    angle1 = _angles(stem_vecs, conn_vecs)
+    angle1 = np.where(angle1 > np.pi/2, np.pi - angle1, angle1)
+
+    # The vector pointing to the minor groove at the point on the stem,
+    # as in ftug.virtual_res_3d_pos_core.
+    stem_lengths = np.linalg.norm(stem_vecs, axis=1)
+    positions = np.linalg.norm(point_on_stem - stem_starts, axis=1)/stem_lengths*(stem_lens - 1)
+    u = twists[:,0]
+    v = np.cross(stem_vecs, u)
+    v /= np.linalg.norm(v, axis=1)[:,np.newaxis]
+    # The angle of the second twist with respect to the first
+    t2_y = np.sum(u*twists[:,1], axis=1)/np.linalg.norm(u, axis=1)
+    t2_z = np.sum(v*twists[:,1], axis=1)
+    ang = np.arctan2(t2_z, t2_y)
+    ang = np.where(ang < 0, ang + 2*np.pi, ang)
+    # calculated from an ideal length 30 helix
+    average_ang_per_nt = 0.636738030735
+    expected_ang = (stem_lens - 1) * average_ang_per_nt
+    expected_dev = expected_ang - 2*np.pi*np.maximum(np.ceil(expected_ang/(2*np.pi)) - 1, 0)
+    forward = np.where(ang < expected_dev, 2*np.pi + ang - expected_dev, ang - expected_dev)
+    backward = np.where(ang < expected_dev, expected_dev - ang, 2*np.pi + expected_dev - ang)
+    total_ang = np.where(forward < backward, expected_ang + forward, expected_ang - backward)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        vres_ang = np.where(stem_lens == 1, 0., total_ang/(stem_lens - 1)*positions)
+    virt_twists = (u*np.cos(vres_ang)[:,np.newaxis] + v*np.sin(vres_ang)[:,np.newaxis])
+
+    # The projection of the connection vector onto the plane normal to the stem
+    conn_proj = conn_vecs - (np.sum(conn_vecs*stem_vecs, axis=1)/stem_lengths**2)[:,np.newaxis]*stem_vecs
+    angle2 = _angles(virt_twists, conn_proj)
+    # The sign of the angle is the direction of the cross product along the stem.
+    angle2 *= np.sign(np.sum(np.cross(virt_twists, conn_proj)*stem_vecs, axis=1))
+    angle1[dists == 0] = np.nan
+    angle2[dists == 0] = np.nan
+    return np.array([dists, angle1, angle2]).T
+
+
+class ProbabilityGrid(object):
+    """
+    The interaction probabilities of an A-Minor classifier, tabulated once
+    on a regular grid in (dist/ANGLEWEIGHT, angle1, angle2) space and
+    evaluated by trilinear interpolation.
+
+    It can be used in place of a ftca.AMinorClassifier for prediction.
+    """
+    #: The grid spacing, in units of the classifier's bandwidth.
+    step_per_bandwidth = 1/3
+    #: The lower and upper bounds of the 3 features.
+    #: Distances beyond the cutoff are never classified.
+    bounds = [(0, ftca.CUTOFFDIST/ftca.ANGLEWEIGHT), (0, np.pi/2), (-np.pi, np.pi)]
+
+    def __init__(self, probs, lower, step, source_hash=None):
+        """
+        :param probs: A 3D array with the probabilities at the grid points.
+        :param lower: The features at the grid point probs[0,0,0]
+        :param step: The grid spacing along the 3 features.
+        :param source_hash: The hash of the data the classifier was trained on.
+        """
+        self.probs = np.asarray(probs, dtype=float)
+        self.lower = np.asarray(lower, dtype=float)
+        self.step = np.asarray(step, dtype=float)
+        self.source_hash = source_hash
+
+    @classmethod
+    def from_classifier(cls, clf, source_hash=None, chunksize=10000):
+        """
+        Tabulate the predict_proba function of the classifier.
+
+        :param clf: A fitted ftca.AMinorClassifier
+        """
+        step = clf.bandwidth*cls.step_per_bandwidth
+        axes = [ np.linspace(lower, upper, int(np.ceil((upper-lower)/step))+1)
+                 for lower, upper in cls.bounds ]
+        points = np.array(np.meshgrid(*axes, indexing="ij")).reshape(3, -1).T
+        log.info("Tabulating A-Minor probabilities on %d grid points", len(points))
+        probs = np.concatenate([ clf.predict_proba(points[i:i+chunksize])
+                                 for i in range(0, len(points), chunksize) ])
+        return cls(probs.reshape([len(ax) for ax in axes]),
+                   [ax[0] for ax in axes], [ax[1]-ax[0] for ax in axes], source_hash)
+
+    @classmethod
+    def load(cls, filename):
+        with np.load(filename) as data:
+            return cls(data["probs"], data["lower"], data["step"], str(data["source_hash"]))
+
+    def save(self, filename):
+        """
+        Store the grid as compressed binary file with single precision probabilities.
+        """
+        with open(filename, "wb") as f:
+            np.savez_compressed(f, probs=self.probs.astype(np.float32),
+                                lower=self.lower, step=self.step,
+                                source_hash=str(self.source_hash))
+
+    def predict_proba(self, X):
+        """
+        Like ftca.AMinorClassifier.predict_proba.
+
+        :param X: A Nx3 array of dist/ANGLEWEIGHT, angle1 and angle2.
+                  Points outside the grid get the value of the closest grid point.
+        :returns: An array of N probabilities. 0 for points with NaN features.
+        """
+        X = np.atleast_2d(np.asarray(X, dtype=float))
+        undefined = np.any(np.isnan(X), axis=1)
+        coords = (np.where(undefined[:,np.newaxis], 0., X) - self.lower)/self.step
+        probs = scipy.ndimage.map_coordinates(self.probs, coords.T, order=1, mode="nearest")
+        probs[undefined] = 0.
+        return probs
+
+
+def _source_hash(loop_type):
+    """
+    The hash of the data and parameters forgi's default classifier for the loop type uses.
+    """
+    params = json.loads(pkgutil.get_data('forgi', 'threedee/data/aminor_params.json').decode("ascii"))
+    h = hashlib.sha1()
+    h.update(pkgutil.get_data('forgi', 'threedee/data/aminor_geometries.csv'))
+    h.update(json.dumps(params[loop_type], sort_keys=True).encode("ascii"))
+    h.update(repr((ProbabilityGrid.step_per_bandwidth, ProbabilityGrid.bounds)).encode("ascii"))
+    return h.hexdigest()
+
+def default_grid_filename(loop_type):
+    """
+    The file next to fess/stats, where the grid for the default classifier is cached.
+    """
+    return data_file("stats/aminor_grid_{}_{}.npz".format(loop_type, _source_hash(loop_type)[:16]))
+
+_default_grids = {}
+
+def get_default_grid(loop_type, build=True):
+    """
+    The ProbabilityGrid for forgi's default classifier of the loop type.
+
+    It is loaded from the cache file, or tabulated and stored there,
+    if the file does not exist.
+
+    :param build: If False and the cache file does not exist, raise an IOError.
+    """
+    if loop_type in _default_grids:
+        return _default_grids[loop_type]
+    filename = default_grid_filename(loop_type)
+    if os.path.isfile(filename):
+        log.info("Loading A-Minor probability grid from %s", filename)
+        grid = ProbabilityGrid.load(filename)
+    elif not build:
+        raise IOError("No A-Minor probability grid for loop type {} found at {}".format(loop_type, filename))
+    else:
+        log.warning("Tabulating the A-Minor probabilities for loop type %s. "
+                    "This takes a few minutes, but only happens once.", loop_type)
+        grid = ProbabilityGrid.from_classifier(ftca._get_default_clf(loop_type),
+                                               _source_hash(loop_type))
+        try:
+            grid.save(filename)
+        except (IOError, OSError) as e:
+            log.warning("Could not store A-Minor probability grid at %s: %s", filename, e)
+    _default_grids[loop_type] = grid
+    return grid
+
+
+class IncrementalAMinor(object):
+    """
+    Predict A-Minor interactions like forgi's `all_interactions`,
+    but only re-classify loop-stem pairs where the loop or the stem moved
+    since the last call.
+
+    A single instance can be shared by several energies,
+    which then reuse the result as long as the cg does not change.
+    """
+    LOOP_TYPES = ["i", "h"]
+
+    def __init__(self, clfs=None):
+        """
+        :param clfs: A dictionary {loop_type: AMinorClassifier or ProbabilityGrid}
+                     or None. For missing loop types, the default classifier is used.
+        """
+        if clfs is None:
+            clfs = {}
+        self.clfs = clfs
+        self._topology = None
+        #: A list of (loop, [stems]) for all loops that can form A-Minor
+        #: interactions and all stems that are not adjacent to them.
+        self._candidates = []
+        #: element -> coordinate fingerprint at the time of the last call
+        self._fingerprints = {}
+        #: (loop, stem) -> interaction probability,
+        #: or None if the elements are too far apart.
+        self._probs = {}
+        self._interactions = None
+
+    def _set_topology(self, cg):
+        topology = (cg.name, tuple(sorted((d, tuple(define)) for d, define in cg.defines.items())))
+        if topology == self._topology:
+            return
+        log.debug("Resetting A-Minor cache for %s", cg.name)
+        self._topology = topology
+        self._fingerprints = {}
+        self._probs = {}
+        self._interactions = None
+        self._candidates = []
+        stems = list(cg.stem_iterator())
+        for loop_type in self.LOOP_TYPES:
+            for loop in cg.defines:
+                if loop[0] != loop_type:
+                    continue
+                if 'A' not in "".join(cg.get_define_seq_str(loop)):
+                    continue
+                self._candidates.append((loop, [s for s in stems if s not in cg.edges[loop]]))
+
+    def _clf(self, loop_type):
+        if loop_type in self.clfs:
+            return self.clfs[loop_type]
+        return ftca._get_default_clf(loop_type)
+
+    def all_interactions(self, cg):
+        """
+        :returns: A list of tuples (loop, stem), like `ftca.all_interactions`
+        """
+        self._set_topology(cg)
+        fingerprints = { d: coordinate_fingerprint(cg, [d]) for d in cg.defines if d[0] in "ish" }
+        moved = set(d for d, fp in fingerprints.items() if self._fingerprints.get(d) != fp)
+        self._fingerprints = fingerprints
+        if not moved and self._interactions is not None:
+            return list(self._interactions)
+        geos = { loop_type: [] for loop_type in self.LOOP_TYPES }
+        labels = { loop_type: [] for loop_type in self.LOOP_TYPES }
+        for loop, stems in self._candidates:
+            changed = [ stem for stem in stems
+                        if loop in moved or stem in moved or (loop, stem) not in self._probs ]
+            if not changed:
+                continue
+            orientations = relative_orientations(cg, loop, changed)
+            for stem, orientation in zip(changed, orientations):
+                if not orientation[0] < ftca.CUTOFFDIST:
+                    self._probs[(loop, stem)] = None
+                    continue
+                geos[loop[0]].append(orientation)
+                labels[loop[0]].append((loop, stem))
+        for loop_type in self.LOOP_TYPES:
+            if not geos[loop_type]:
+                continue
+            loop_geos = np.array(geos[loop_type])
+            loop_geos[:, 0] /= ftca.ANGLEWEIGHT
+            probs = self._clf(loop_type).predict_proba(loop_geos)
+            log.debug("Classified %d changed loop-stem pairs of loop type %s", len(probs), loop_type)
+            self._probs.update(zip(labels[loop_type], probs))
+        # Like ftca.all_interactions, use only the best interaction per loop.
+        best_interactions = {}
+        for loop, stems in self._candidates:
+            for stem in stems:
+                p = self._probs[(loop, stem)]
+                if p is None or p < 0.5:
+                    continue
+                if loop not in best_interactions or p > best_interactions[loop][0]:
+                    best_interactions[loop] = (p, (loop, stem))
+        self._interactions = [ best_interactions[loop][1]
+                               for loop, stems in self._candidates
+                               if loop in best_interactions ]
+        return list(self._interactions)
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install future
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+"""angle_geometry.py: Where angle stats place the next stem, for many stats at once."""
+
+__metaclass__=type
+
+import logging
+
+import numpy as np
+import scipy.spatial
+
+import forgi.threedee.utilities.vector as ftuv
+import forgi.threedee.utilities.graph_pdb as ftug
+
+log = logging.getLogger(__name__)
+
+
+class AngleStatGeometry(object):
+    """
+    For a list of angle stats, the start, direction and twist of the next stem
+    in the coordinate system of the previous stem.
+
+    The stem is a virtual stem of length 5, like in cytvec.get_broken_ml_deviation.
+    """
+    def __init__(self, stats):
+        self.stats = list(stats)
+        basis = np.eye(3)
+        #: The start of the next stem (Nx3)
+        self.positions = np.array([ftug.stem2_pos_from_stem1_1(basis, stat.position_params())
+                                   for stat in self.stats]).reshape(-1,3)
+        #: The (unit) direction of the next stem (Nx3)
+        self.orientations = np.array([ftug.stem2_orient_from_stem1_1(basis,
+                                                                     [1]+list(stat.orientation_params()))
+                                      for stat in self.stats]).reshape(-1,3)
+        #: The twist vector at the start of the next stem (Nx3)
+        self.twists = np.array([ftug.twist2_orient_from_stem1_1(basis, stat.twist_params())
+                                for stat in self.stats]).reshape(-1,3)
+        #: The distance between the two stems (r1) for every stat
+        self.distances = np.array([stat.r1 for stat in self.stats], dtype=float)
+
+        #: For a subset, the geometry of all stats and the indices into it.
+        self._parent = None
+        self._indices = None
+        self._tree = None
+
+    def __len__(self):
+        return len(self.stats)
+
+    def subset(self, mask):
+        """
+        :param mask: A boolean array or an array of indices into the stats.
+        :returns: A new AngleStatGeometry for the selected stats,
+                  which shares the spatial index with this geometry.
+        """
+        indices = np.sort(np.arange(len(self.stats))[mask])
+        new = AngleStatGeometry([])
+        new.stats = [ self.stats[i] for i in indices ]
+        new.positions = self.positions[indices]
+        new.orientations = self.orientations[indices]
+        new.twists = self.twists[indices]
+        new.distances = self.distances[indices]
+        if self._parent is None:
+            new._parent, new._indices = self, indices
+        else:
+            new._parent, new._indices = self._parent, self._indices[indices]
+        return new
+
+    @property
+    def tree(self):
+        """
+        A KD-tree of the stem start positions, built on first use.
+        """
+        if self._tree is None:
+            log.debug("Building KD-tree for %d angle stats", len(self.positions))
+            self._tree = scipy.spatial.cKDTree(self.positions)
+        return self._tree
+
+    def within(self, position, max_distance):
+        """
+        :returns: The sorted indices of all stats, which place the start
+                  of the next stem at most max_distance away from position
+                  (in the coordinate system of the previous stem).
+        """
+        if len(self.stats)==0:
+            return np.zeros(0, dtype=int)
+        if self._parent is not None:
+            # Map the indices into the parent to indices into this subset.
+            found = self._parent.within(position, max_distance)
+            pos = np.minimum(np.searchsorted(self._indices, found), len(self._indices)-1)
+            return pos[self._indices[pos]==found]
+        return np.array(sorted(self.tree.query_ball_point(position, max_distance)), dtype=int)
+
+    def nearest(self, position):
+        """
+        :returns: The index of the stat, which places the start of the
+                  next stem closest to position.
+        """
+        if self._parent is not None:
+            # Subsets are drawn anew for every query and not worth an own tree.
+            return int(np.argmin(np.linalg.norm(self.positions - position, axis=1)))
+        return int(self.tree.query(position)[1])
+
+    def query(self, position, direction, twist, max_distance, max_angle, max_twist_angle=None):
+        """
+        Which stats place the next stem within max_distance Angstrom and
+        max_angle radians of the given stem?
+
+        :param position, direction, twist: The start, direction and
+                  twist vector of the target stem, in the coordinate system
+                  of the previous stem.
+        :param max_twist_angle: The maximal deviation of the twist in radians.
+                  Defaults to max_angle.
+        :returns: The sorted indices of all matching stats.
+        """
+        if max_twist_angle is None:
+            max_twist_angle = max_angle
+        found = self.within(position, max_distance)
+        found = found[_angles(self.orientations[found], direction)<=max_angle]
+        return found[_angles(self.twists[found], twist)<=max_twist_angle]
+
+
+def stem_frame(cg, stem, ml):
+    """
+    The coordinate system in which angle stats for the multiloop segment ml
+    describe the next stem, if stem is the previous stem.
+
+    :returns: A tuple origin, basis. origin is the end of stem next to ml,
+              basis is a 3x3 matrix with the basis vectors as rows.
+    """
+    sides = cg.get_sides(stem, ml)
+    stem_vec = cg.coords.get_direction(stem)
+    if sides[0] == 0:
+        stem_vec = -stem_vec
+    basis = ftuv.create_orthonormal_basis(stem_vec, cg.twists[stem][sides[0]])
+    return cg.coords[stem][sides[0]], basis
+
+def _angles(vectors, target):
+    """
+    The angles between the rows of vectors and the target vector, like ftuv.vec_angle
+    """
+    cosines = (np.dot(vectors, target)/np.linalg.norm(vectors, axis=1)
+               /ftuv.magnitude(target))
+    return np.arccos(np.clip(cosines, -1., 1.))
+
+def broken_ml_target(cg, broken_ml, fixed_stem):
+    """
+    The true stem at the other side of the broken multiloop segment,
+    in the coordinate system in which angle stats describe it.
+
+    :returns: A tuple start, direction, twist
+    """
+    origin, basis = stem_frame(cg, fixed_stem, broken_ml)
+    other_stem, = cg.edges[broken_ml] - set([fixed_stem])
+    sides = cg.get_sides(other_stem, broken_ml)
+    start = cg.coords[other_stem][sides[0]]
+    end = cg.coords[other_stem][sides[1]]
+    return (np.dot(basis, start - origin), np.dot(basis, end - start),
+            np.dot(basis, cg.twists[other_stem][sides[0]]))
+
+def next_stem_frame(origin, basis, stat):
+    """
+    Where the builder places the next stem with an angle stat.
+
+    :param origin, basis: The frame of the previous stem, see stem_frame
+    :returns: The frame (origin, basis) of the next stem at the same junction.
+    """
+    transposed = basis.T
+    start = origin + ftug.stem2_pos_from_stem1_1(transposed, stat.position_params())
+    direction = ftug.stem2_orient_from_stem1_1(transposed, [1]+list(stat.orientation_params()))
+    twist = ftug.twist2_orient_from_stem1_1(transposed, stat.twist_params())
+    # The next ml-segment starts at the same end of the stem, which points
+    # against the direction of the stem.
+    return start, ftuv.create_orthonormal_basis(-direction, twist)
+
+def junction_build_order(cg, broken_ml):
+    """
+    The (stem, ml-segment, stem) triples of cg.traverse_graph() for the
+    other segments of the multiloop of broken_ml.
+
+    :returns: A list of triples or None, if the stems of the multiloop do not
+              all meet at one junction or another segment is broken as well.
+    """
+    loop = cg.shortest_mlonly_multiloop(broken_ml)
+    order = [ triple for triple in cg.traverse_graph() if triple[1] in loop ]
+    if len(order)!=len(loop)-1:
+        return None
+    sides = {}
+    for ml in loop:
+        for stem in cg.edges[ml]:
+            side = cg.get_sides(stem, ml)[0]
+            if sides.setdefault(stem, side)!=side:
+                return None
+    return order
+
+def junction_target(cg, broken_ml, elem_defs, build_order):
+    """
+    Like broken_ml_target, but for the structure that building the multiloop
+    with the stats in elem_defs would result in, without building it.
+
+    :param build_order: The result of junction_build_order (not None)
+    """
+    frames = {}
+    for prev_stem, ml, next_stem in build_order:
+        if prev_stem not in frames:
+            frames[prev_stem] = stem_frame(cg, prev_stem, ml)
+        frames[next_stem] = next_stem_frame(*frames[prev_stem], stat=elem_defs[ml])
+    s1, s2 = sorted(cg.edges[broken_ml], key=cg.buildorder_of)
+    origin, basis = frames[s1]
+    start, basis2 = frames[s2]
+    return (np.dot(basis, start - origin), np.dot(basis, -basis2[0]),
+            np.dot(basis, basis2[1]))
+
+def target_deviations(target, geometry, indices=None):
+    """
+    The deviations of the stems placed by the stats in geometry from a target stem.
+
+    :param target: A tuple start, direction, twist, e.g. from broken_ml_target
+    :param geometry: An AngleStatGeometry
+    :param indices: If not None, only calculate the deviations for these stats.
+    :returns: A tuple of 3 arrays: The deviation of the position (in Angstrom),
+              the orientation and the twist (both in radians), for every stat.
+    """
+    if indices is None:
+        indices = slice(None)
+    position, direction, twist = target
+    pos_dev = np.linalg.norm(geometry.positions[indices] - position, axis=1)
+    return (pos_dev, _angles(geometry.orientations[indices], direction),
+            _angles(geometry.twists[indices], twist))
+
+def broken_ml_deviations(cg, broken_ml, fixed_stem, geometry, indices=None):
+    """
+    Like cytvec.get_broken_ml_deviation for all stats of geometry at once.
+
+    :param broken_ml: The name of a broken multiloop segment.
+    :param fixed_stem: The stem from which the stats place the other stem of broken_ml.
+    :param geometry: An AngleStatGeometry
+    :param indices: If not None, only calculate the deviations for these stats.
+    :returns: See target_deviations
+    """
+    return target_deviations(broken_ml_target(cg, broken_ml, fixed_stem), geometry, indices)
@@ -272,8 +272,7 @@ class Builder(object):
             node = random.choice(changable)
             sm.elem_defs[node] = self.stat_source.sample_for(sm.bg, node)
             sm.new_traverse_and_build(start=node, end=nodes[-1])
-            ec = sm.constraint_energy.eval_energy(sm.bg, nodes=nodes)
-            if ec == 0:
+            if sm.constraint_energy.fulfills(sm.bg, nodes=nodes):
                 log.debug("_rebuild_clash_only for {} was successful after {} tries".format(nodes, i))
                 return True
         log.debug("_rebuild_clash_only for {} was not successful.".format(nodes, i))
@@ -378,7 +377,8 @@ class FairBuilder(Builder):
             elif self.store_failed=="list":
                 with open(os.path.join(self.output_dir, "clashlist.txt"), "a") as f:
                     self._failed_save_counter += 1
-                    clash_pairs = set()
+                    # fulfills_clash_energy stops at the first clash. Get all of them.
+                    sm.constraint_energy.eval_energy(sm.bg)
                     f.write("{}: clash {}\n".format(self._failed_save_counter, sm.constraint_energy.bad_bulges))
             return False
 
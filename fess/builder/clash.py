@@ -0,0 +1,405 @@
+#!/usr/bin/python
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install future
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+"""clash.py: Array based data structures for the detection of clashes between virtual atoms."""
+
+__metaclass__=type
+
+import warnings
+import logging
+from collections import defaultdict
+
+import numpy as np
+
+import Bio.KDTree as kd #KD-Trees for distance-calculations in point-cloud.
+
+log = logging.getLogger(__name__)
+
+#: Virtual residues are shifted by this many Angstrom towards their strand.
+SIDE_POINT_OFFSET = 8
+#: Only the atoms of virtual residues closer than this are compared.
+RESIDUE_CUTOFF = 10.
+
+
+def _all_pairs_within(coords, radius):
+    """
+    :returns: A Nx2 integer array with all pairs of indices into coords,
+              which are closer than radius.
+    """
+    if len(coords)<2:
+        return np.zeros((0,2), dtype=int)
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")
+        kdt = kd.KDTree(3)
+        kdt.set_coords(np.asarray(coords, dtype=float))
+        kdt.all_search(radius)
+    return np.asarray(kdt.all_get_indices(), dtype=int).reshape(-1,2)
+
+
+class VirtualAtomArray(object):
+    """
+    The virtual atoms of all stems of a CoarseGrainRNA in one contiguous array.
+
+    For every side point (one per stem, position in the strand and strand)
+    and every virtual atom, parallel index arrays store the stem
+    index and the residue number. Stem connectivity is stored as a boolean
+    matrix, so clashes can be filtered with array operations only.
+    """
+    def __init__(self, cg):
+        #: The names of all stems. Indices into this list are used as stem ids.
+        self.stems = sorted(cg.stem_iterator())
+        self._stem_ids = { s:i for i, s in enumerate(self.stems) }
+        self._signature = self._cg_signature(cg)
+
+        #: excluded[i,j] is True, if stems i and j are the same or connected.
+        #: Such stems never clash.
+        self.excluded = np.eye(len(self.stems), dtype=bool)
+        for s1 in self.stems:
+            for s2 in self.stems:
+                if s1!=s2 and cg.edges[s1] & cg.edges[s2]:
+                    self.excluded[self._stem_ids[s1], self._stem_ids[s2]] = True
+
+        # One entry per side point. Ordered like the points in
+        # StemVirtualResClashEnergy.eval_energy
+        res_stem = []
+        res_resn = []
+        #: The triples (stem, i, a) for all side points
+        self.res_keys = []
+        #: The first index into the atom arrays for every side point.
+        self.res_start = []
+        atom_names = []
+        for s in self.stems:
+            for i in range(cg.stem_length(s)):
+                for a in (1, 0):
+                    res_stem.append(self._stem_ids[s])
+                    res_resn.append(cg.stem_side_vres_to_resn(s, a, i))
+                    self.res_keys.append((s, i, a))
+                    self.res_start.append(len(atom_names))
+                    atom_names.extend(cg.virtual_atoms(res_resn[-1]).keys())
+        self.res_start.append(len(atom_names))
+        self.res_stem = np.array(res_stem, dtype=int)
+        self.res_resn = np.array(res_resn, dtype=int)
+        self.res_start = np.array(self.res_start, dtype=int)
+        self._res_atom_names = [ atom_names[self.res_start[r]:self.res_start[r+1]]
+                                 for r in range(len(self.res_keys)) ]
+
+        #: For every virtual atom the index of its side point
+        self.atom_res = np.repeat(np.arange(len(self.res_keys)), np.diff(self.res_start))
+        self.atom_stem = self.res_stem[self.atom_res]
+        self.atom_resn = self.res_resn[self.atom_res]
+        #: All virtual atom coordinates. Only filled for side points
+        #: that are close to another stem.
+        self.atom_coords = np.zeros((len(atom_names), 3))
+        log.debug("VirtualAtomArray with %d stems, %d side points and %d atoms",
+                  len(self.stems), len(self.res_keys), len(atom_names))
+
+    @staticmethod
+    def _cg_signature(cg):
+        return (cg.seq_length, tuple(sorted((s, tuple(cg.defines[s])) for s in cg.stem_iterator())))
+
+    def describes(self, cg):
+        """
+        Whether or not this array has the layout for the given cg.
+        """
+        return self._cg_signature(cg) == self._signature
+
+    def stem_ids(self, stems):
+        """
+        :param stems: A list of stem names
+        :returns: An array of stem ids. Raises a KeyError for unknown stems.
+        """
+        return np.array([self._stem_ids[s] for s in stems], dtype=int)
+
+    def residue_vposs(self, cg):
+        """
+        The virtual residue position and vectors (p, v, v_l, v_r)
+        for every side point as a Nx4x3 array.
+        """
+        vposs = [ cg.v3dposs[s][i] for s in self.stems for i in range(cg.stem_length(s)) ]
+        return np.repeat(np.array(vposs), 2, axis=0)
+
+    def side_points(self, cg, vposs=None):
+        """
+        The side points of all stems as a Nx3 array.
+
+        :param vposs: The result of self.residue_vposs(cg), if it is already known.
+        """
+        if vposs is None:
+            vposs = self.residue_vposs(cg)
+        points = np.empty((len(self.res_keys), 3))
+        points[0::2] = vposs[0::2,0] + SIDE_POINT_OFFSET * vposs[0::2,2]
+        points[1::2] = vposs[1::2,0] + SIDE_POINT_OFFSET * vposs[1::2,3]
+        return points
+
+    def atom_indices(self, residues):
+        """
+        :param residues: An array of side point indices
+        :returns: An array with the indices of all atoms of these side points.
+        """
+        starts = self.res_start[residues]
+        counts = self.res_start[residues+1] - starts
+        if len(counts)==0:
+            return np.zeros(0, dtype=int)
+        offsets = np.arange(np.sum(counts)) - np.repeat(np.cumsum(counts)-counts, counts)
+        return np.repeat(starts, counts) + offsets
+
+    def update_atoms(self, cg, residues):
+        """
+        Recalculate the virtual atom coordinates of the given side points.
+        """
+        for r in residues:
+            vas = cg.virtual_atoms(int(self.res_resn[r]))
+            self.atom_coords[self.res_start[r]:self.res_start[r+1]] = [ vas[name] for name in self._res_atom_names[r]]
+
+    def candidate_residues(self, points, active):
+        """
+        Side points of different, unconnected stems closer than RESIDUE_CUTOFF.
+
+        :param points: The side points, as returned by self.side_points
+        :param active: A boolean mask of side points to consider.
+        :returns: An array of side point indices
+        """
+        active_res = np.flatnonzero(active)
+        pairs = active_res[_all_pairs_within(points[active_res], RESIDUE_CUTOFF)]
+        keep = ~self.excluded[self.res_stem[pairs[:,0]], self.res_stem[pairs[:,1]]]
+        return np.unique(pairs[keep])
+
+    def clashing_atoms(self, atoms, atom_diameter):
+        """
+        Pairs of clashing atoms of different, unconnected stems
+        that are not adjacent in the sequence.
+
+        :param atoms: Indices of the atoms to consider
+        :returns: A Nx2 array of atom indices.
+        """
+        pairs = atoms[_all_pairs_within(self.atom_coords[atoms], atom_diameter)]
+        keep = ~self.excluded[self.atom_stem[pairs[:,0]], self.atom_stem[pairs[:,1]]]
+        #Adjacent residues cannot clash
+        keep &= np.abs(self.atom_resn[pairs[:,0]] - self.atom_resn[pairs[:,1]]) != 1
+        return pairs[keep]
+
+    def clashes(self, cg, stems, atom_diameter):
+        """
+        Count the clashes between the virtual atoms of the given stems.
+
+        :param cg: The CoarseGrainRNA. Needs to be described by this VirtualAtomArray
+        :param stems: A list of stem names.
+        :param atom_diameter: The distance between two atoms which counts as a clash
+        :returns: A tuple (clashes, bad_bulges, bad_atoms). See StemVirtualResClashEnergy
+        """
+        active = np.in1d(self.res_stem, self.stem_ids(stems))
+        residues = self.candidate_residues(self.side_points(cg), active)
+        self.update_atoms(cg, residues)
+        pairs = self.clashing_atoms(self.atom_indices(residues), atom_diameter)
+        return (len(pairs),) + self.bad_bulges_and_atoms(pairs)
+
+    def bad_bulges_and_atoms(self, pairs):
+        """
+        :param pairs: A Nx2 array of clashing atom indices
+        :returns: A tuple bad_bulges, bad_atoms. See StemVirtualResClashEnergy
+        """
+        bad_atoms = defaultdict(list)
+        if len(pairs)==0:
+            return [], bad_atoms
+        stem_pairs = np.sort(np.column_stack((self.atom_stem[pairs[:,0]],
+                                              self.atom_stem[pairs[:,1]])), axis=1)
+        bad_bulges = [ tuple(sorted((self.stems[s1], self.stems[s2])))
+                       for s1, s2 in np.unique(stem_pairs, axis=0) ]
+        for ia, ib in pairs:
+            bad_atoms[self.stems[self.atom_stem[ia]]].append(self.atom_coords[ia])
+            bad_atoms[self.stems[self.atom_stem[ib]]].append(self.atom_coords[ib])
+        return bad_bulges, bad_atoms
+
+
+class CellList(object):
+    """
+    A uniform grid of cubic cells for fixed-radius neighbor searches
+    among points that move over time.
+
+    Moved points are re-binned in place and a neighbor query only
+    looks at the 27 cells around the query point.
+    Thus the search radius must not be larger than the cell size.
+    """
+    def __init__(self, cell_size):
+        self.cell_size = cell_size
+        #: A dict {cell: set of point ids}
+        self._cells = {}
+        #: A dict {point id: cell}
+        self._point_cell = {}
+        #: A dict {point id: coordinates}
+        self._coords = {}
+
+    def __len__(self):
+        return len(self._point_cell)
+
+    def __contains__(self, point_id):
+        return point_id in self._point_cell
+
+    def update(self, ids, coords):
+        """
+        Insert the points with the given ids or move them to new coordinates.
+
+        :param ids: A sequence of hashable point ids
+        :param coords: An Nx3 array
+        """
+        coords = np.asarray(coords, dtype=float).reshape(-1,3)
+        cells = np.floor(coords/self.cell_size).astype(int)
+        for point_id, cell, coord in zip(ids, map(tuple, cells), coords):
+            old_cell = self._point_cell.get(point_id)
+            if old_cell != cell:
+                if old_cell is not None:
+                    self._discard_from_cell(point_id, old_cell)
+                self._cells.setdefault(cell, set()).add(point_id)
+                self._point_cell[point_id] = cell
+            self._coords[point_id] = coord
+
+    def remove(self, ids):
+        for point_id in ids:
+            cell = self._point_cell.pop(point_id, None)
+            if cell is not None:
+                self._discard_from_cell(point_id, cell)
+                del self._coords[point_id]
+
+    def _discard_from_cell(self, point_id, cell):
+        self._cells[cell].discard(point_id)
+        if not self._cells[cell]:
+            del self._cells[cell]
+
+    def neighbors(self, point_id, radius):
+        """
+        The ids of all other points not farther than radius from the given point.
+        """
+        if radius > self.cell_size:
+            raise ValueError("Search radius {} is larger than the "
+                             "cell size {}".format(radius, self.cell_size))
+        x, y, z = self._point_cell[point_id]
+        candidates = [ other for dx in (-1, 0, 1) for dy in (-1, 0, 1) for dz in (-1, 0, 1)
+                             for other in self._cells.get((x+dx, y+dy, z+dz), ())
+                             if other != point_id ]
+        if not candidates:
+            return []
+        coords = np.array([ self._coords[other] for other in candidates ])
+        dists = np.sqrt(np.sum((coords - self._coords[point_id])**2, axis=1))
+        return [ other for other, d in zip(candidates, dists) if d <= radius ]
+
+
+def _drop_neighbors(neighbors, point_id):
+    """
+    Remove a point from a symmetric dict {point_id: set of neighbor ids}
+    """
+    for other in neighbors.pop(point_id, ()):
+        neighbors[other].discard(point_id)
+        if not neighbors[other]:
+            del neighbors[other]
+
+
+class CellListVirtualAtomArray(VirtualAtomArray):
+    """
+    A VirtualAtomArray that keeps its neighbor lists between calls to clashes.
+
+    Side points and virtual atoms are stored in persistent cell lists.
+    In every call to clashes, only the side points of moved residues are re-binned
+    and only their neighbors are searched. Virtual atoms are only recalculated
+    for moved residues that are close to another stem.
+    """
+    def __init__(self, cg, atom_diameter):
+        super(CellListVirtualAtomArray, self).__init__(cg)
+        #: The residue_vposs of the last call to clashes.
+        self._vposs = None
+        self._res_grid = CellList(RESIDUE_CUTOFF)
+        #: For every side point, the side points of different, unconnected
+        #: stems closer than RESIDUE_CUTOFF
+        self._res_neighbors = {}
+        self._reset_atoms(atom_diameter)
+
+    def _reset_atoms(self, atom_diameter):
+        self._atom_diameter = atom_diameter
+        self._atom_grid = CellList(atom_diameter)
+        #: For every atom in the atom grid, the clashing atoms.
+        self._atom_neighbors = {}
+        #: Side points whose atoms are in the atom grid
+        self._atoms_present = np.zeros(len(self.res_keys), dtype=bool)
+
+    def _add_neighbors(self, neighbors, grid, point_id, radius, allowed):
+        for other in grid.neighbors(point_id, radius):
+            if allowed(point_id, other):
+                neighbors.setdefault(point_id, set()).add(other)
+                neighbors.setdefault(other, set()).add(point_id)
+
+    def _residues_allowed(self, r1, r2):
+        return not self.excluded[self.res_stem[r1], self.res_stem[r2]]
+
+    def _atoms_allowed(self, a1, a2):
+        return (not self.excluded[self.atom_stem[a1], self.atom_stem[a2]] and
+                abs(self.atom_resn[a1]-self.atom_resn[a2]) != 1)
+
+    def update(self, cg, atom_diameter):
+        """
+        Bring the cell lists up to date with the coordinates of the cg.
+
+        :returns: The number of moved side points.
+        """
+        diameter_changed = atom_diameter != self._atom_diameter
+        if diameter_changed:
+            # All atoms are added to the new atom grid below.
+            self._reset_atoms(atom_diameter)
+        vposs = self.residue_vposs(cg)
+        if self._vposs is None:
+            moved = np.ones(len(vposs), dtype=bool)
+        else:
+            moved = np.any(vposs != self._vposs, axis=(1,2))
+        self._vposs = vposs
+        moved_res = np.flatnonzero(moved)
+        if len(moved_res)==0 and not diameter_changed:
+            return 0
+        points = self.side_points(cg, vposs)
+        self._res_grid.update(moved_res, points[moved_res])
+        for r in moved_res:
+            _drop_neighbors(self._res_neighbors, r)
+        for r in moved_res:
+            self._add_neighbors(self._res_neighbors, self._res_grid, r,
+                                RESIDUE_CUTOFF, self._residues_allowed)
+
+        candidates = np.zeros(len(self.res_keys), dtype=bool)
+        candidates[list(self._res_neighbors.keys())] = True
+        removed = np.flatnonzero(self._atoms_present & ~candidates)
+        changed = np.flatnonzero(candidates & (moved | ~self._atoms_present))
+        self._atoms_present = candidates
+
+        removed_atoms = self.atom_indices(removed)
+        self._atom_grid.remove(removed_atoms)
+        for a in removed_atoms:
+            _drop_neighbors(self._atom_neighbors, a)
+        self.update_atoms(cg, changed)
+        changed_atoms = self.atom_indices(changed)
+        self._atom_grid.update(changed_atoms, self.atom_coords[changed_atoms])
+        for a in changed_atoms:
+            _drop_neighbors(self._atom_neighbors, a)
+        for a in changed_atoms:
+            self._add_neighbors(self._atom_neighbors, self._atom_grid, a,
+                                atom_diameter, self._atoms_allowed)
+        log.debug("CellListVirtualAtomArray: %d side points moved, %d with "
+                  "changed atoms, %d atoms in clashes", len(moved_res), len(changed),
+                  len(self._atom_neighbors))
+        return len(moved_res)
+
+    def clashes(self, cg, stems, atom_diameter):
+        """
+        Count the clashes between the virtual atoms of the given stems.
+
+        See VirtualAtomArray.clashes
+        """
+        self.update(cg, atom_diameter)
+        active = np.in1d(self.res_stem, self.stem_ids(stems))
+        # Only side points close to another side point of an active stem count.
+        active_candidates = np.zeros(len(self.res_keys), dtype=bool)
+        for r, others in self._res_neighbors.items():
+            if active[r] and any(active[o] for o in others):
+                active_candidates[r] = True
+        pairs = [ (a, b) for a, others in self._atom_neighbors.items() for b in others
+                  if a < b and active_candidates[self.atom_res[a]]
+                           and active_candidates[self.atom_res[b]] ]
+        pairs = np.array(sorted(pairs), dtype=int).reshape(-1,2)
+        return (len(pairs),) + self.bad_bulges_and_atoms(pairs)
@@ -0,0 +1,257 @@
+#!/usr/bin/python
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install future
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+"""compiled_stats.py: A memory-mapped binary cache of parsed stats files."""
+
+__metaclass__=type
+
+try:
+    from collections.abc import Mapping, Sequence
+except ImportError:
+    from collections import Mapping, Sequence
+import hashlib
+import logging
+import os
+import os.path
+import shutil
+import tempfile
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+
+#: Increase this, whenever the layout of the cache changes.
+CACHE_VERSION = 1
+
+STAT_TYPES = ["stem", "angle", "loop", "3prime", "5prime"]
+
+#: One row per stat, sorted by stat type and key.
+#: Lines of stat i are lines[line_start[i]:line_stop[i]]
+_ROW_DTYPE = np.dtype([("line_start", np.int64), ("line_stop", np.int64),
+                       ("u", float), ("v", float), ("t", float),
+                       ("r1", float), ("u1", float), ("v1", float)])
+#: One row per key. The stats for the key are rows[start:stop]
+_GROUP_DTYPE = np.dtype([("stat_type", np.int8), ("key", np.int64, (3,)),
+                         ("start", np.int64), ("stop", np.int64)])
+
+def source_hash(filename):
+    """
+    The sha1 hexdigest of the content of the file and the cache layout.
+    """
+    h = hashlib.sha1()
+    h.update("compiled_stats {}".format(CACHE_VERSION).encode("ascii"))
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(1<<20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+def user_cache_dir():
+    """
+    The directory for compiled stats, if they cannot be stored next to the stats file.
+    """
+    cache_home = os.environ.get("XDG_CACHE_HOME") or os.path.expanduser(os.path.join("~", ".cache"))
+    return os.path.join(cache_home, "ernwin", "compiled_stats")
+
+def cache_dirname(filename, digest=None, directory=None):
+    """
+    The directory, where the compiled version of a stats file is stored.
+
+    :param directory: The parent directory of the result.
+                      Defaults to the directory of the stats file.
+    """
+    if digest is None:
+        digest = source_hash(filename)
+    name = "{}.{}.compiled".format(os.path.basename(filename), digest[:16])
+    if directory is None:
+        directory = os.path.dirname(filename)
+    return os.path.join(directory, name)
+
+def cache_dirnames(filename):
+    """
+    The directories for the compiled stats file, in the order in which they are tried.
+    """
+    digest = source_hash(filename)
+    return [cache_dirname(filename, digest), cache_dirname(filename, digest, user_cache_dir())]
+
+def _key_to_array(key):
+    if isinstance(key, tuple):
+        return tuple(key)+(0,)*(3-len(key))
+    return (key, 0, 0)
+
+def compile_stats(records, dirname):
+    """
+    Write the compiled stats to dirname.
+
+    The directory is written under a temporary name and renamed at the end,
+    so concurrent processes never see a partially written cache.
+
+    :param records: A list of tuples (stat_type, key, line, stat) in the
+                    order of the stats file. line is the text, which parses
+                    to the stat, key is an integer or a tuple of up to 3 integers.
+    :param dirname: The directory to create. Nothing is written, if it exists.
+    """
+    order = sorted(range(len(records)),
+                   key=lambda i: (STAT_TYPES.index(records[i][0]), _key_to_array(records[i][1])))
+    lines = [ records[i][2].encode("utf-8") for i in order ]
+    stops = np.cumsum([ len(line) for line in lines ], dtype=np.int64)
+    rows = np.zeros(len(records), dtype=_ROW_DTYPE)
+    rows["line_stop"] = stops
+    rows["line_start"] = stops - [ len(line) for line in lines ]
+    for row, i in enumerate(order):
+        stat_type, key, line, stat = records[i]
+        if stat_type == "angle":
+            rows[row] = (rows[row]["line_start"], rows[row]["line_stop"],
+                         stat.u, stat.v, stat.t, stat.r1, stat.u1, stat.v1)
+
+    groups = []
+    for row, i in enumerate(order):
+        group = (STAT_TYPES.index(records[i][0]), _key_to_array(records[i][1]))
+        if groups and groups[-1][:2] == group:
+            groups[-1] = group + (groups[-1][2], row+1)
+        else:
+            groups.append(group + (row, row+1))
+    group_arr = np.array(groups, dtype=_GROUP_DTYPE)
+
+    parent = os.path.dirname(os.path.abspath(dirname))
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError:
+            if not os.path.isdir(parent):
+                raise
+    tmpdir = tempfile.mkdtemp(dir=parent, prefix=".compiled_stats")
+    try:
+        np.save(os.path.join(tmpdir, "rows.npy"), rows)
+        np.save(os.path.join(tmpdir, "groups.npy"), group_arr)
+        np.save(os.path.join(tmpdir, "lines.npy"), np.frombuffer(b"".join(lines), dtype=np.uint8))
+        # mkdtemp only allows access for the owner.
+        os.chmod(tmpdir, 0o755)
+        try:
+            os.rename(tmpdir, dirname)
+        except OSError:
+            if not os.path.isdir(dirname):
+                raise
+            # Another process compiled the same file in the meantime.
+    finally:
+        if os.path.isdir(tmpdir):
+            shutil.rmtree(tmpdir)
+
+
+class CompiledStats(Mapping):
+    """
+    The content of a stats file, like the result of stat_container.parse_stats_file,
+    but backed by memory-mapped arrays.
+
+    Stat objects are only created (by parse_line) when a key is first accessed.
+    All processes loading the same cache share the physical memory of the arrays.
+    Pickling only stores the directory, so the unpickled object maps it again.
+    """
+    def __init__(self, dirname, parse_line):
+        """
+        :param dirname: A directory written by compile_stats
+        :param parse_line: A function, which turns a line into a tuple
+                           (stat_type, key, stat), like stat_container.parse_stat_line
+        """
+        self.dirname = dirname
+        self.parse_line = parse_line
+        self.rows = np.load(os.path.join(dirname, "rows.npy"), mmap_mode="r")
+        self.lines = np.load(os.path.join(dirname, "lines.npy"), mmap_mode="r")
+        groups = np.load(os.path.join(dirname, "groups.npy"))
+        self._stats = { stat_type: _CompiledStatsOfType(self, stat_type)
+                        for stat_type in STAT_TYPES }
+        for stat_type, key, start, stop in groups:
+            stat_type = STAT_TYPES[stat_type]
+            if stat_type == "angle":
+                key = tuple(int(k) for k in key)
+            else:
+                key = int(key[0])
+            self._stats[stat_type].groups[key] = _LazyStats(self, int(start), int(stop))
+
+    def __reduce__(self):
+        return (CompiledStats, (self.dirname, self.parse_line))
+
+    def __getitem__(self, stat_type):
+        return self._stats[stat_type]
+
+    def __iter__(self):
+        return iter(self._stats)
+
+    def __len__(self):
+        return len(self._stats)
+
+    def line(self, row):
+        """
+        The text of the stat in the given row.
+        """
+        return self.lines[self.rows[row]["line_start"]:self.rows[row]["line_stop"]].tobytes().decode("utf-8")
+
+
+class _CompiledStatsOfType(Mapping):
+    """
+    A mapping key -> list of stats for one stat type.
+    """
+    def __init__(self, compiled, stat_type):
+        self.compiled = compiled
+        self.stat_type = stat_type
+        self.groups = {}
+
+    def __getitem__(self, key):
+        return self.groups[key]
+
+    def __iter__(self):
+        return iter(self.groups)
+
+    def __len__(self):
+        return len(self.groups)
+
+
+class _LazyStats(Sequence):
+    """
+    The stats with one key. They are parsed on first access.
+    """
+    def __init__(self, compiled, start, stop):
+        self.compiled = compiled
+        self.start = start
+        self.stop = stop
+        self._stats = None
+
+    @property
+    def columns(self):
+        """
+        The rows of the compiled stats, with the numeric angle parameters.
+        """
+        return self.compiled.rows[self.start:self.stop]
+
+    def _materialize(self):
+        if self._stats is None:
+            self._stats = [ self.compiled.parse_line(self.compiled.line(row))[2]
+                            for row in range(self.start, self.stop) ]
+        return self._stats
+
+    def __getitem__(self, i):
+        return self._materialize()[i]
+
+    def __iter__(self):
+        return iter(self._materialize())
+
+    def __len__(self):
+        return self.stop-self.start
+
+    def __eq__(self, other):
+        if isinstance(other, (list, _LazyStats)):
+            return list(self) == list(other)
+        return NotImplemented
+
+    def __ne__(self, other):
+        eq = self.__eq__(other)
+        if eq is NotImplemented:
+            return eq
+        return not eq
+
+    __hash__ = None
+
+    def __repr__(self):
+        return "<_LazyStats of {} stats from {}>".format(len(self), self.compiled.dirname)
+
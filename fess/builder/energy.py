@@ -16,6 +16,7 @@ import math
 import re
 import sys
 import copy
+import contextlib
 import inspect
 import itertools
 from pprint import pprint
@@ -53,7 +54,13 @@ import forgi.threedee.classification.aminor as ftca
 
 
 from .energy_abcs import EnergyFunction, CoarseGrainEnergy, DEFAULT_ENERGY_PREFACTOR, InteractionEnergy
+from .energy_abcs import coordinate_fingerprint
 import fess.builder.aminor as fba
+import fess.builder.clash as fbc
+import fess.builder.pdd as fbpdd
+import fess.builder.fpp as fbfpp
+import fess.builder.angle_geometry as fbag
+from . import config as conf
 from fess.builder._commandline_helper import replica_substring
 from ..utils import get_all_subclasses, get_version_string
 from fess import data_file
@@ -86,6 +93,68 @@ def load_local_data(filename):
     except TypeError:
         return StringIO(data.decode("utf-8"))
 
+class HairpinDistances(object):
+    """
+    The matrix of the shortest distances between the line segments of all
+    hairpin loops.
+
+    A single instance is shared by the SLD, UIE and LLI energies.
+    It is recomputed only if the coordinates of a hairpin loop change.
+    """
+    def __init__(self):
+        self._key = None
+        #: hairpin name -> index into the matrix
+        self._index = {}
+        #: A symmetric matrix of distances, with inf on the diagonal
+        self._matrix = np.zeros((0,0))
+
+    def _update(self, cg):
+        loops = list(cg.hloop_iterator())
+        key = (cg.name, tuple(loops), coordinate_fingerprint(cg, loops))
+        if key == self._key:
+            return
+        self._key = key
+        self._index = { loop: i for i, loop in enumerate(loops) }
+        self._matrix = np.full((len(loops), len(loops)), np.inf)
+        if len(loops) < 2:
+            return
+        starts = np.array([cg.coords[loop][0] for loop in loops])
+        ends = np.array([cg.coords[loop][1] for loop in loops])
+        i, j = np.triu_indices(len(loops), 1)
+        i1, i2 = fba.closest_points(starts[i], ends[i], starts[j], ends[j])
+        self._matrix[i, j] = self._matrix[j, i] = np.linalg.norm(i1 - i2, axis=1)
+
+    def distances(self, cg, loop, others):
+        """
+        :param loop: The name of a hairpin loop
+        :param others: A list of names of hairpin loops
+        :returns: An array with the distances from loop to each of the others.
+                  The distance of loop to itself is inf.
+        """
+        self._update(cg)
+        return self._matrix[self._index[loop], [self._index[o] for o in others]]
+
+    def min_distance(self, cg, loop, others):
+        """
+        The shortest distance from loop to any of the others, like _minimal_h_h_distance.
+        """
+        others = list(others)
+        if not others:
+            return float("inf")
+        return float(np.min(self.distances(cg, loop, others)))
+
+    def count_closer_than(self, cg, loops, cutoff):
+        """
+        :param loops: A list of names of hairpin loops
+        :returns: The number of loops that are closer than cutoff
+                  to any other of the loops.
+        """
+        self._update(cg)
+        idx = [self._index[l] for l in loops]
+        return int(np.sum(np.any(self._matrix[np.ix_(idx, idx)] < cutoff, axis=1)))
+
+_hairpin_distances = HairpinDistances()
+
 class RandomEnergy(EnergyFunction):
     _shortname = "RND"
     HELPTEXT = "Random Energy"
@@ -130,9 +199,24 @@ class CheatingEnergy(EnergyFunction):
 
 
 class FitVolume(EnergyFunction):
+    """
+    How badly the virtual residues fit into the volume of a cryo-EM map
+    (all voxels with a density above the cutoff).
+
+    The measure is the mean of two fractions: the fraction of virtual
+    residues outside the volume and the fraction of volume voxels farther
+    than residue_radius from every virtual residue. It is 0 if all residues
+    are inside the volume and the volume is covered by them.
+
+    The centroid of the virtual residues is placed at the centroid of the volume.
+    """
     _shortname = "VOL"
     HELPTEXT = "Fit volumetric data"
-    def __init__(self, filename, cutoff, prefactor=None, adjustment=None):
+    def __init__(self, filename, cutoff, prefactor=None, adjustment=None, residue_radius=6.):
+        """
+        :param residue_radius: In Angstrom. Voxels of the volume within this distance
+                               to a virtual residue are covered by the RNA.
+        """
         import mrcfile #https://doi.org/10.1107/S2059798317007859
         with mrcfile.open(filename) as mrc:
             self.data = mrc.data
@@ -140,40 +224,50 @@ class FitVolume(EnergyFunction):
             voxs = mrc.voxel_size
             self.vox_x, self.vox_y, self.vox_z = voxs.x, voxs.y, voxs.z
         self.cutoff=cutoff
-        points = []
-        # TODO: Make more efficient with numpy using a grid-based approach
-        for x in range(len(self.data)):
-            for y in range(len(self.data[0])):
-                for z in range(len(self.data[0][0])):
-                    if self.data[x][y][z]>self.cutoff:
-                            points.append([x*self.vox_x,y*self.vox_y,z*self.vox_z])
-        self.centroid = ftuv.get_vector_centroid(points)
+        self.residue_radius = residue_radius
+        self._voxel_size = np.array([self.vox_x, self.vox_y, self.vox_z], dtype=float)
+        #: True for all voxels above the cutoff
+        self._volume = self.data>self.cutoff
+        self._volume_size = np.sum(self._volume)
+        self.centroid = np.mean(np.argwhere(self._volume), axis=0)*self._voxel_size
+        #: The index offsets of all voxels within residue_radius of a voxel
+        r = np.ceil(residue_radius/self._voxel_size).astype(int)
+        offsets = np.mgrid[-r[0]:r[0]+1, -r[1]:r[1]+1, -r[2]:r[2]+1].reshape(3, -1).T
+        self._sphere = offsets[np.sum((offsets*self._voxel_size)**2, axis=1)<=residue_radius**2]
         super(FitVolume, self).__init__(prefactor, adjustment)
+
+    def _residue_voxels(self, cg):
+        """
+        The voxel of every virtual residue (with their centroid at self.centroid),
+        as a Nx3 array of indices. They may lie outside of the map.
+        """
+        points = np.array([cg.get_virtual_residue(i, allow_single_stranded=True)
+                           for i in range(1, cg.seq_length+1)])
+        points = points - ftuv.get_vector_centroid(points) + self.centroid
+        return (points // self._voxel_size).astype(int)
+
+    def _in_map(self, voxels):
+        return np.all((voxels>=0) & (voxels<self.data.shape), axis=1)
+
     def eval_energy(self, cg, *args, **kwargs):
-        density = np.zeros_like(self.data)
-        points = []
-        for i in range(1, cg.seq_length+1):
-            points.append(cg.get_virtual_residue(i, allow_single_stranded=True))
-
-        # model 000 = self.centroid
-
-        origin_x, origin_y, origin_z = self.centroid
-        points = ftuv.center_on_centroid(points)
-        for point in points:
-            x,y,z = point
-            x = int((x + origin_x) // self.vox_x)
-            y = int((y + origin_y) // self.vox_y)
-            z = int((z + origin_z) // self.vox_z)
-            if 0<=x<density.shape[0] and 0<=y<density.shape[1] and 0<=z<density.shape[2]:
-                density[x][y][z]+=1
-            else:
-                self.log.debug("No overlap")
-        overlap = (density>0) & (self.data>self.cutoff)
-        return density
+        voxels = self._residue_voxels(cg)
+        in_map = self._in_map(voxels)
+        if not np.all(in_map):
+            self.log.debug("%d residues outside of the map", np.sum(~in_map))
+        in_volume = np.sum(self._volume[tuple(voxels[in_map].T)])
+        # Only the voxels around the residues are looked at, not the whole map.
+        near = np.unique(voxels, axis=0)[:,np.newaxis,:] + self._sphere
+        near = near.reshape(-1, 3)
+        near = np.unique(np.ravel_multi_index(near[self._in_map(near)].T, self.data.shape))
+        covered = np.sum(self._volume.ravel()[near])
+        self._last_measure = (1 - in_volume/len(voxels) + 1 - covered/self._volume_size)/2
+        return self.prefactor*self._last_measure
+
 class ProjectionMatchEnergy(EnergyFunction):
     _shortname = "PRO"
     HELPTEXT = ("Match Projection distances. \n"
                "Requires the projected distances.")
+    _cached_attributes = ("bad_bulges", "_last_measure", "projDir")
     @classmethod
     def from_cg(cls, prefactor, adjustment, pro_distances, cg, **kwargs):
         """
@@ -197,7 +291,7 @@ class ProjectionMatchEnergy(EnergyFunction):
         #: The optimal projection direction for the last accepted step.
         self.accepted_projDir=np.array([1.,1.,1.])
         self.projDir=np.array([1.,1.,1.])
-        self.start_points=self._get_start_points(60)
+        self.start_points=np.array(self._get_start_points(60))
     def _get_start_points(self, numPoints):
         """
         Return numPoints equally-distributed points on half the unit sphere.
@@ -223,7 +317,9 @@ class ProjectionMatchEnergy(EnergyFunction):
 
     def optimizeProjectionDistance(self, p):
         """
-        :param c: A numpy array. The projection vector that HAS TO BE NORMALIZED
+        :param p: A numpy array. The projection vector that HAS TO BE NORMALIZED,
+                  or a Nx3 array of N normalized projection vectors.
+        :returns: The sum of deviations, or an array of N sums.
 
         Let theta be the angle between the p, normal vector of the plane of projection,
         and the vector a which is projected onto that plain.
@@ -243,21 +339,48 @@ class ProjectionMatchEnergy(EnergyFunction):
         for all d, i.e. for all a, dist_3d, dist_2d considered.
         Under the side constraint that p has to be normalized.
         """
-        x=0
-        #Sum over all given distances
-        for (s,e), dist in self.distances.items():
-            sc=self.cg.coords[s]
-            ec=self.cg.coords[e]
-            #The middle point of the cg element
-            start=(sc[0]+sc[1])/2
-            end=(ec[0]+ec[1])/2
-            a=end-start
-            lengthDifferenceExperiment=ftuv.magnitude(a)**2-dist**2
-            lengthDifferenceGivenP=(p[0]*a[0]+p[1]*a[1]+p[2]*a[2])**2
-            # Add the deviation between (3d length-2d length)**2 observed vs calculated
-            # for the given projection angle
-            x+=abs(lengthDifferenceGivenP-lengthDifferenceExperiment)
-        return x
+        return self._deviation(p, *self._element_vectors(self.cg))
+
+    @staticmethod
+    def _deviation(p, a, length_differences):
+        """
+        optimizeProjectionDistance for the output of _element_vectors
+        """
+        # Add the deviation between (3d length-2d length)**2 observed vs calculated
+        # for the given projection angle(s)
+        return np.sum(np.abs(np.dot(p, a.T)**2 - length_differences), axis=-1)
+
+    @staticmethod
+    def _gradient(p, a, length_differences):
+        """
+        The gradient of _deviation with respect to p.
+        """
+        projections = np.dot(a, p)
+        signs = np.sign(projections**2 - length_differences)
+        return np.dot(2*projections*signs, a)
+
+    def _element_vectors(self, cg):
+        """
+        :returns: A tuple a, length_differences.
+                  a is a Kx3 array with the vectors between the middle points
+                  of the K pairs of elements in self.distances.
+                  length_differences is an array with the
+                  squared 3D minus squared 2D distances.
+        """
+        if getattr(self, "_pair_indices", None) is None:
+            elements = sorted(set(elem for pair in self.distances for elem in pair))
+            index = { elem: i for i, elem in enumerate(elements) }
+            pairs = list(self.distances.keys())
+            #: The element names and the indices of the start and end elements of all pairs
+            self._pair_indices = (elements, np.array([index[s] for s, e in pairs], dtype=int),
+                                  np.array([index[e] for s, e in pairs], dtype=int))
+            self._projected_distances = np.array([self.distances[pair] for pair in pairs], dtype=float)
+        elements, starts, ends = self._pair_indices
+        coords = np.array([cg.coords[elem] for elem in elements])
+        # The middle points of the cg elements
+        middles = (coords[:,0]+coords[:,1])/2
+        a = middles[ends] - middles[starts]
+        return a, np.sum(a*a, axis=1) - self._projected_distances**2
 
     def eval_energy(self, cg, background=None, nodes=None, **kwargs):
         """
@@ -267,7 +390,8 @@ class ProjectionMatchEnergy(EnergyFunction):
         This function tries to minimize its value over all projection directions.
         A global optimization is attempted and we are only interested in projection directions
         from the origin to points on half the unit sphere. Thus we first sample the energy for
-        multiple, equally distributed directions. From the best one we operform a local optimization.
+        multiple, equally distributed directions and the optimal direction of the last
+        accepted structure. From the best one we operform a local optimization.
 
         For our specific purpose, where our starting points can give a good overview over
         the landscape, this is better and faster than more sophisticated
@@ -275,15 +399,15 @@ class ProjectionMatchEnergy(EnergyFunction):
         """
         self.cg=cg
         # The projection vector has to be normalized
-        c1={'type':'eq', 'fun':lambda x: x[0]**2+x[1]**2+x[2]**2-1}
-        best_start=np.array([0.,0.,0.])
-        best_score=float('inf')
-        for direction in self.start_points:
-            score=self.optimizeProjectionDistance(direction)
-            if score<best_score:
-                best_start=direction
-                best_score=score
-        opt=scipy.optimize.minimize(self.optimizeProjectionDistance, direction,
+        c1={'type':'eq', 'fun':lambda x: x[0]**2+x[1]**2+x[2]**2-1,
+            'jac':lambda x: 2*x}
+        warm_start = self.accepted_projDir/ftuv.magnitude(self.accepted_projDir)
+        directions = np.vstack([self.start_points, warm_start])
+        vectors = self._element_vectors(cg)
+        scores = self._deviation(directions, *vectors)
+        best_start = directions[np.argmin(scores)]
+        opt=scipy.optimize.minimize(self._deviation, best_start, args=vectors,
+                                    jac=self._gradient,
                                     constraints=c1, options={"maxiter":200} )
         if opt.success:
             self.projDir=opt.x
@@ -314,11 +438,25 @@ class FPPEnergy(EnergyFunction):
         if adjustment is not None:
             warnings.warn("Adjustment {} ignored for FPP energy".format(adjustment))
         return cls(prefactor, fpp_landmarks, fpp_scale, fpp_ref_image)
+    #: An orientation (mirrored or not) is not rasterized, if its landmarks
+    #: fit this many pixels (RMSD) worse than those of the other orientation.
+    landmark_pruning_margin = 2.
+
     def __init__(self, pre, landmarks, scale, ref_image):
         super(FPPEnergy, self).__init__(prefactor = pre)
         self.landmarks = landmarks
         self.scale = scale
         self.ref_image = fpp.to_grayscale(scipy.ndimage.imread(ref_image))
+        self._ref_distance = fbfpp.CombinedDistance(self.ref_image)
+        self._points = None
+
+    def _get_points(self, cg):
+        """
+        The projected coordinates of cg, gathered again only if cg changed.
+        """
+        if self._points is None or self._points.key != fbfpp.ProjectionPoints.key_for(cg):
+            self._points = fbfpp.ProjectionPoints(cg, virtual_atoms="selected")
+        return self._points
 
     @profile
     def eval_energy(self, cg, background=True, nodes=None, **kwargs):
@@ -334,55 +472,46 @@ class FPPEnergy(EnergyFunction):
             log.info("{}: USING LSTSQ".format(e), exc_info=True)
             projection_direction = np.linalg.lstsq(np.array(vectors3d), np.array(angles))[0] #lstsq instead of solve, because system may be underdetermined
 
-        ###
-        #sm.bg.project_from = ftuv.normalize(-projection_direction)
-        #proj =  fpp.Projection2D(sm.bg, project_virtual_atoms = "selected")
-        #orig_img, _ = proj.rasterize(self.ref_image.shape[0], warn = False)
-        proj, angleA, offset_centroidA, bs = self._find_offset(cg, projection_direction, mirror = True)
-        img1, _ = proj.rasterize(self.ref_image.shape[0], bs, rotate = math.degrees(angleA), warn = False, virtual_residues = False)
-        scoreA = fph.combined_distance(img1, self.ref_image)
-        proj, angleB, offset_centroidB, bs = self._find_offset(cg, projection_direction, mirror = False)
-        img2, _ = proj.rasterize(self.ref_image.shape[0], bs, rotate = math.degrees(angleB), warn = False, virtual_residues = False)
-        scoreB = fph.combined_distance(img2, self.ref_image)
-        if scoreA<scoreB:
-            cg.project_from = ftuv.normalize(-projection_direction)
-            score, img, params = fph.locally_minimal_distance(self.ref_image, self.scale, cg,
-                                                          math.degrees(angleA), offset_centroidA,
-                                                          None, distance=fph.combined_distance,
-                                                          maxiter=200, virtual_atoms="selected")
+        ### Step 2: Find offset and rotation for both orientations
+        points = self._get_points(cg)
+        candidates = []
+        for mirror in [False, True]:
+            proj, angle, offset_centroid, bs, rmsd = self._find_offset(points, projection_direction, mirror)
+            candidates.append((rmsd, mirror, proj, angle, offset_centroid, bs))
+        best_rmsd = min(c[0] for c in candidates)
+        candidates = [ c for c in candidates
+                       if c[0] <= best_rmsd + self.landmark_pruning_margin*steplength ]
+        ### Step 3: Choose the orientation that fits the image best
+        if len(candidates) == 1:
+            log.debug("Only the orientation with mirror=%s fits the landmarks", candidates[0][1])
+            _, mirror, _, angle, offset_centroid, _ = candidates[0]
         else:
-           score, img, params = fph.locally_minimal_distance(self.ref_image, self.scale, cg,
-                                                         math.degrees(angleB), offset_centroidB,
-                                                         None, distance=fph.combined_distance,
-                                                         maxiter=200, virtual_atoms="selected")
-        #lmimg = np.zeros_like(img)
-        #for l in self.landmarks:
-        #    lmimg[l[2],l[1]]=1
-        #import matplotlib.pyplot as plt
-        #fig, ax  = plt.subplots(2,3)
-        #ax[0,0].imshow(self.ref_image, interpolation="none")
-        #ax[0,0].set_title("Reference")
-        #ax[1,0].imshow(lmimg, interpolation="none")
-        #ax[1,0].set_title("Landmarks:")
-        #ax[0,1].imshow(img1, interpolation="none")
-        #ax[0,1].set_title("IntermediateA {}".format(scoreA))
-        #ax[1,1].imshow(img2, interpolation="none")
-        #ax[1,1].set_title("IntermediateB {}".format(scoreB))
-        #ax[0,2].imshow(img, interpolation="none")
-        #ax[0,2].set_title("Final {}".format(score))
-        #ax[1,2].imshow(orig_img, interpolation="none")
-        #ax[1,2].set_title("Rot/ offset unknown")
-        #plt.show()
+            scores = []
+            for _, _, proj, angle, _, bs in candidates:
+                img, _ = proj.rasterize(self.ref_image.shape[0], bs, rotate = math.degrees(angle),
+                                        warn = False, virtual_residues = False)
+                scores.append(self._ref_distance(img))
+            _, mirror, _, angle, offset_centroid, _ = candidates[np.argmin(scores)]
+        direction = ftuv.normalize(-projection_direction if mirror else projection_direction)
+        cg.project_from = direction
+        ### Step 4: Local optimization
+        score, img, params = fbfpp.locally_minimal_distance(self._ref_distance, self.scale, points,
+                                                            math.degrees(angle), offset_centroid,
+                                                            fph.to_polar(direction)[1:],
+                                                            maxiter=200)
         self._last_measure = score
         return score*self.prefactor
 
     @profile
-    def _find_offset(self, cg, projection_direction, mirror = False):
+    def _find_offset(self, points, projection_direction, mirror = False):
+        """
+        :returns: A tuple projection, angle, offset, bounding square, landmark RMSD
+        """
         if mirror: projection_direction = -projection_direction
         steplength = self.scale/self.ref_image.shape[0]
-        cg.project_from = ftuv.normalize(projection_direction)
         ### Step 2: Find out offset and rotation.
-        proj = fpp.Projection2D(cg, project_virtual_residues = [ x[0] for x in self.landmarks], project_virtual_atoms = "selected")
+        proj = fbfpp.CachedProjection2D(points, ftuv.normalize(projection_direction),
+                                        project_virtual_residues = [ x[0] for x in self.landmarks])
         target = []
         current = []
         for l in self.landmarks:
@@ -397,8 +526,10 @@ class FPPEnergy(EnergyFunction):
             rotationMatrix[0,1] = -rotationMatrix[0,1]
             rotationMatrix[1,0] = -rotationMatrix[1,0]
         c_rot = np.dot(current, rotationMatrix)
+        deviation = target - c_rot
+        rmsd = math.sqrt(np.mean(np.sum((deviation - np.mean(deviation, axis=0))**2, axis=1)))
         bs = fph.get_box(proj, self.scale)
-        offset_centroid = target - c_rot + np.array((bs[0],bs[2]))
+        offset_centroid = deviation + np.array((bs[0],bs[2]))
         offset_centroid = ftuv.get_vector_centroid(offset_centroid)
         #The rotation angle in rad"""
         angle = math.atan2(rotationMatrix[1,0], rotationMatrix[0,0])
@@ -406,7 +537,7 @@ class FPPEnergy(EnergyFunction):
         #Calculate the bounding square using the offset.
         bs = fph.get_box(proj, self.scale, -offset_centroid)
 
-        return proj, angle, -offset_centroid, bs
+        return proj, angle, -offset_centroid, bs, rmsd
     @profile
     def _generate_equations(self, cg):
         penalty = 0
@@ -414,7 +545,7 @@ class FPPEnergy(EnergyFunction):
         # the 3 pairwise distances between landmarks.
         angles = []
         vectors3d = []
-        for i, (l0, l1) in enumerate(it.combinations(self.landmarks, 2)):
+        for i, (l0, l1) in enumerate(itertools.combinations(self.landmarks, 2)):
             vec = cg.get_virtual_residue(l1[0], True) - cg.get_virtual_residue(l0[0], True)
             vectors3d.append(vec)
             distance3d = ftuv.magnitude(vec)
@@ -494,6 +625,9 @@ class DistanceExponentialEnergy(EnergyFunction):
 
         closest_distance = ftuv.vec_distance(closest_points[1], closest_points[0])
         return closest_distance
+
+    def dependencies(self, cg, nodes=None):
+        return [self.from_elem, self.to_elem]
     @property
     def shortname(self):
         if self.prefactor==1:
@@ -517,6 +651,41 @@ class DistanceExponentialEnergy(EnergyFunction):
 
 
 
+class _StemClashData(object):
+    """
+    The data of a single stem needed for clash evaluation.
+
+    Used by the incremental mode of the StemVirtualResClashEnergy
+    to cache the virtual atoms of stems that were not moved.
+    """
+    def __init__(self, stem, points, keys):
+        """
+        :param points: A Nx3 array with the positions of the virtual residues,
+                       shifted towards the side of the strands.
+        :param keys: A list of N tuples (stem, i, a) with the position i
+                     in the strand and the strand a. See
+                     StemVirtualResClashEnergy.eval_energy
+        """
+        self.stem = stem
+        self.points = points
+        self.keys = keys
+        self.center = np.mean(points, axis=0)
+        self.radius = np.max(np.sqrt(np.sum((points - self.center)**2, axis=1)))
+        #: The virtual atoms, lazily filled for residues that
+        #: come close to other stems
+        self.vras = {}
+
+    def matches(self, points):
+        return self.points.shape == points.shape and np.array_equal(self.points, points)
+
+    def virtual_atoms(self, cg, key):
+        try:
+            return self.vras[key]
+        except KeyError:
+            s, i, a = key
+            self.vras[key] = ftug.virtual_residue_atoms(cg, s, i, a)
+            return self.vras[key]
+
 class StemVirtualResClashEnergy(EnergyFunction):
     '''
     Determine if the virtual residues clash.
@@ -527,6 +696,11 @@ class StemVirtualResClashEnergy(EnergyFunction):
     IS_CONSTRAINT_ONLY = True
     can_constrain = "sm"
     HELPTEXT = "Clash constraint energy"
+    #: If True, keep the virtual atoms of all stems and the clashes of all
+    #: pairs of stems between calls to eval_energy and only re-evaluate
+    #: stems whose coordinates have changed.
+    _incremental = False
+    _cached_attributes = ("bad_bulges", "bad_atoms")
 
 
     def __init__(self, clash_penalty = None, atom_diameter = None):
@@ -545,6 +719,28 @@ class StemVirtualResClashEnergy(EnergyFunction):
         self.bad_bulges = []
         self.bad_atoms = defaultdict(list)
 
+        #: Incremental mode: The _StemClashData of every stem evaluated so far
+        self._stem_cache = {}
+        #: Incremental mode: A dict {(stem1, stem2): (clashes, bad_atoms1, bad_atoms2)}
+        self._pair_cache = {}
+        #: Incremental mode: The atom diameter used to fill the _pair_cache
+        self._pair_cache_adjustment = None
+        #: Incremental mode: Copies of the two caches above at the last accepted step.
+        self._accepted_caches = ({}, {})
+        #: The pair of stems where self.fulfills found the last clash.
+        self._last_clash_pair = None
+
+    def accept_last_measure(self):
+        super(StemVirtualResClashEnergy, self).accept_last_measure()
+        if self._incremental:
+            self._accepted_caches = (dict(self._stem_cache), dict(self._pair_cache))
+
+    def reject_last_measure(self):
+        super(StemVirtualResClashEnergy, self).reject_last_measure()
+        if self._incremental:
+            self._stem_cache = dict(self._accepted_caches[0])
+            self._pair_cache = dict(self._accepted_caches[1])
+
     def _virtual_residue_atom_clashes_kd(self, cg):
         '''
         Check if any of the virtual residue atoms clash.
@@ -653,6 +849,9 @@ class StemVirtualResClashEnergy(EnergyFunction):
             # Special case, if only one stem is present.
             return 0.
 
+        if self._incremental:
+            return self.prefactor * self._virtual_residue_atom_clashes_incremental(cg, nodes)
+
         for d in nodes:
             if d[0] == 's':
                 s = d
@@ -706,6 +905,217 @@ class StemVirtualResClashEnergy(EnergyFunction):
         energy += self.prefactor * self._virtual_residue_atom_clashes_kd(cg)
         return energy
 
+    def dependencies(self, cg, nodes=None):
+        if nodes is None:
+            nodes = cg.defines.keys()
+        return [d for d in nodes if d[0]=="s"]
+
+    @staticmethod
+    def _stem_side_points(cg, stem, mult=8):
+        """
+        The virtual residue positions of the stem, shifted towards both strands.
+
+        :returns: A tuple (points, keys), where points is a Nx3 array and keys
+                  is a list of N triples (stem, i, a). See eval_energy
+        """
+        points = []
+        keys = []
+        for i in range(cg.stem_length(stem)):
+            (p, v, v_l, v_r) = cg.v3dposs[stem][i]
+            points.append(p + mult * v_l)
+            keys.append((stem, i, 1))
+            points.append(p + mult * v_r)
+            keys.append((stem, i, 0))
+        return np.array(points), keys
+
+    def _update_stem_cache(self, cg, stems):
+        """
+        Recalculate the side points of all stems and discard the cached
+        data of every stem that has moved.
+
+        :returns: The set of stems that have moved since the last evaluation.
+        """
+        changed = set()
+        for s in stems:
+            points, keys = self._stem_side_points(cg, s)
+            data = self._stem_cache.get(s)
+            if data is None or not data.matches(points):
+                self._stem_cache[s] = _StemClashData(s, points, keys)
+                changed.add(s)
+        if self.adjustment != self._pair_cache_adjustment:
+            self._pair_cache = {}
+            self._pair_cache_adjustment = self.adjustment
+        elif changed:
+            self._pair_cache = { pair:clashes for pair, clashes in self._pair_cache.items()
+                                 if pair[0] not in changed and pair[1] not in changed }
+        self.log.debug("Incremental clash energy: %d of %d stems changed", len(changed), len(stems))
+        return changed
+
+    def _stem_pair_clashes(self, cg, s1, s2):
+        """
+        Count the clashes between the virtual atoms of two (unconnected) stems.
+
+        Like in the non-incremental case, only the virtual atoms of residues
+        whose side points are closer than 10 Angstrom are compared.
+
+        :returns: A tuple (clashes, bad_atoms1, bad_atoms2), where the bad_atoms
+                  are lists of atom coordinates of the stems s1 and s2
+        """
+        d1 = self._stem_cache[s1]
+        d2 = self._stem_cache[s2]
+        if ftuv.vec_distance(d1.center, d2.center) > d1.radius + d2.radius + 10.:
+            return 0, [], []
+        res_dists = np.sqrt(np.sum((d1.points[:,np.newaxis,:] - d2.points[np.newaxis,:,:])**2, axis=2))
+        close = res_dists < 10.
+        if not np.any(close):
+            return 0, [], []
+        atoms = []
+        for data, candidates in [(d1, np.any(close, axis=1)), (d2, np.any(close, axis=0))]:
+            coords = []
+            resns = []
+            for key, is_candidate in zip(data.keys, candidates):
+                if not is_candidate:
+                    continue
+                resn = cg.stem_side_vres_to_resn(key[0], key[2], key[1])
+                for coord in data.virtual_atoms(cg, key).values():
+                    coords.append(coord)
+                    resns.append(resn)
+            atoms.append((np.array(coords), np.array(resns)))
+        (coords1, resn1), (coords2, resn2) = atoms
+        if len(coords1)==0 or len(coords2)==0:
+            return 0, [], []
+        atom_dists = np.sqrt(np.sum((coords1[:,np.newaxis,:] - coords2[np.newaxis,:,:])**2, axis=2))
+        #Adjacent residues cannot clash
+        clashing = (atom_dists <= self.adjustment) & (np.abs(resn1[:,np.newaxis] - resn2[np.newaxis,:]) != 1)
+        ia, ib = np.nonzero(clashing)
+        return len(ia), list(coords1[ia]), list(coords2[ib])
+
+    def fulfills(self, cg, nodes=None, **kwargs):
+        """
+        Whether there are no clashes, without counting all of them.
+
+        The evaluation stops at the first pair of stems with a clash.
+        The pair of stems that clashed last time and pairs containing
+        stems that moved since the last call are tested first.
+        Afterwards, bad_bulges only contains the first clashing pair and
+        bad_atoms is empty. Use eval_energy to get all clashes.
+
+        Like in the incremental mode, clashes are evaluated per pair of stems.
+        """
+        self.bad_bulges = []
+        self.bad_atoms = defaultdict(list)
+        if nodes is None:
+            nodes = cg.defines.keys()
+        stems = sorted(d for d in nodes if d[0]=="s")
+        if len(stems)<2:
+            return True
+        changed = self._update_stem_cache(cg, stems)
+        pairs = [ (s1, s2) for s1, s2 in itertools.combinations(stems, 2)
+                  if not cg.edges[s1] & cg.edges[s2] ]
+        pairs.sort(key=lambda pair: (pair != self._last_clash_pair,
+                                     pair[0] not in changed and pair[1] not in changed))
+        for pair in pairs:
+            try:
+                pair_clashes = self._pair_cache[pair][0]
+            except KeyError:
+                self._pair_cache[pair] = self._stem_pair_clashes(cg, *pair)
+                pair_clashes = self._pair_cache[pair][0]
+            if pair_clashes:
+                self.log.debug("Clash between %s found after testing %d of %d pairs",
+                               pair, pairs.index(pair)+1, len(pairs))
+                self._last_clash_pair = pair
+                self.bad_bulges = [pair]
+                return False
+        return True
+
+    def _virtual_residue_atom_clashes_incremental(self, cg, nodes):
+        """
+        Count the clashes like eval_energy, but reuse the results for all
+        pairs of stems that did not move since the last call.
+
+        Clashes are evaluated per pair of stems. This can differ from the
+        non-incremental evaluation only for atom pairs whose virtual residues
+        are more than 10 Angstrom apart, which are ignored here.
+        """
+        stems = sorted(d for d in nodes if d[0]=="s")
+        self._update_stem_cache(cg, stems)
+        clashes = 0
+        for s1, s2 in itertools.combinations(stems, 2):
+            if cg.edges[s1] & cg.edges[s2]:
+                # Really do not consider connected stems,
+                continue
+            try:
+                pair_clashes, bad_atoms1, bad_atoms2 = self._pair_cache[(s1, s2)]
+            except KeyError:
+                pair_clashes, bad_atoms1, bad_atoms2 = self._stem_pair_clashes(cg, s1, s2)
+                self._pair_cache[(s1, s2)] = (pair_clashes, bad_atoms1, bad_atoms2)
+            if pair_clashes:
+                self.bad_bulges.append((s1, s2))
+                self.bad_atoms[s1] += bad_atoms1
+                self.bad_atoms[s2] += bad_atoms2
+                clashes += pair_clashes
+        return clashes
+
+class IncrementalClashEnergy(StemVirtualResClashEnergy):
+    _shortname = "ICLASH"
+    HELPTEXT = ("Clash constraint energy.\n"
+                "Only re-evaluates stems that moved since\n"
+                "the last evaluation.")
+    _incremental = True
+
+class ArrayClashEnergy(StemVirtualResClashEnergy):
+    _shortname = "ACLASH"
+    HELPTEXT = ("Clash constraint energy.\n"
+                "Uses array operations on all virtual atoms\n"
+                "instead of per-atom python loops.")
+
+    def __init__(self, clash_penalty = None, atom_diameter = None):
+        super(ArrayClashEnergy, self).__init__(clash_penalty, atom_diameter)
+        #: A fess.builder.clash.VirtualAtomArray. Created for the first cg evaluated.
+        self._atom_array = None
+
+    def eval_energy(self, cg, background=False, nodes = None, **kwargs):
+        '''
+        Count how many clashes of virtual residues there are.
+
+        Returns the same energy, bad_bulges and bad_atoms as
+        StemVirtualResClashEnergy.eval_energy.
+        '''
+        self.bad_bulges = []
+        self.bad_atoms = defaultdict(list)
+        if nodes is None:
+            nodes = cg.defines.keys()
+        stems = [stem for stem in nodes if stem[0]=="s"]
+        if len(stems)<2:
+            # Special case, if only one stem is present.
+            return 0.
+        if self._atom_array is None or not self._atom_array.describes(cg):
+            self._atom_array = self._new_atom_array(cg)
+        clashes, self.bad_bulges, self.bad_atoms = self._atom_array.clashes(cg, stems, self.adjustment)
+        return self.prefactor * clashes
+
+    def fulfills(self, cg, nodes=None, **kwargs):
+        """
+        Whether there are no clashes.
+
+        Unlike StemVirtualResClashEnergy.fulfills, this counts all clashes
+        with the array kernel, so the result and bad_bulges are the same
+        as for eval_energy.
+        """
+        return self.eval_energy(cg, nodes=nodes) == 0
+
+    def _new_atom_array(self, cg):
+        return fbc.VirtualAtomArray(cg)
+
+class GridClashEnergy(ArrayClashEnergy):
+    _shortname = "GCLASH"
+    HELPTEXT = ("Clash constraint energy.\n"
+                "Keeps a cell list of virtual residues and atoms\n"
+                "for the whole trajectory and only updates moved residues.")
+
+    def _new_atom_array(self, cg):
+        return fbc.CellListVirtualAtomArray(cg, self.adjustment)
+
 class RoughJunctionClosureEnergy(EnergyFunction):
     _shortname = "JDIST"
     _JUNCTION_DEFAULT_PREFACTOR = 50000.
@@ -722,6 +1132,16 @@ class RoughJunctionClosureEnergy(EnergyFunction):
             adjustment = 1
         super(RoughJunctionClosureEnergy, self).__init__(prefactor = prefactor, adjustment=adjustment)
 
+    def dependencies(self, cg, nodes=None):
+        if nodes is None:
+            nodes = cg.defines.keys()
+        deps = set()
+        for d in nodes:
+            if d[0]=="m":
+                deps.add(d)
+                deps.update(cg.edges[d])
+        return list(deps)
+
     def eval_energy(self, cg, background=True, nodes=None, **kwargs):
         log.debug("Evaluating junction closure energy")
         if nodes == None:
@@ -776,6 +1196,14 @@ class MaxEnergyValue(EnergyFunction):
             self.bad_bulges = []
             return 0.
 
+    def snapshot(self):
+        return (super(MaxEnergyValue, self).snapshot(), self._other_energy.snapshot())
+
+    def restore(self, snapshot):
+        own, other = snapshot
+        other_unchanged = self._other_energy.restore(other)
+        return super(MaxEnergyValue, self).restore(own) and other_unchanged
+
     def precheck(self, cg, elems, elem_defs):
         c = self._other_energy.precheck(cg, elems, elem_defs)
         if c>=self.adjustment:
@@ -789,6 +1217,25 @@ class MaxEnergyValue(EnergyFunction):
         """
         pass
 
+    @property
+    def closing_stats(self):
+        """
+        A function (cg, elem_defs=None) -> list of stats for the broken
+        multiloop segment of the child energy, for which this energy would be 0.
+        See stats_below of the child energy.
+
+        Only available (otherwise an AttributeError is raised),
+        if the child is a single energy with a stats_below method.
+        """
+        try:
+            child, = self._other_energy.iterate_energies()
+        except AttributeError:
+            child = self._other_energy
+        except ValueError:
+            raise AttributeError("closing_stats requires a single child energy.")
+        stats_below = child.stats_below
+        return lambda cg, elem_defs=None: stats_below(cg, self.adjustment, elem_defs)
+
     @property
     def shortname(self):
         sn = super(MaxEnergyValue, self).shortname
@@ -803,6 +1250,7 @@ class FragmentBasedJunctionClosureEnergy(EnergyFunction):
     can_constrain = "junction"
     HELPTEXT = ("A Fragment based energy")
     _always_search=False
+    _cached_attributes = ("bad_bulges", "used_stat")
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, stat_source, **kwargs):
         energies = []
@@ -824,6 +1272,9 @@ class FragmentBasedJunctionClosureEnergy(EnergyFunction):
         # A deviation of 1 rad is equivalent to a deviation of how many angstrom
         self.angular_weight = angular_weight
         self.used_stat = None
+        #: The build order of the other segments of the junction (see
+        #: fbag.junction_build_order). False, as long as it is unknown.
+        self._junction_order = False
         super(FragmentBasedJunctionClosureEnergy, self).__init__(prefactor = prefactor,
                                                                  adjustment = adjustment)
 
@@ -843,19 +1294,136 @@ class FragmentBasedJunctionClosureEnergy(EnergyFunction):
         self.log.debug("Weighted deviation: pos: %s, orient %s, twist: %s", pdev, adev, tdev)
         return max(pdev, adev, tdev)
 
+    def _target(self, cg):
+        """
+        The true stem at the other side of the broken ml-segment.
+        """
+        s1, s2 = sorted(cg.edges[self.element], key=cg.buildorder_of)
+        return fbag.broken_ml_target(cg, self.element, s1)
+
+    def _predicted_target(self, cg, elem_defs):
+        """
+        Like _target, but for the structure, that building the junction with
+        the stats in elem_defs would result in. None, if it cannot be predicted.
+        """
+        if self._junction_order is False:
+            self._junction_order = fbag.junction_build_order(cg, self.element)
+        if self._junction_order is None:
+            return None
+        return fbag.junction_target(cg, self.element, elem_defs, self._junction_order)
+
+    def _stat_deviations(self, cg, geometry, indices=None, target=None):
+        """
+        The same as _stat_deviation for all stats of an AngleStatGeometry at once.
+
+        :param indices: If not None, only for the stats with these indices.
+        :param target: Compare to this stem instead of the true stem (see _target)
+        """
+        if target is None:
+            target = self._target(cg)
+        pdev, adev, tdev = fbag.target_deviations(target, geometry, indices)
+        return np.max([pdev, np.degrees(adev)/4, np.degrees(tdev)/4], axis=0)
+
+    def _find_best_stat(self, cg, geometry):
+        """
+        The index and deviation of the stat with the smallest deviation.
+
+        The deviation of the stat, which places the stem closest to the true
+        stem, is an upper bound for the best deviation. Only stats placing
+        the stem within this distance have to be compared.
+        """
+        target = self._target(cg)
+        position = target[0]
+        nearest = geometry.nearest(position)
+        bound, = self._stat_deviations(cg, geometry, [nearest], target)
+        # Allow for rounding differences between the KD-tree and our distances.
+        candidates = geometry.within(position, bound*(1+1e-9)+1e-9)
+        deviations = self._stat_deviations(cg, geometry, candidates, target)
+        best = np.argmin(deviations)
+        return candidates[best], float(deviations[best])
+
+    def stats_below(self, cg, max_energy, elem_defs=None):
+        """
+        All stats for the broken multiloop segment, for which the energy
+        would be below max_energy in the current structure.
+
+        Only the stats, which place the stem close enough to the true stem,
+        are retrieved from the spatial index of the stat source.
+
+        :param elem_defs: If given, for the structure that building the
+                          junction with these stats would result in.
+        :returns: A list of AngleStats or None, if the structure
+                  for elem_defs cannot be predicted.
+        """
+        if elem_defs is None:
+            target = self._target(cg)
+        else:
+            target = self._predicted_target(cg, elem_defs)
+            if target is None:
+                return None
+        if self.element in self.stat_source.continuouse:
+            geometry = fbag.AngleStatGeometry(self.stat_source.iterate_stats_for(cg, self.element))
+            candidates = np.arange(len(geometry))
+        else:
+            geometry = self.stat_source.angle_geometry_for(cg, self.element)
+            if self.prefactor>0 and self.adjustment>0 and max_energy>0:
+                max_dev = (max_energy/self.prefactor)**(1/self.adjustment)
+                # Pad the query to be independent of rounding.
+                max_dev = max_dev*(1+1e-9)+1e-9
+                candidates = geometry.query(target[0], target[1], target[2],
+                                            max_dev, math.radians(max_dev*4))
+            else:
+                candidates = np.arange(len(geometry))
+        energies = (self._stat_deviations(cg, geometry, candidates, target)**self.adjustment)*self.prefactor
+        return [ geometry.stats[i] for i in candidates[energies<max_energy] ]
+
+    def dependencies(self, cg, nodes=None):
+        return [self.element]+list(cg.edges[self.element])
+
+    def cache_key(self, cg, background=True, nodes=None, sampled_stats=None, **kwargs):
+        key = super(FragmentBasedJunctionClosureEnergy, self).cache_key(cg, background, nodes, **kwargs)
+        if sampled_stats is not None and not self._always_search:
+            # The energy depends on the stat sampled for the element.
+            key += (sampled_stats.get(self.element),)
+        return key
 
     def precheck(self, cg, elems, elem_defs):
         """
         Try, if this conformation can be ruled-out based on the element
         definitions, without building the structure.
+
+        The ml-segments of the junction connect the ends of its stems,
+        so their lengths (r1) have to form a closed polygon.
+        If self.element is not in elems, no stat has been chosen for it yet
+        and it may have any length, that a stat from the stat_source has.
+        Otherwise the stems are placed with the stats of the junction
+        (if possible) to get the deviation without building the structure.
+
+        :param elems: The ml-segments of the junction.
+        :returns: A lower bound for the energy. The position deviation is at
+                  least as large, as the polygon inequality is violated.
         """
         if self._always_search:
             return 0
         lengths = [elem_defs[e].r1 for e in elems]
-        diff = 2*max(lengths)-sum(lengths)
+        if self.element in elems:
+            diff = 2*max(lengths)-sum(lengths)
+            target = self._predicted_target(cg, elem_defs) if diff<=0 else None
+            if target is not None:
+                geometry = fbag.AngleStatGeometry([elem_defs[self.element]])
+                # Tolerate rounding differences to the built structure.
+                diff = self._stat_deviations(cg, geometry, target=target)[0]-10**-6
+        else:
+            if not lengths or self.element in self.stat_source.continuouse:
+                return 0
+            shortest, longest = self.stat_source.distance_range_for(cg, self.element)
+            total = sum(lengths)
+            # The broken segment can neither be longer than all others together,
+            # nor too short to bridge the gap left by the longest one.
+            diff = max(shortest-total, 2*max(lengths)-total-longest)
         if diff>0:
             log.debug("Precheck for lengths %s is %s", lengths, diff)
-            return diff
+            return (diff**self.adjustment)*self.prefactor
         return 0
 
 
@@ -875,12 +1443,17 @@ class FragmentBasedJunctionClosureEnergy(EnergyFunction):
             best_deviation = self._stat_deviation(cg, sampled_stats[self.element])
         else:
             log.debug("No stat sampled for %s. Searching for a suitable stat", self.element)
-            for stat in self.stat_source.iterate_stats_for(cg, self.element):
-                curr_dev = self._stat_deviation(cg, stat)
-                if curr_dev < best_deviation:
-                    best_deviation = curr_dev
-                    log.debug("Setting used stat to %s, dev %s", stat, curr_dev)
-                    self.used_stat = stat
+            if self.element in self.stat_source.continuouse:
+                for stat in self.stat_source.iterate_stats_for(cg, self.element):
+                    curr_dev = self._stat_deviation(cg, stat)
+                    if curr_dev < best_deviation:
+                        best_deviation = curr_dev
+                        log.debug("Setting used stat to %s, dev %s", stat, curr_dev)
+                        self.used_stat = stat
+            else:
+                geometry = self.stat_source.angle_geometry_for(cg, self.element)
+                best, best_deviation = self._find_best_stat(cg, geometry)
+                self.used_stat = geometry.stats[best]
         log.debug("FJC energy using fragment %s for element %s is %s", self.used_stat.pdb_name,
                                                                       self.element, best_deviation)
         self.bad_bulges = [self.element]
@@ -1013,6 +1586,9 @@ class RadiusOfGyrationEnergy(CoarseGrainEnergy):
     def _get_cg_measure(self, cg):
         return cg.radius_of_gyration("fast")
 
+    def dependencies(self, cg, nodes=None):
+        return list(cg.defines.keys())
+
     def _get_values_from_file(self, filename, length):
         data = pd.read_csv(load_local_data(filename), delimiter=' ', comment="#", names=["pdb_id","nt_length","rog"])
 
@@ -1080,6 +1656,10 @@ class AMinorEnergy(InteractionEnergy):
     HELPTEXT = "A-Minor energy"
     LOOPS=["i", "h"]
     sampled_stats_fn = data_file("stats/AME_distributions.csv")
+    _options = ("aminor_interactions",)
+    #: Shared by all AME and PAE instances, so the interactions are
+    #: predicted only once per structure and only for moved elements.
+    aminor_interactions = fba.IncrementalAMinor()
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, **kwargs):
         """
@@ -1123,7 +1703,7 @@ class AMinorEnergy(InteractionEnergy):
         self.target_interactions=target
 
     def _get_cg_measure(self, cg):
-        interactions = ftca.all_interactions(cg)
+        interactions = self.aminor_interactions.all_interactions(cg)
         interactions = set(pair[0] for pair in interactions)
         interaction_counts=0
         for d in self.qualifying_loops(cg, cg.defines):
@@ -1175,6 +1755,8 @@ class UnspecificInteractionEnergy(InteractionEnergy):
     cutoff = 15
     target_interactions = 0.27
     knowledge_weight = 50
+    #: Shared by all SLD, UIE and LLI energies
+    _hairpin_distances = _hairpin_distances
 
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, **kwargs):
@@ -1192,16 +1774,8 @@ class UnspecificInteractionEnergy(InteractionEnergy):
 
 
     def _get_cg_measure(self, cg):
-        interactions = 0
-        for loop1 in self.qualifying_loops(cg, cg.hloop_iterator()):
-            a,b = cg.coords[loop1]
-            for loop2 in self.qualifying_loops(cg, cg.hloop_iterator()):
-                if loop1 == loop2:
-                    continue
-                c,d = cg.coords[loop2]
-                if ftuv.elements_closer_than(a,b,c,d, self.cutoff):
-                    interactions+=1
-                    break
+        loops = list(self.qualifying_loops(cg, cg.hloop_iterator()))
+        interactions = self._hairpin_distances.count_closer_than(cg, loops, self.cutoff)
         return interactions/self.num_loops
 
 class LoopLoopInteractionEnergy(InteractionEnergy):
@@ -1210,6 +1784,8 @@ class LoopLoopInteractionEnergy(InteractionEnergy):
     cutoff = 15
     target_interactions = 0.27
     knowledge_weight = 50
+    #: Shared by all SLD, UIE and LLI energies
+    _hairpin_distances = _hairpin_distances
 
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, **kwargs):
@@ -1227,16 +1803,8 @@ class LoopLoopInteractionEnergy(InteractionEnergy):
 
 
     def _get_cg_measure(self, cg):
-        interactions = 0
-        for loop1 in self.qualifying_loops(cg, cg.hloop_iterator()):
-            a,b = cg.coords[loop1]
-            for loop2 in self.qualifying_loops(cg, cg.hloop_iterator()):
-                if loop1 == loop2:
-                    continue
-                c,d = cg.coords[loop2]
-                if ftuv.elements_closer_than(a,b,c,d, self.cutoff):
-                    interactions+=1
-                    break
+        loops = list(self.qualifying_loops(cg, cg.hloop_iterator()))
+        interactions = self._hairpin_distances.count_closer_than(cg, loops, self.cutoff)
         return interactions/self.num_loops
 
     def reset_distributions(self, rna_length):
@@ -1264,6 +1832,11 @@ def read_gnom_out(filename):
     return df
 
 class _PDD_Mixin(object):
+    _options = ("pdd_max_memory",)
+    #: The approximate memory in bytes per tile of distance calculations.
+    #: None for fess.builder.pdd.MAX_MEMORY
+    pdd_max_memory = None
+
     def check_level(self, level):
         if level not in ["A", "R"]:
             raise ValueError("Level has to be either 'A' or 'R', "
@@ -1367,25 +1940,22 @@ class _PDD_Mixin(object):
         return out
 
     @classmethod
-    def get_pdd(cls, cg, level, stepsize, only_seqids=None):
-        use_asserts = ftuv.USE_ASSERTS
-        ftuv.USE_ASSERTS = False
-        try:
-            points=[]
-            for i in range(1,len(cg.seq)+1):
-                if only_seqids is not None and cg.seq.to_resid(i) not in only_seqids:
-                    continue
-                if level=="R":
-                    points.append(cg.get_virtual_residue(i, allow_single_stranded=True))
-                elif level=="A":
-                    va_dict = cg.virtual_atoms(i)
-                    for k,v in va_dict.items():
-                        points.append(v)
-                else:
-                    raise ValueError("wrongLevel")
-        finally:
-            ftuv.USE_ASSERTS = use_asserts
-        return ftuv.pair_distance_distribution(points, stepsize)
+    def get_pdd(cls, cg, level, stepsize, only_seqids=None, max_memory=None):
+        """
+        :param max_memory: See fess.builder.pdd.count_pairs.
+                           Energies pass their pdd_max_memory.
+        """
+        return fbpdd.pair_distance_distribution(fbpdd.pdd_points(cg, level, only_seqids), stepsize,
+                                                max_memory)
+
+    def _get_current_pdd(self, cg):
+        """
+        Like get_pdd for this energy's level and stepwidth, but only
+        re-counts the distances of points that moved since the last call.
+        """
+        if getattr(self, "_incremental_pdd", None) is None:
+            self._incremental_pdd = fbpdd.IncrementalPDD(self._stepwidth, self.pdd_max_memory)
+        return self._incremental_pdd.update(fbpdd.pdd_points(cg, self._level, self.only_seqids))
 
     @classmethod
     def from_cg(cls, prefactor, adjustment, level, cg, pdd_target,**kwargs):
@@ -1395,7 +1965,8 @@ class _PDD_Mixin(object):
         if pdd_target=="__cg__":
             if "reference_cg" not in kwargs or kwargs["reference_cg"] is None:
                 logger.warning("Using BUILT cg for pdd '__cg__'!")
-            dists, counts = cls.get_pdd(cg, level, cls.stepwidth_from_level(level))
+            dists, counts = cls.get_pdd(cg, level, cls.stepwidth_from_level(level),
+                                        max_memory=cls.pdd_max_memory)
             errors=sum(counts)/1000
             errors/=1.5**max(0,6-cg.seq_length//100) # sum(counts)/11000 seems reasonable for tRNA
             target_pdd = pd.DataFrame({"distance":dists, "count":counts, "error":errors})
@@ -1429,6 +2000,7 @@ class _PDD_Mixin(object):
 class PDDEnergy(_PDD_Mixin, EnergyFunction):
     _shortname = "PDD"
     HELPTEXT = "Pair distance distribution energy for fitting SAXS data."
+    _cached_attributes = ("bad_bulges", "_last_measure", "_last_integral")
 
     def __init__(self, length, target_pdd, prefactor, adjustment, level="R", stepwidth=None):
         """
@@ -1449,7 +2021,7 @@ class PDDEnergy(_PDD_Mixin, EnergyFunction):
         if use_accepted_measure:
             m = self.accepted_measures[-1]
         else:
-            m = self.get_pdd(cg, self._level, self._stepwidth,self.only_seqids)[1]
+            m = self._get_current_pdd(cg)[1]
             m=self.pad(m)
             m=m/np.sum(m)
         self._last_measure=m
@@ -1466,6 +2038,24 @@ class PDDEnergy(_PDD_Mixin, EnergyFunction):
         #    plt.show()
         return self.prefactor*np.exp(integral*self.adjustment)
 
+    def eval_energy_many(self, cgs, background=True, nodes=None, **kwargs):
+        if nodes is not None:
+            raise NotImplementedError("'nodes' is not implemented for PDD Energy")
+        if len(cgs)==0:
+            return np.zeros(0)
+        pdds = np.array([ self.pad(self.get_pdd(cg, self._level, self._stepwidth, self.only_seqids,
+                                                self.pdd_max_memory)[1]*1.0)
+                          for cg in cgs ])
+        return self._energies_from_pdds(pdds)
+
+    def _energies_from_pdds(self, pdds):
+        """
+        :param pdds: A 2D array with one (unnormalized) pdd per row.
+        """
+        m = pdds/np.sum(pdds, axis=1)[:,np.newaxis]
+        integrals = np.sum(np.abs(m-self.target_values), axis=1)*self._stepwidth
+        return self.prefactor*np.exp(integrals*self.adjustment)
+
     @property
     def last_accepted_measure(self):
         return self._last_integral
@@ -1486,25 +2076,27 @@ class PDDEnergy(_PDD_Mixin, EnergyFunction):
 class LastNPDDsEnergy(PDDEnergy):
     _shortname = "LNP"
     N=100
+
+    @property
+    def distribution_state(self):
+        # The energy depends on the last N accepted measures
+        return super(LastNPDDsEnergy, self).distribution_state + (len(self.accepted_measures),)
+
     def eval_energy(self, cg, background=True, nodes=None, use_accepted_measure=False,
                     plot_debug=False, **kwargs):
         if plot_debug or nodes is not None:
             raise NotImplementedError("'plot_debug' and 'nodes' args are not implemented"
                                       " for PDD Energy")
         if use_accepted_measure:
-            m = self.accepted_measures[-self.N:]
-            self.log.debug("Using accepted pdd %s", m[-1])
+            m = self._window_sum(self.N)
+            self.log.debug("Using accepted pdd %s", self.accepted_measures[-1])
 
         else:
-            m1 = self.get_pdd(cg, self._level, self._stepwidth, self.only_seqids)[1]*1.0
+            m1 = self._get_current_pdd(cg)[1]*1.0
             self.log.debug("Got pdd %s", m1)
             m1=self.pad(m1)
-            m = self.accepted_measures[-self.N+1:]
-            m.append(m1)
+            m = self._window_sum(self.N-1) + m1
             self._last_measure=m1
-        m = np.array(m)
-        self.log.debug("Shape is %s", m.shape)
-        m=np.sum(m, axis=0)
         self.log.debug("m= %s", m)
         m/=sum(m)
         diff_vec = m-self.target_values
@@ -1531,6 +2123,56 @@ class LastNPDDsEnergy(PDDEnergy):
         #    plt.show()
         return self.prefactor*np.exp(integral*self.adjustment)
 
+    def _energies_from_pdds(self, pdds):
+        # Every pdd is combined with the last N-1 accepted pdds.
+        pdds = pdds + self._window_sum(self.N-1)
+        return super(LastNPDDsEnergy, self)._energies_from_pdds(pdds)
+
+    def _window_sum(self, last):
+        """
+        The sum of the last `last` (at most N) accepted pdds.
+
+        The last N accepted pdds are kept in a RunningWindow,
+        which is updated with the pdds accepted since the last call.
+        """
+        if (getattr(self, "_window", None) is None
+                or self._num_windowed > len(self.accepted_measures)):
+            self._window = fbpdd.RunningWindow(self.N, len(self.target_values))
+            self._num_windowed = max(0, len(self.accepted_measures)-self.N)
+        for m in self.accepted_measures[self._num_windowed:]:
+            self._window.append(m)
+        self._num_windowed = len(self.accepted_measures)
+        return self._window.sum(last)
+
+
+class _PerBinKDE(object):
+    """
+    Independent one-dimensional gaussian KDEs for every bin of a histogram,
+    evaluated for all bins with a single array operation.
+
+    Like scipy.stats.gaussian_kde with Scott's rule for every column of
+    the values. Columns without variance have a density of 10**-300,
+    like bins for which gaussian_kde raises a LinAlgError.
+    """
+    def __init__(self, values):
+        """
+        :param values: A 2D array with one histogram per row
+        """
+        self._values = np.array(values, dtype=float)
+        n = len(self._values)
+        self._sigmas = np.std(self._values, axis=0, ddof=1) * n**(-1/5)
+
+    def __call__(self, points):
+        """
+        :param points: A histogram. The i-th value is evaluated with the KDE of the i-th bin.
+        :returns: An array with one density per bin.
+        """
+        points = np.asarray(points, dtype=float)
+        valid = self._sigmas > 0
+        sigmas = np.where(valid, self._sigmas, 1.)
+        kernel = np.exp(-0.5*((points - self._values)/sigmas)**2)
+        out = np.mean(kernel, axis=0)/(math.sqrt(2*math.pi)*sigmas)
+        return np.where(valid, np.maximum(out, 10**-300), 10**-300)
 
 class Ensemble_PDD_Energy(_PDD_Mixin, CoarseGrainEnergy):
     sampled_stats_fn = None
@@ -1564,7 +2206,7 @@ class Ensemble_PDD_Energy(_PDD_Mixin, CoarseGrainEnergy):
         # At the start of sampling, set the reference PDD
         # compareable to but broader than the target PDD
         # The target-PDD never changes
-        self.accepted_measures = [self.target_values]
+        self.accepted_measures = self._new_measure_store([self.target_values])
         self.log.debug("Target values = %s", self.target_values)
         err = np.linspace(0, max(1,2*int(self.adjustment)), 11)[1:]
         for i in err:
@@ -1617,8 +2259,7 @@ class Ensemble_PDD_Energy(_PDD_Mixin, CoarseGrainEnergy):
                 plt.legend()
                 plt.show()
 
-    @classmethod
-    def _get_distribution_from_values(cls, values):
+    def _get_distribution_from_values(self, values):
         '''
         Return a probability distribution from the given values.
 
@@ -1628,8 +2269,10 @@ class Ensemble_PDD_Energy(_PDD_Mixin, CoarseGrainEnergy):
         values = np.asarray(values)
         log.debug("Getting distribution from len(%s [0]) = %s", values, len(values[0]))
         log.debug("values[:,1] = %s", values[:,1])
+        if self.dist_type == "kde" and not self.tabulate_distributions:
+            return _PerBinKDE(values)
 
-        kdes = [ super(Ensemble_PDD_Energy, cls)._get_distribution_from_values(values[:,i])
+        kdes = [ super(Ensemble_PDD_Energy, self)._get_distribution_from_values(values[:,i])
                     for i in range(len(values[0]))
                 ]
         log.debug("Ensemble_PDD used %s KDEs: %s", len(kdes), kdes)
@@ -1646,13 +2289,6 @@ class Ensemble_PDD_Energy(_PDD_Mixin, CoarseGrainEnergy):
                         out.append(v)
                     else:
                         out.append(10**-300)
-                    if False and i%10==1:
-                        import matplotlib.pyplot as plt
-                        fig,ax=plt.subplots()
-                        plt.title(i)
-                        ax.plot(np.linspace(-0.01,0.06,100), self._kdes[i](np.linspace(-0.01,0.06,100)))
-                        ax.plot([values[i]], self._kdes[i](values[i]), "ro")
-                        plt.show()
                 return np.array(out)
         return KDE(kdes)
 
@@ -1660,7 +2296,7 @@ class Ensemble_PDD_Energy(_PDD_Mixin, CoarseGrainEnergy):
         raise NotImplementedError()
 
     def _get_cg_measure(self, cg):
-        m = self.get_pdd(cg, self._level, self._stepwidth, self.only_seqids)[1]
+        m = self._get_current_pdd(cg)[1]
         m = self.pad(m)
         m = m/np.sum(m)
         return m
@@ -1723,6 +2359,8 @@ class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
     HELPTEXT = "shortest loop distance per loop"
     real_stats_fn = 'stats/sld_target_dist_1S72_0.csv'
     sampled_stats_fn = 'stats/sld_reference_dist_1S72_0.csv'
+    #: Shared by all SLD, UIE and LLI energies
+    _hairpin_distances = _hairpin_distances
 
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, **kwargs):
@@ -1822,19 +2460,27 @@ class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
     def _get_distribution_from_values(self, values):
         f = super(ShortestLoopDistancePerLoop, self)._get_distribution_from_values(values)
         self.log.debug("Getting distributions")
+        return self._mix_with_uniform(f)
+
+    def _reference_from_estimator(self, estimator):
+        return self._mix_with_uniform(estimator)
+
+    def _mix_with_uniform(self, f):
         def kde_with_uniform(measure):
             x1 = f(measure)
             assert self._lsp_max>self._lsp_min
-            if np.all(measure<self._lsp_max) and np.all(measure>self._lsp_min):
-                x2=1/(self._lsp_max-self._lsp_min)
-            else:
-                x2=0
+            x2 = np.where((measure<self._lsp_max) & (measure>self._lsp_min),
+                          1/(self._lsp_max-self._lsp_min), 0)
             self.log.debug("Mixed distr: x1 = %s, x2 = %s", x1, x2)
             return (1-self._lsp_weight)*x1+self._lsp_weight*x2
         return kde_with_uniform
 
+    def dependencies(self, cg, nodes=None):
+        return [hloop for hloop in cg.hloop_iterator()
+                if hloop not in cg.interacting_elements or hloop==self.loop_name]
+
     def _get_cg_measure(self, cg):
-        min_dist = _minimal_h_h_distance(cg, self.loop_name,
+        min_dist = self._hairpin_distances.min_distance(cg, self.loop_name,
                                         [hloop for hloop in cg.hloop_iterator()
                                          if hloop not in cg.interacting_elements ])
         return min_dist
@@ -1854,6 +2500,14 @@ class ShortestLoopDistancePerLoop(CoarseGrainEnergy):
                 energy=0
             return energy
 
+    def eval_energy_many(self, cgs, background=True, nodes=None, **kwargs):
+        energies = np.zeros(len(cgs))
+        contributing = [ i for i, cg in enumerate(cgs) if len(list(cg.hloop_iterator())) >= 2 ]
+        if contributing:
+            measures = np.array([ self._get_cg_measure(cgs[i]) for i in contributing ], dtype=float)
+            energies[contributing] = self._energies_from_measures(measures, background)
+        return energies
+
 
 class CombinedFunction(object):
     def __init__(self, funcs):
@@ -1871,6 +2525,12 @@ class CombinedFunction(object):
                              "no attribute {}".format(self._funcs, name))
 
 class CombinedEnergy(object):
+    #: How many cached values are stored per member energy.
+    #: Two values are enough to cover a rejected sampling step.
+    _CACHE_SIZE = 2
+    #: Log the cache hit rate every that many lookups.
+    _CACHE_LOG_FREQUENCY = 1000
+
     def __init__(self, energies=None, normalize=False):
         """
         :param normalize: Divide the resulting energy by the numbers of contributions
@@ -1886,6 +2546,11 @@ class CombinedEnergy(object):
             super(CombinedEnergy, self).__setattr__("energies", [])
         super(CombinedEnergy, self).__setattr__("constituing_energies", [])
         super(CombinedEnergy, self).__setattr__("normalize", normalize)
+        #: A dict {id(energy): [(energy, key, contribution, snapshot), ...]}
+        #: For member energies that declare their dependencies.
+        super(CombinedEnergy, self).__setattr__("_energy_cache", {})
+        super(CombinedEnergy, self).__setattr__("cache_hits", 0)
+        super(CombinedEnergy, self).__setattr__("cache_misses", 0)
 
     def __setattr__(self, name, val):
         if name not in self.__dict__:
@@ -1995,9 +2660,16 @@ class CombinedEnergy(object):
         num_contribs=0
 
         for energy in self.energies:
-            contrib = energy.eval_energy(cg, background=background, nodes=nodes,
-                                         use_accepted_measure=use_accepted_measure,
-                                         plot_debug = plot_debug, **kwargs)
+            key = None
+            if isinstance(energy, EnergyFunction) and not use_accepted_measure and not plot_debug:
+                key = energy.cache_key(cg, background=background, nodes=nodes, **kwargs)
+            contrib = self._cached_contribution(energy, key)
+            if contrib is None:
+                contrib = energy.eval_energy(cg, background=background, nodes=nodes,
+                                             use_accepted_measure=use_accepted_measure,
+                                             plot_debug = plot_debug, **kwargs)
+                if key is not None:
+                    self._store_contribution(energy, key, contrib)
 
             if not np.isscalar(contrib):
                 raise TypeError
@@ -2025,6 +2697,120 @@ class CombinedEnergy(object):
         log.debug("{} [{}] at {}: total energy is {}".format(str(self), self.shortname, id(self), total_energy))
         return total_energy
 
+    def _cached_contribution(self, energy, key):
+        """
+        Return the cached energy of a member energy (and restore its
+        attributes set by eval_energy), or None, if nothing is cached for this key.
+        """
+        if key is None:
+            return None
+        for cached_energy, cached_key, contrib, snapshot in self._energy_cache.get(id(energy), []):
+            if cached_energy is energy and cached_key == key:
+                energy.restore(snapshot)
+                self.cache_hits += 1
+                self._log_cache_rate()
+                return contrib
+        self.cache_misses += 1
+        self._log_cache_rate()
+        return None
+
+    def _store_contribution(self, energy, key, contrib):
+        entries = [ entry for entry in self._energy_cache.get(id(energy), [])
+                    if entry[0] is energy ]
+        entries.insert(0, (energy, key, contrib, energy.snapshot()))
+        self._energy_cache[id(energy)] = entries[:self._CACHE_SIZE]
+
+    def _log_cache_rate(self):
+        lookups = self.cache_hits + self.cache_misses
+        if lookups % self._CACHE_LOG_FREQUENCY == 0:
+            log.info("%s: %d of %d cacheable energy evaluations (%.1f%%) were cache hits",
+                     self.shortname, self.cache_hits, lookups, 100.*self.cache_hits/lookups)
+
+    def eval_energy_many(self, cgs, background=True, nodes=None, **kwargs):
+        """
+        Evaluate the total energy of many structures.
+
+        Every member energy evaluates all structures at once.
+        The state of the member energies is not changed.
+
+        :returns: A numpy array with one energy per structure.
+        """
+        total_energy = np.zeros(len(cgs))
+        for energy in self.energies:
+            if isinstance(energy, (EnergyFunction, CombinedEnergy)):
+                contrib = energy.eval_energy_many(cgs, background=background, nodes=nodes, **kwargs)
+            else:
+                contrib = np.array([ energy.eval_energy(cg, background=background, nodes=nodes, **kwargs)
+                                     for cg in cgs ], dtype=float)
+            log.debug("%s contributing %s", energy.shortname, contrib)
+            total_energy += contrib
+        if self.normalize and self.energies:
+            total_energy=total_energy/len(self.energies)
+        return total_energy
+
+    def snapshot(self):
+        """
+        Store the energy values and the state of all member energies
+        of the last call to eval_energy. See restore_energy.
+        """
+        return (list(self.constituing_energies),
+                [ energy.snapshot() if isinstance(energy, (EnergyFunction, CombinedEnergy)) else None
+                  for energy in self.energies ])
+
+    def restore(self, snapshot):
+        """
+        Restore the state of all member energies.
+
+        :returns: False, if the distribution of any member energy changed
+                  since the snapshot was taken.
+        """
+        constituing, member_snapshots = snapshot
+        self.constituing_energies = list(constituing)
+        unchanged = True
+        for energy, member_snapshot in zip(self.energies, member_snapshots):
+            if member_snapshot is None or not energy.restore(member_snapshot):
+                unchanged = False
+        return unchanged
+
+    def restore_energy(self, snapshot, cg, **kwargs):
+        """
+        Restore the state stored by snapshot and return the total energy.
+
+        Only member energies whose distributions changed since the snapshot
+        was taken are re-evaluated.
+
+        :param cg: The structure that was evaluated when the snapshot was taken.
+        :param kwargs: Passed to eval_energy of the re-evaluated energies.
+        """
+        constituing, member_snapshots = snapshot
+        if len(constituing) != len(self.energies):
+            return self.eval_energy(cg, **kwargs)
+        self.constituing_energies = []
+        total_energy = 0.
+        for energy, (_, contrib), member_snapshot in zip(self.energies, constituing, member_snapshots):
+            if isinstance(energy, CombinedEnergy):
+                contrib = energy.restore_energy(member_snapshot, cg, **kwargs)
+            elif member_snapshot is None or not energy.restore(member_snapshot):
+                log.debug("Distribution of %s changed. Re-evaluating it.", energy.shortname)
+                contrib = energy.eval_energy(cg, **kwargs)
+            self.constituing_energies.append((energy.shortname, contrib))
+            total_energy += contrib
+        if self.normalize and self.energies:
+            total_energy=total_energy/len(self.energies)
+        return total_energy
+
+    def fulfills(self, cg, nodes=None, **kwargs):
+        """
+        Whether no member energy is greater than 0.
+
+        Stops at the first member energy that is not fulfilled.
+        """
+        for energy in self.energies:
+            if not energy.fulfills(cg, nodes=nodes, **kwargs):
+                log.debug("%s not fulfilled", energy.shortname)
+                return False
+        return True
+
     def __str__(self):
         out_str = 'CombinedEnergy('
         for en in self.energies:
@@ -2082,13 +2868,68 @@ def update_parser(parser):
                                      "distribution from the SAX experiment.")
     energy_options.add_argument('--pdd-stepsize', type=float,
                                 help="If given, rescale the PDD to this stepsize.")
+    energy_options.add_argument('--pdd-max-memory', type=float, default=64,
+                                help="The approximate memory in MB used for "
+                                     "calculating pair distances at once.")
+    energy_options.add_argument('--tabulate-kde', action="store_true",
+                                help="Evaluate the target and reference KDEs of "
+                                     "coarse grained energies by interpolation "
+                                     "in precomputed tables.")
+    energy_options.add_argument('--streaming-reference', action="store_true",
+                                help="Update the reference distributions of "
+                                     "coarse grained energies with every new "
+                                     "accepted measure, instead of refitting "
+                                     "them to all accepted measures.")
+    energy_options.add_argument('--measure-window', type=int,
+                                help="Keep only the last 1-2 times this many "
+                                     "accepted measures of each energy in memory. "
+                                     "Older measures are written to binary files "
+                                     "in the output directory.")
+    energy_options.add_argument('--aminor-grid', action="store_true",
+                                help="Evaluate the A-Minor interaction probabilities "
+                                     "by interpolation in a precomputed grid, "
+                                     "which is stored in fess/stats. "
+                                     "If it does not exist, it is created (slow).")
+
+_OPTION_CLASSES = [EnergyFunction, CoarseGrainEnergy, _PDD_Mixin, AMinorEnergy]
+
+@contextlib.contextmanager
+def energy_options(**options):
+    """
+    Set options for all energies created in the with-block.
+
+    The options are the class attributes listed in the _options of
+    an energy class, e.g. measure_window or tabulate_distributions.
+    Every energy keeps the options it was created with. When the block is
+    left, the defaults are restored for energies created afterwards.
+    """
+    old = []
+    try:
+        for name, value in options.items():
+            klass, = [ k for k in _OPTION_CLASSES if name in vars(k)["_options"] ]
+            old.append((klass, name, vars(klass)[name]))
+            setattr(klass, name, value)
+        yield
+    finally:
+        for klass, name, value in reversed(old):
+            setattr(klass, name, value)
 
 def from_args(args, cg, stat_source, replica=None, reference_cg=None):
     energy_string = replica_substring(args.energy, replica)
-    energies = EnergyFunction.from_string(energy_string,
-                                          cg=cg,
-                                          stat_source=stat_source,
-                                          pdd_target=args.pdd_file,
-                                          pdd_stepsize=args.pdd_stepsize,
-                                          reference_cg=reference_cg)
+    options = { "tabulate_distributions": args.tabulate_kde,
+                "stream_reference_distribution": args.streaming_reference,
+                "measure_window": args.measure_window,
+                "measure_directory": conf.Configuration.sampling_output_dir,
+                "pdd_max_memory": int(args.pdd_max_memory*2**20) }
+    if args.aminor_grid:
+        options["aminor_interactions"] = fba.IncrementalAMinor(
+                    { loop_type: fba.get_default_grid(loop_type)
+                      for loop_type in fba.IncrementalAMinor.LOOP_TYPES })
+    with energy_options(**options):
+        energies = EnergyFunction.from_string(energy_string,
+                                              cg=cg,
+                                              stat_source=stat_source,
+                                              pdd_target=args.pdd_file,
+                                              pdd_stepsize=args.pdd_stepsize,
+                                              reference_cg=reference_cg)
     return CombinedEnergy(energies)
@@ -7,12 +7,14 @@ from future.utils import with_metaclass
 from abc import ABCMeta, abstractmethod, abstractproperty
 import numpy as np
 import scipy.stats
+import scipy.special
 import warnings
 import logging
 import itertools as it
 import time
 import math
 import os
+import os.path as op
 
 from commandline_parsable import parsable_base
 from logging_exceptions import log_to_exception
@@ -26,6 +28,237 @@ log = logging.getLogger(__name__)
 DEFAULT_ENERGY_PREFACTOR = 30
 INCR = 0.01
 
+def coordinate_fingerprint(cg, elements):
+    """
+    An exact fingerprint of the coordinates (and twists) of the given elements.
+
+    :param elements: A sequence of coarse grained element names.
+    :returns: A bytes object.
+    """
+    parts = []
+    for elem in elements:
+        parts.extend(cg.coords[elem])
+        if elem[0]=="s":
+            parts.extend(cg.twists[elem])
+    return np.array(parts, dtype=float).tobytes()
+
+class TabulatedDistribution(object):
+    """
+    A one-dimensional gaussian KDE, sampled once on a regular grid
+    and evaluated by linear interpolation of the log-density.
+
+    The grid covers the data plus `margin` bandwidths on either side.
+    Beyond the grid, only data points within `margin` bandwidths of the
+    most extreme value contribute noticeably to the KDE, so the tails
+    are evaluated exactly from these points.
+    """
+    #: The grid extends this many bandwidths beyond the data.
+    margin = 6
+    #: The minimal number of grid points per bandwidth.
+    points_per_bandwidth = 20
+    #: The minimal number of grid points.
+    min_points = 512
+
+    def __init__(self, kde):
+        """
+        :param kde: A one-dimensional scipy.stats.gaussian_kde
+        """
+        #: The tabulated KDE
+        self.kde = kde
+        data = np.ravel(kde.dataset)
+        weights = getattr(kde, "weights", None)
+        if weights is None:
+            weights = np.ones(len(data))/len(data)
+        self._sigma = math.sqrt(kde.covariance[0,0])
+        lower = data.min() - self.margin * self._sigma
+        upper = data.max() + self.margin * self._sigma
+        num_points = max(self.min_points,
+                         int(math.ceil((upper-lower)/self._sigma*self.points_per_bandwidth))+1)
+        self.xs = np.linspace(lower, upper, num_points)
+        self.log_ys = np.log(kde(self.xs))
+        lower_tail = data < data.min() + self.margin * self._sigma
+        upper_tail = data > data.max() - self.margin * self._sigma
+        log_norm = np.log(np.asarray(weights)) - math.log(math.sqrt(2*math.pi)*self._sigma)
+        self._lower_tail = data[lower_tail], log_norm[lower_tail]
+        self._upper_tail = data[upper_tail], log_norm[upper_tail]
+        log.debug("Tabulated KDE of %d values on %d grid points between %s and %s",
+                  len(data), num_points, lower, upper)
+
+    def __call__(self, points):
+        points = np.ravel(np.asarray(points, dtype=float))
+        out = np.interp(points, self.xs, self.log_ys)
+        below = points < self.xs[0]
+        if np.any(below):
+            out[below] = self._tail(points[below], *self._lower_tail)
+        above = points > self.xs[-1]
+        if np.any(above):
+            out[above] = self._tail(points[above], *self._upper_tail)
+        return np.exp(out)
+
+    def _tail(self, points, data, log_norm):
+        """
+        The log-density contributed by the given data points.
+        """
+        exponents = log_norm - (points[:,np.newaxis] - data)**2/(2*self._sigma**2)
+        return scipy.special.logsumexp(exponents, axis=1)
+
+class StreamingKDE(object):
+    """
+    A one-dimensional gaussian KDE over a growing stream of values.
+
+    The values are counted in a histogram with fixed, narrow bins, so adding
+    a value is O(1) and memory is bounded by the number of occupied bins.
+    The density is the histogram smoothed with a gaussian kernel,
+    centered on the mean of the values in each bin.
+    Like for scipy.stats.gaussian_kde, the bandwidth follows Scott's rule,
+    using the running mean and variance of all values.
+    """
+    #: The bin width is the initial bandwidth divided by this number.
+    bins_per_bandwidth = 20
+
+    def __init__(self, values):
+        """
+        :param values: The initial values. At least two of them have to be different.
+        """
+        values = np.ravel(np.asarray(values, dtype=float))
+        self._n = len(values)
+        self._mean = np.mean(values)
+        self._m2 = np.sum((values-self._mean)**2)
+        if not self._n>1 or not self._m2>0:
+            raise ValueError("At least two different values are required "
+                             "for a StreamingKDE.")
+        #: The width of the histogram bins. Fixed at initialization.
+        self.bin_width = self.bandwidth/self.bins_per_bandwidth
+        keys, inverse, counts = np.unique(np.floor(values/self.bin_width).astype(int),
+                                          return_inverse=True, return_counts=True)
+        sums = np.bincount(np.ravel(inverse), weights=values)
+        #: bin index -> [number of values, sum of values]
+        self._bins = { key: [count, sum_] for key, count, sum_
+                                          in zip(keys.tolist(), counts.tolist(), sums.tolist()) }
+        self._arrays = None
+
+    def __len__(self):
+        return self._n
+
+    @property
+    def bandwidth(self):
+        return math.sqrt(self._m2/(self._n-1)) * self._n**(-1/5)
+
+    def add(self, value):
+        """
+        Add a value to the distribution.
+        """
+        value = float(value)
+        self._n += 1
+        delta = value - self._mean
+        self._mean += delta/self._n
+        self._m2 += delta*(value-self._mean)
+        key = int(math.floor(value/self.bin_width))
+        bin_ = self._bins.setdefault(key, [0, 0.])
+        bin_[0] += 1
+        bin_[1] += value
+        self._arrays = None
+
+    def __call__(self, points):
+        points = np.ravel(np.asarray(points, dtype=float))
+        if self._arrays is None:
+            counts, sums = np.array(list(self._bins.values()), dtype=float).T
+            self._arrays = sums/counts, counts
+        centers, counts = self._arrays
+        sigma = self.bandwidth
+        kernel = np.exp(-0.5*((points[:,np.newaxis]-centers)/sigma)**2)
+        return np.dot(kernel, counts)/(self._n*sigma*math.sqrt(2*math.pi))
+
+class MeasureStore(object):
+    """
+    An append-only, list-like history of measures.
+
+    Without a window, this behaves like a list. With a window, only the
+    most recent measures (between `window` and 2*`window`) are kept as
+    python objects. Older ones are moved, in chunks of `window` measures,
+    to compact numpy arrays, which are appended to a binary file if a
+    filename is given. Iterating over the store or converting it to an
+    array yields the full history, reading it back from the file if needed.
+
+    When spilling to a file, all measures must have the same shape.
+    """
+    def __init__(self, values=(), window=None, filename=None):
+        """
+        :param values: The initial measures.
+        :param window: The minimal number of recent measures kept in memory
+                       as python objects, or None to keep all of them.
+        :param filename: A file for measures older than the window.
+                         It is overwritten when the first chunk is written.
+        """
+        if window is not None and window<1:
+            raise ValueError("The window has to be positive or None")
+        self.window = window
+        self.filename = filename
+        #: Compacted chunks that are not written to the file.
+        self._chunks = []
+        #: Number of chunks in the file.
+        self._file_chunks = 0
+        #: Number of measures in the file or in _chunks.
+        self._num_old = 0
+        self._recent = []
+        for value in values:
+            self.append(value)
+
+    def append(self, value):
+        self._recent.append(value)
+        if self.window is not None and len(self._recent)>=2*self.window:
+            chunk = np.array(self._recent[:self.window])
+            del self._recent[:self.window]
+            self._num_old += len(chunk)
+            if self.filename is None:
+                self._chunks.append(chunk)
+            else:
+                with open(self.filename, "ab" if self._file_chunks else "wb") as f:
+                    np.save(f, chunk)
+                self._file_chunks += 1
+
+    def _iter_chunks(self):
+        if self._file_chunks:
+            with open(self.filename, "rb") as f:
+                for i in range(self._file_chunks):
+                    yield np.load(f)
+        for chunk in self._chunks:
+            yield chunk
+
+    def __len__(self):
+        return self._num_old + len(self._recent)
+
+    def __iter__(self):
+        for chunk in self._iter_chunks():
+            for value in chunk:
+                yield value
+        for value in self._recent:
+            yield value
+
+    def __getitem__(self, key):
+        num_old = self._num_old
+        if isinstance(key, slice):
+            start, stop, step = key.indices(len(self))
+            if start>=num_old and step>0:
+                return self._recent[start-num_old:max(stop-num_old, 0):step]
+            return list(self)[key]
+        if key<0:
+            key += len(self)
+        if key>=num_old:
+            return self._recent[key-num_old]
+        if key<0:
+            raise IndexError("MeasureStore index out of range")
+        for chunk in self._iter_chunks():
+            if key<len(chunk):
+                return chunk[key]
+            key -= len(chunk)
+
+    def __array__(self, dtype=None):
+        return np.array(list(self), dtype=dtype)
+
+    def __repr__(self):
+        return "<MeasureStore with {} measures ({} in memory)>".format(len(self), len(self._recent))
+
 @parsable_base(False, required_kwargs=["cg"], factory_function="from_cg",
                name_attr="_shortname", helptext_sep="\n", help_attr="HELPTEXT",
                allow_pre_and_post_number=True, help_intro_list_sep="\n")
@@ -35,6 +268,25 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
     '''
     __metaclass__ = ABCMeta
 
+    #: Attributes set by eval_energy, which are stored together with a cached
+    #: energy value and restored when the cached value is used.
+    #: See CombinedEnergy.eval_energy
+    _cached_attributes = ("bad_bulges", "_last_measure")
+    #: Has to be increased whenever the energy for the same coordinates changes,
+    #: e.g. because the reference distribution was updated.
+    _cache_version = 0
+    #: Class attributes, which every energy copies in __init__.
+    #: Subclasses can add more. They can be set for all energies created in
+    #: a with-block with fess.builder.energy.energy_options, without
+    #: changing energies created before or after it.
+    _options = ("measure_window", "measure_directory")
+    #: If not None, older accepted measures are compacted to arrays, keeping
+    #: at least this many recent measures as python objects. See MeasureStore.
+    measure_window = None
+    #: If measure_window is set, write the older accepted measures to a file
+    #: in this directory instead of keeping them in memory.
+    measure_directory = None
+
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, **kwargs):
         """
@@ -46,6 +298,9 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
 
     def __init__(self, prefactor=None, adjustment=None):
         self.log = logging.getLogger(self.__class__.__module__+"."+self.__class__.__name__)
+        for klass in type(self).__mro__:
+            for option in vars(klass).get("_options", ()):
+                setattr(self, option, getattr(type(self), option))
         if prefactor is None:
             prefactor = DEFAULT_ENERGY_PREFACTOR
         if adjustment is None:
@@ -59,7 +314,7 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
         #: The reference distribution.
         #: In the case of EnergyFunctions that are not CoarseGrainEnergy instances,
         #: this is only used to dump the measures to a file.
-        self.accepted_measures = []
+        self.accepted_measures = self._new_measure_store()
 
         #: The energy function can be adjusted with a prefactor (weight)
         #: and an adjustment (offset from the target value)
@@ -76,6 +331,18 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
         if not hasattr(type(self), "name"):
             self.name = self.__class__.__name__.lower()
 
+    def _new_measure_store(self, values=()):
+        """
+        A MeasureStore for the accepted measures, configured by
+        measure_window and measure_directory.
+        """
+        filename = None
+        if self.measure_window is not None and self.measure_directory is not None:
+            filename = op.join(self.measure_directory,
+                               "{}_{}_{}.measures.npy".format(type(self).__name__.lower(),
+                                                              os.getpid(), hex(id(self))))
+        return MeasureStore(values, self.measure_window, filename)
+
     @property
     def last_accepted_measure(self):
         return self.accepted_measures[-1]
@@ -145,6 +412,94 @@ class EnergyFunction(with_metaclass(ABCMeta, object)):
     def eval_energy(self, cg, background=True, nodes=None, **kwargs):
         raise NotImplementedError
 
+    def eval_energy_many(self, cgs, background=True, nodes=None, **kwargs):
+        """
+        Evaluate the energy of many structures.
+
+        Unlike eval_energy, this does not change the state of the energy
+        (e.g. the last measure used for the reference ratio method).
+
+        :param cgs: A sequence of CoarseGrainRNA objects.
+        :param kwargs: Passed on to eval_energy for every structure.
+        :returns: A numpy array with one energy per structure.
+        """
+        snapshot = self.snapshot()
+        try:
+            return np.array([ self.eval_energy(cg, background=background, nodes=nodes, **kwargs)
+                              for cg in cgs ], dtype=float)
+        finally:
+            self.restore(snapshot)
+
+    def dependencies(self, cg, nodes=None):
+        """
+        The coarse grained elements whose coordinates (and twists) determine
+        the result of eval_energy.
+
+        :returns: A list of element names or None, if the energy depends on
+                  anything else (then it will never be cached).
+        """
+        return None
+
+    def cache_key(self, cg, background=True, nodes=None, **kwargs):
+        """
+        A hashable key which is the same for two calls to eval_energy
+        only if they return the same energy.
+
+        Used by CombinedEnergy to cache the energy values of its members.
+
+        :returns: A tuple or None, if this energy cannot be cached.
+        """
+        deps = self.dependencies(cg, nodes)
+        if deps is None:
+            return None
+        deps = tuple(sorted(deps))
+        if nodes is not None:
+            nodes = tuple(sorted(nodes))
+        return (deps, coordinate_fingerprint(cg, deps), nodes, background,
+                self.distribution_state)
+
+    @property
+    def distribution_state(self):
+        """
+        Changes whenever eval_energy may return a different value for the same
+        coordinates, e.g. during simulated annealing or after the reference
+        distribution was updated.
+        """
+        return (self.prefactor, self.adjustment, self._cache_version)
+
+    def snapshot(self):
+        """
+        Store the state set by the last call to eval_energy.
+
+        Together with restore, this lets a sampler return to the last accepted
+        state without re-evaluating the energy.
+        """
+        return ({ name: getattr(self, name) for name in self._cached_attributes
+                                            if hasattr(self, name) },
+                self.distribution_state)
+
+    def restore(self, snapshot):
+        """
+        Restore the state stored by snapshot.
+
+        :returns: False, if the distributions changed since the snapshot was taken.
+                  Then eval_energy has to be called again to get the correct energy.
+        """
+        attributes, state = snapshot
+        for name, value in attributes.items():
+            setattr(self, name, value)
+        return state == self.distribution_state
+
+    def fulfills(self, cg, nodes=None, **kwargs):
+        """
+        Whether the energy of the cg is not greater than 0.
+
+        This is used for constraint energies, where only the fact whether
+        the constraint is violated matters. Subclasses can override this to
+        stop the evaluation as soon as the first violation is found.
+        """
+        return not self.eval_energy(cg, nodes=nodes, **kwargs)>0
+
     def dump_measures(self, base_directory, iteration=None):
         '''
         Dump all of the accepted measures collected so far
@@ -218,6 +573,10 @@ class InteractionEnergy(EnergyFunction):
     def __init__(self, rna_length, num_loops, prefactor, adjustment):
         self.num_loops = num_loops
         super(InteractionEnergy, self).__init__(prefactor, adjustment)
+        #: The number and sum of accepted measures in the reference interactions.
+        #: See _resample_background_kde
+        self._num_streamed = 0
+        self._streamed_sum = 0.
         if num_loops == 0:
             log.warning("The number of loops is 0 for %s", self.shortname)
         self.reset_distributions(rna_length)
@@ -263,6 +622,28 @@ class InteractionEnergy(EnergyFunction):
             m = self._get_cg_measure(cg)
         self._last_measure = m
 
+        energy_contrib = self._interaction_energy(background)
+
+        num_interactions = int(round(m*self.num_loops))
+        self.log.debug("Energy contribution of %s = %s, "
+                  "with %s interactions (background=%s)",
+                  self.shortname,
+                  energy_contrib, num_interactions, background)
+        energy=energy_contrib*num_interactions
+        return self.prefactor*energy
+
+    def eval_energy_many(self, cgs, background=True, nodes=None, **kwargs):
+        if nodes is not None:
+            raise NotImplementedError("'nodes' is not implemented"
+                                      " for InteractionEnergies")
+        measures = np.array([ self._get_cg_measure(cg) for cg in cgs ], dtype=float)
+        num_interactions = np.round(measures*self.num_loops)
+        return self.prefactor*self._interaction_energy(background)*num_interactions
+
+    def _interaction_energy(self, background):
+        """
+        The energy of a single interaction.
+        """
         reference_perc = sum(self.reference_interactions)/len(self.reference_interactions)
         target_perc    = self.target_interactions
         if background:
@@ -272,15 +653,7 @@ class InteractionEnergy(EnergyFunction):
             e_i=-np.log(target_perc)
             e_noi=-np.log(1-target_perc)
         self.log.debug("%s , %s", e_i, e_noi)
-        energy_contrib = e_i-e_noi
-
-        num_interactions = int(round(m*self.num_loops))
-        self.log.debug("Energy contribution of %s = %s, "
-                  "with %s interactions (background=%s)",
-                  self.shortname,
-                  energy_contrib, num_interactions, background)
-        energy=energy_contrib*num_interactions
-        return self.prefactor*energy
+        return e_i-e_noi
 
 
     def _set_target_distribution(self):
@@ -291,7 +664,17 @@ class InteractionEnergy(EnergyFunction):
         pass
 
     def _resample_background_kde(self):
-        self.reference_interactions = self.accepted_measures[:]
+        """
+        Replace the reference interactions by the mean of the accepted measures.
+
+        Only the measures accepted since the last call are read, so
+        older measures spilled by the MeasureStore are not loaded again.
+        """
+        for value in self.accepted_measures[self._num_streamed:]:
+            self._streamed_sum += value
+        self._num_streamed = len(self.accepted_measures)
+        self.reference_interactions = [self._streamed_sum/self._num_streamed]
+        self._cache_version += 1
 
 
 class CoarseGrainEnergy(EnergyFunction):
@@ -300,6 +683,19 @@ class CoarseGrainEnergy(EnergyFunction):
     """
     #: Change this to anything but "kde" to use a beta distribution (UNTESTED).
     dist_type = "kde"
+    _options = ("tabulate_distributions", "stream_reference_distribution")
+    #: Set to True to evaluate one-dimensional KDEs via a precomputed
+    #: TabulatedDistribution. The tables are built whenever a distribution is fitted.
+    tabulate_distributions = False
+    #: Set to True to estimate the reference distribution of scalar measures
+    #: with a StreamingKDE, which is updated with the new accepted measures
+    #: instead of being refitted to all of them.
+    stream_reference_distribution = False
+
+    #: The StreamingKDE, if stream_reference_distribution is used.
+    _reference_estimator = None
+
+    _cached_attributes = ("bad_bulges", "_last_measure", "prev_energy")
 
     @classmethod
     def from_cg(cls, prefactor, adjustment, cg, **kwargs):
@@ -414,10 +810,17 @@ class CoarseGrainEnergy(EnergyFunction):
         """
         if self.sampled_stats_fn is not None:
             log.debug("Loading sapmled measures into accepted_measures")
-            self.accepted_measures = list(self._get_values_from_file(self.sampled_stats_fn, rna_length))
+            self.accepted_measures = self._new_measure_store(self._get_values_from_file(self.sampled_stats_fn, rna_length))
         #If sampled_stats_fn is None, we assume accepted_measures is given in the constructor
         if self.accepted_measures:
-            self.reference_distribution = self._get_distribution_from_values(self.accepted_measures)
+            if self.stream_reference_distribution and np.ndim(self.accepted_measures)==1:
+                self._reference_estimator = StreamingKDE(self.accepted_measures)
+                #: How many of the accepted_measures were added to the _reference_estimator
+                self._num_streamed = len(self.accepted_measures)
+                self.reference_distribution = self._reference_from_estimator(self._reference_estimator)
+            else:
+                self._reference_estimator = None
+                self.reference_distribution = self._get_distribution_from_values(self.accepted_measures)
         else:
             raise ValueError("Either sampled_stats_fn or accepted_measures has to be set "
                              "before calling CoarseGrainEnergy.__init__ or "
@@ -441,10 +844,17 @@ class CoarseGrainEnergy(EnergyFunction):
         Update the reference distribution based on the accepted values
         """
         log.debug("Resampling background KDE for %s. Now %d accepted measures", type(self).__name__, len(self.accepted_measures))
+        if self._reference_estimator is not None:
+            for value in self.accepted_measures[self._num_streamed:]:
+                self._reference_estimator.add(value)
+            self._num_streamed = len(self.accepted_measures)
+            self._cache_version += 1
+            return
         values = self.accepted_measures
         new_kde = self._get_distribution_from_values(values)
         if new_kde is not None:
             self.reference_distribution = new_kde
+            self._cache_version += 1
             log.debug("Density of ref AFTER resampling = %s", self.reference_distribution(self.accepted_measures[-1]))
         else:
             log.warning("Distribution is None. Cannot change background_kde")
@@ -476,8 +886,7 @@ class CoarseGrainEnergy(EnergyFunction):
         log.info("%d datapoints", len(rdata))
         return rdata[target_col]
 
-    @classmethod
-    def _get_distribution_from_values(cls, values):
+    def _get_distribution_from_values(self, values):
         '''
         Return a probability distribution from the given values.
 
@@ -486,12 +895,14 @@ class CoarseGrainEnergy(EnergyFunction):
         '''
 
         log.debug("Getting distribution from values of shape {}".format(np.shape(values)))
-        if cls.dist_type == "kde":
+        if self.dist_type == "kde":
             try:
                 k = scipy.stats.gaussian_kde(values)
             except np.linalg.linalg.LinAlgError:
                 log.exception("Setting KDE for %s to None because of", values)
                 return None
+            if self.tabulate_distributions and k.d == 1:
+                k = TabulatedDistribution(k)
         else:
             floc = -0.1
             fscale =  1.5 * max(values)
@@ -499,6 +910,15 @@ class CoarseGrainEnergy(EnergyFunction):
             k = lambda x: scipy.stats.beta.pdf(x, f[0], f[1], f[2], f[3])
         return k
 
+    def _reference_from_estimator(self, estimator):
+        """
+        The reference distribution for the given StreamingKDE.
+
+        Subclasses that modify the distributions returned by
+        _get_distribution_from_values should modify this one in the same way.
+        """
+        return estimator
+
     @abstractmethod
     def _get_cg_measure(self, cg):
         raise NotImplementedError
@@ -559,6 +979,33 @@ class CoarseGrainEnergy(EnergyFunction):
                 energy, = l
             return -energy
 
+    def eval_energy_many(self, cgs, background=True, nodes=None, **kwargs):
+        """
+        Evaluate the energy of many structures.
+
+        The measures of all structures are calculated first and the
+        distributions are evaluated once for all of them.
+        Falls back to one eval_energy call per structure for measures
+        that are not scalar.
+        """
+        if len(cgs)==0:
+            return np.zeros(0)
+        measures = np.array([ self._get_cg_measure(cg) for cg in cgs ], dtype=float)
+        if measures.ndim != 1:
+            return super(CoarseGrainEnergy, self).eval_energy_many(cgs, background, nodes, **kwargs)
+        return self._energies_from_measures(measures, background)
+
+    def _energies_from_measures(self, measures, background=True):
+        """
+        Like eval_energy, but for a 1D array of scalar measures.
+        """
+        tar_val = np.ravel(self.target_distribution(measures))
+        if background:
+            ref_val = np.ravel(self.reference_distribution(measures))
+            return -1 * self.prefactor * (np.log(tar_val) - np.log(ref_val))
+        else:
+            return -np.log(tar_val)
+
     def _update_adj(self):
         super(CoarseGrainEnergy, self)._update_adj()
         self._set_target_distribution()
@@ -567,3 +1014,4 @@ class CoarseGrainEnergy(EnergyFunction):
         log.info("Adjusting target distribution (base class)")
         scaled_vals = np.asarray(self.target_values)*self.adjustment
         self.target_distribution = self._get_distribution_from_values(scaled_vals)
+        self._cache_version += 1
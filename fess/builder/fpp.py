@@ -0,0 +1,241 @@
+#!/usr/bin/python
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install future
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+"""fpp.py: Fast projection, rasterization and image distances for the 4-point-projection energy."""
+
+__metaclass__=type
+
+import logging
+
+import numpy as np
+import scipy.ndimage
+
+import forgi.projection.projection2d as fpp
+import forgi.projection.hausdorff as fph
+
+from .energy_abcs import coordinate_fingerprint
+
+log = logging.getLogger(__name__)
+
+try:
+  profile  #The @profile decorator from line_profiler (kernprof)
+except:
+  def profile(x):
+    return x
+
+
+class ProjectionPoints(object):
+    """
+    The 3D coordinates of a structure, which are projected by fpp.Projection2D.
+
+    Gathering the virtual atoms is the expensive part of a projection,
+    so they are gathered once and can then be projected in any direction.
+    """
+    def __init__(self, cg, virtual_atoms="selected"):
+        """
+        :param virtual_atoms: Like the project_virtual_atoms parameter of fpp.Projection2D
+        """
+        elements = list(cg.sorted_element_iterator())
+        self.key = self.key_for(cg)
+        self.virtual_atom_selection = virtual_atoms
+        self.elements = elements
+        self.starts = np.array([cg.coords[elem][0] for elem in elements])
+        self.ends = np.array([cg.coords[elem][1] for elem in elements])
+        self.virtual_atoms = self._gather_virtual_atoms(cg, virtual_atoms)
+        self._cg = cg
+
+    @staticmethod
+    def key_for(cg):
+        """
+        A key that changes whenever the projected coordinates of cg change.
+        """
+        return (cg.name, coordinate_fingerprint(cg, list(cg.sorted_element_iterator())))
+
+    @staticmethod
+    def _gather_virtual_atoms(cg, virtual_atoms):
+        """
+        The virtual atoms in the same order as in fpp.Projection2D._project
+        """
+        if not virtual_atoms:
+            return np.zeros((0,3))
+        va = []
+        for pos in range(1, cg.seq_length + 1):
+            residue = cg.virtual_atoms(pos)
+            if virtual_atoms == "selected":
+                va.extend(residue[atom] for atom in ["P", "C1'", "C1", "O3'"] if atom in residue)
+            else:
+                va.extend(residue.values())
+        return np.array(va, dtype=float).reshape(-1,3)
+
+    def get_virtual_residues(self, positions):
+        return np.array([self._cg.get_virtual_residue(pos, True) for pos in positions])
+
+
+class CachedProjection2D(fpp.Projection2D):
+    """
+    A fpp.Projection2D of ProjectionPoints instead of a CoarseGrainRNA.
+    """
+    def __init__(self, points, proj_direction, rotation=0, project_virtual_residues=[]):
+        """
+        :param points: A ProjectionPoints instance
+        :param proj_direction: A carthesian vector in the direction of projection.
+        """
+        super(CachedProjection2D, self).__init__(points, proj_direction, rotation,
+                                                 points.virtual_atom_selection,
+                                                 project_virtual_residues)
+
+    @profile
+    def _project(self, points, project_virtual_atoms, project_virtual_residues):
+        basis = np.array([self._unit_vec1, self._unit_vec2]).T
+        starts = np.dot(points.starts, basis)
+        ends = np.dot(points.ends, basis)
+        self._coords = { elem: (starts[i], ends[i]) for i, elem in enumerate(points.elements) }
+        self._virtual_atoms = []
+        if project_virtual_atoms and len(points.virtual_atoms):
+            self._virtual_atoms = np.dot(points.virtual_atoms, basis)
+        if project_virtual_residues:
+            self._virtual_residues = np.dot(points.get_virtual_residues(project_virtual_residues),
+                                            basis)
+
+
+class CombinedDistance(object):
+    """
+    The same distance as fph.combined_distance to a fixed reference image,
+    using the distance transform of the reference image, which is computed only once.
+    """
+    def __init__(self, ref_img):
+        self.ref_img = np.asarray(ref_img) != 0
+        #: The distance of every pixel to the closest pixel of the reference image
+        if np.any(self.ref_img):
+            self._ref_distances = scipy.ndimage.distance_transform_edt(~self.ref_img)
+        else:
+            self._ref_distances = np.full(self.ref_img.shape, np.inf)
+
+    def hausdorff_distance(self, img):
+        """
+        Like fph.hausdorff_distance(img, self.ref_img)
+        """
+        img = np.asarray(img) != 0
+        if not np.any(img) or not np.any(self.ref_img):
+            return float("inf")
+        img_distances = scipy.ndimage.distance_transform_edt(~img)
+        return max(float(np.max(img_distances[self.ref_img])),
+                   float(np.max(self._ref_distances[img])))
+
+    def __call__(self, img):
+        img = np.asarray(img) != 0
+        tp = np.sum(img & self.ref_img)
+        if tp == 0:
+            return float("inf")
+        return np.sum(img | self.ref_img) / tp + self.hausdorff_distance(img)
+
+
+def _rasterize(projection, dpi, scale, offset, rotation):
+    box = fph.get_box(projection, scale, offset)
+    img, _ = projection.rasterize(dpi, bounding_square=box, warn=False, rotate=rotation)
+    return img
+
+@profile
+def locally_minimal_distance(distance, scale, points, start_rot, offset, proj_dir,
+                             maxiter=50, advanced=False):
+    """
+    The same local optimization as fph.locally_minimal_distance, but projecting
+    the cached points and using a distance to a fixed reference image.
+
+    :param distance: A CombinedDistance instance (or another callable
+                     taking the image as only argument), which holds the reference image.
+    :param scale: The edge length in Angstrom of the reference image.
+    :param points: A ProjectionPoints instance.
+    :param start_rot: The in-plane rotation of the projection in degrees.
+    :param offset: The offset that will be applied to the projection in Angstrom. A np.array([x,y]).
+    :param proj_dir: The starting projection direction in spherical polar coordinates.
+    :returns: A triple: (distance, image, parameters), like fph.locally_minimal_distance
+    """
+    dpi = len(distance.ref_img)
+    cell_length = scale / dpi
+    offset_stepwidth = max(1, int(cell_length / 2.5))
+    scale_projectionsteps = max(1, int(cell_length / 5) * 4)
+    curr_best_rotation = start_rot if start_rot else 0
+    curr_best_offs = np.array([0, 0]) if offset is None else offset
+    curr_best_pro = np.array(proj_dir)
+
+    projection = CachedProjection2D(points, fph.from_polar([1] + list(curr_best_pro)))
+    curr_best_score = distance(_rasterize(projection, dpi, scale, curr_best_offs, curr_best_rotation))
+
+    for _ in range(maxiter):
+        found = False
+        # Optimize offset
+        best_change_offs = np.array((0, 0))
+        directions = [np.array((1, 0)), np.array((0, 1)), np.array((-1, 0)), np.array((0, -1))]
+        if advanced:
+            directions += [np.array((1, 1)), np.array((1, -1)),
+                           np.array((-1, 1)), np.array((-1, -1))]
+        for co in directions:
+            co = co * offset_stepwidth
+            for i in range(10):
+                tmp_score = distance(_rasterize(projection, dpi, scale,
+                                                curr_best_offs + co, curr_best_rotation))
+                if tmp_score > curr_best_score:
+                    break
+                elif tmp_score < curr_best_score:
+                    curr_best_score = tmp_score
+                    best_change_offs = co
+                    break
+                else:
+                    co = co * 2
+        if np.all(best_change_offs == np.array((0, 0))):
+            found = True
+        curr_best_offs = curr_best_offs + best_change_offs
+        if not curr_best_score:
+            break
+        # Optimize rotation
+        best_change_rot = 0
+        for cr in (-0.5, 0.5):
+            for i in range(10):
+                tmp_score = distance(_rasterize(projection, dpi, scale,
+                                                curr_best_offs, curr_best_rotation + cr))
+                if tmp_score > curr_best_score:
+                    break
+                elif tmp_score < curr_best_score:
+                    curr_best_score = tmp_score
+                    best_change_rot = cr
+                    break
+                else:
+                    cr = cr * 2
+        if best_change_rot != 0:
+            found = False
+        curr_best_rotation = curr_best_rotation + best_change_rot
+        if not curr_best_score:
+            break
+        # Optimize projection direction
+        change_pro = np.array((0., 0.))
+        directions = [(0, 0.002), (0.002, 0), (0, -0.002), (-0.002, 0), (0.002, 0.002),
+                      (-0.002, -0.002), (0.002, -0.002), (-0.002, 0.002)]
+        if advanced:
+            directions += [(0.001, 0.002), (-0.001, 0.002), (0.002, 0.001), (0.002, -0.001),
+                           (0.001, -0.002), (-0.001, -0.002), (-0.002, 0.001), (-0.002, -0.001)]
+        for cp in directions:
+            cp = (cp[0] * scale_projectionsteps, cp[1] * scale_projectionsteps)
+            for i in range(10):
+                tmp_projection = CachedProjection2D(points,
+                                                    fph.from_polar([1] + list(curr_best_pro + cp)))
+                tmp_score = distance(_rasterize(tmp_projection, dpi, scale,
+                                                curr_best_offs, curr_best_rotation))
+                if tmp_score > curr_best_score:
+                    break
+                elif tmp_score < curr_best_score:
+                    curr_best_score = tmp_score
+                    projection = tmp_projection
+                    change_pro = cp
+                    break
+                else:
+                    cp = np.array(cp) * 2
+        if not np.all(change_pro == np.array((0., 0.))):
+            found = False
+        curr_best_pro = curr_best_pro + change_pro
+        if found or not curr_best_score:
+            break
+    img = _rasterize(projection, dpi, scale, curr_best_offs, curr_best_rotation)
+    return curr_best_score, img, [curr_best_pro, curr_best_rotation, curr_best_offs]
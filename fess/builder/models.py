@@ -895,7 +895,7 @@ class SpatialModel:
     def fulfills_clash_energy(self):
         if self.constraint_energy is None:
             warnings.warn("Model has no clash energy!")
-        if self.constraint_energy is not None and self.constraint_energy.eval_energy(self.bg)>0:
+        if self.constraint_energy is not None and not self.constraint_energy.fulfills(self.bg):
             log.info("CLASHING")
             return False
         return True
@@ -299,6 +299,106 @@ class EnergeticJunctionMover(Mover):
         """
         # TODO Implement
 
+    @staticmethod
+    def _build_junction(sm, elems):
+        built_nodes = []
+        for elem in elems[:-1]: # The last elem is broken!
+            nodes = sm.new_traverse_and_build(start=elem, max_steps = 1)#, finish_building=False)
+            built_nodes+=nodes
+        return built_nodes
+
+    @staticmethod
+    def _closing_stat_queries(sm, broken):
+        """
+        For the junction constraint energies of the broken ml-segment,
+        which support it, functions (cg, elem_defs) -> stats fulfilling the energy.
+        """
+        return [ energy.closing_stats
+                 for energy in sm.junction_constraint_energy[broken].energies
+                 if hasattr(energy, "closing_stats") ]
+
+    @staticmethod
+    def _query_closing_stats(sm, queries, elem_defs=None):
+        """
+        The stats fulfilling all queries. See _closing_stat_queries.
+
+        :param elem_defs: Query for the structure that building with
+                          these stats would result in.
+        :returns: A list of stats or None, if a query cannot
+                  predict the structure for elem_defs.
+        """
+        candidates = None
+        for query in queries:
+            stats = query(sm.bg, elem_defs)
+            if stats is None:
+                return None
+            if candidates is None:
+                candidates = stats
+            else:
+                found = set(map(id, stats))
+                candidates = [ stat for stat in candidates if id(stat) in found ]
+        return candidates
+
+    def _closing_stat_ids(self, sm, elems, whole_loop, queries):
+        """
+        The ids of the stats for the broken ml-segment (elems[-1]), which
+        close the junction built with the stats in sm.elem_defs,
+        according to the queries. See _closing_stat_queries.
+        """
+        broken = elems[-1]
+        # Without the broken segment, the precheck uses the range of
+        # lengths its stats can have.
+        try:
+            if sm.junction_constraint_energy[broken].precheck(sm.bg,
+                                                              [ e for e in whole_loop if e!=broken ],
+                                                              sm.elem_defs)>0:
+                return set()
+        except AttributeError:
+            pass
+        # If possible, find the stats before building the junction.
+        candidates = self._query_closing_stats(sm, queries, sm.elem_defs)
+        if candidates is None:
+            self._build_junction(sm, elems)
+            candidates = self._query_closing_stats(sm, queries)
+        log.debug("%d stats for %s close the junction", len(candidates), broken)
+        return set(map(id, candidates))
+
+    def _close_junction(self, sm, sampled_stats, elems, whole_loop, queries, closing):
+        """
+        Like _check_junction, but the junction is only built and evaluated,
+        if the stat sampled for the broken ml-segment (elems[-1]) is one of
+        the stats that close the junction built from the other sampled stats.
+
+        The combinations are still sampled for all elements, including the
+        broken one, so every combination fulfilling the junction energy
+        is found with the same probability as with _check_junction.
+        (Choosing a stat among the closing stats of the first combination of
+        the other elements that has any, would favour combinations with few
+        closing stats.)
+
+        :param queries: The result of _closing_stat_queries
+        :param closing: A dictionary, which caches the result of _closing_stat_ids
+                        for the combinations of the other elements.
+        """
+        for elem, new_stat in sampled_stats.items():
+            sm.elem_defs[elem]=new_stat
+        broken = elems[-1]
+        key = tuple(sorted((elem, id(stat)) for elem, stat in sampled_stats.items()
+                           if elem!=broken))
+        if key not in closing:
+            closing[key] = self._closing_stat_ids(sm, elems, whole_loop, queries)
+        if id(sampled_stats[broken]) not in closing[key]:
+            return False
+        # Energies that do not support the query have to be evaluated.
+        built_nodes = self._build_junction(sm, elems)
+        energy = sm.junction_constraint_energy[broken].eval_energy(sm.bg,
+                                                        nodes=built_nodes+[broken],
+                                                        sampled_stats={broken:sampled_stats[broken]})
+        if energy==0:
+            return True
+        closing[key].discard(id(sampled_stats[broken]))
+        return False
+
     def _check_junction(self, sm, sampled_stats, elems, whole_loop):
         for elem, new_stat in sampled_stats.items():
             sm.elem_defs[elem]=new_stat
@@ -311,10 +411,7 @@ class EnergeticJunctionMover(Mover):
         except AttributeError:
             pass
         # Now we have to build the junction
-        built_nodes = []
-        for elem in elems[:-1]: # The last elem is broken!
-            nodes = sm.new_traverse_and_build(start=elem, max_steps = 1)#, finish_building=False)
-            built_nodes+=nodes
+        built_nodes = self._build_junction(sm, elems)
         try:
             broken_stat = sampled_stats[elems[-1]]
         except KeyError:
@@ -343,9 +440,18 @@ class EnergeticJunctionMover(Mover):
         log.debug("For elems %s, loop index is %s, loop is %s", elems, i, whole_loop)
         loop = whole_loop[i:]
         log.info("Loop now %s", loop)
+        broken = loop[-1]
+        queries = self._closing_stat_queries(sm, broken) if broken in elems else []
+        if queries:
+            # Look up the stats for the broken segment, which close the
+            # junction, instead of building it for every combination.
+            closing = {}
+            check = lambda sampled: self._close_junction(sm, sampled, loop, whole_loop, queries, closing)
+        else:
+            check = lambda sampled: self._check_junction(sm, sampled, loop, whole_loop)
         for sampled in create.stat_combinations(sm.bg, elems, self.stat_source):
             counter+=1
-            if self._check_junction(sm, sampled, loop, whole_loop):
+            if check(sampled):
                 log.info("Succsessfuly combination found after %d tried", counter)
                 if self.max_tries is not None:
                     self.max_tries = int(max(self.original_max_tries, self.max_tries*3/4, counter+(self.original_max_tries/2)))
@@ -0,0 +1,199 @@
+#!/usr/bin/python
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install future
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+"""pdd.py: Pair distance distributions of virtual residues or virtual atoms."""
+
+__metaclass__=type
+
+import logging
+import math
+
+import numpy as np
+
+import forgi.threedee.utilities.vector as ftuv
+
+log = logging.getLogger(__name__)
+
+
+def pdd_points(cg, level, only_seqids=None):
+    """
+    The points used for the pair distance distribution, in a fixed order.
+
+    :param level: "R" for virtual residues or "A" for virtual atoms.
+    :param only_seqids: If not None, only use nucleotides with these resids.
+    :returns: A Nx3 array
+    """
+    use_asserts = ftuv.USE_ASSERTS
+    ftuv.USE_ASSERTS = False
+    try:
+        points=[]
+        for i in range(1,len(cg.seq)+1):
+            if only_seqids is not None and cg.seq.to_resid(i) not in only_seqids:
+                continue
+            if level=="R":
+                points.append(cg.get_virtual_residue(i, allow_single_stranded=True))
+            elif level=="A":
+                va_dict = cg.virtual_atoms(i)
+                for k,v in va_dict.items():
+                    points.append(v)
+            else:
+                raise ValueError("wrongLevel")
+    finally:
+        ftuv.USE_ASSERTS = use_asserts
+    return np.array(points, dtype=float).reshape(-1, 3)
+
+#: The approximate memory in bytes, which may be used for
+#: the distances of one tile of point pairs.
+MAX_MEMORY = 64*2**20
+#: The approximate memory needed per point pair in a tile.
+_BYTES_PER_PAIR = 64
+
+def _add_counts(counts, bins, sign=1):
+    """
+    Add (or for sign=-1 subtract) the bins to the histogram counts.
+
+    :returns: The histogram, extended if required.
+    """
+    if len(bins)==0:
+        return counts
+    if bins.max() >= len(counts):
+        counts = np.concatenate([counts, np.zeros(bins.max()+1-len(counts), dtype=int)])
+    counts += sign*np.bincount(bins, minlength=len(counts))
+    return counts
+
+def count_pairs(points, stepsize, rows=None, counts=None, sign=1, max_memory=None):
+    """
+    Add the distances of all pairs of points with at least one point in rows
+    to the histogram counts. Each pair is counted once.
+
+    The pairs are processed in square tiles, so the memory used does not
+    depend on the number of points.
+    Distances and bins are calculated exactly like in ftuv.pair_distance_distribution.
+
+    :param points: A Nx3 array
+    :param rows: A sorted array of indices into points. If None, use all points.
+    :param counts: The histogram to add to. If None, start with an empty histogram.
+    :param sign: 1 to add the pairs to the histogram, -1 to subtract them.
+    :param max_memory: The approximate memory in bytes per tile. Defaults to MAX_MEMORY
+    :returns: The histogram (an integer array of counts per bin).
+    """
+    if counts is None:
+        counts = np.zeros(0, dtype=int)
+    if max_memory is None:
+        max_memory = MAX_MEMORY
+    if rows is None:
+        rows = np.arange(len(points))
+    rows = np.asarray(rows, dtype=int)
+    in_rows = np.zeros(len(points), dtype=bool)
+    in_rows[rows] = True
+    tile = max(1, int(math.sqrt(max_memory/_BYTES_PER_PAIR)))
+    for r0 in range(0, len(rows), tile):
+        row_ids = rows[r0:r0+tile]
+        for c0 in range(0, len(points), tile):
+            c1 = min(c0+tile, len(points))
+            # All pairs of this tile were counted for a previous row
+            if c1-1 <= row_ids[0] and np.all(in_rows[c0:c1]):
+                continue
+            col_ids = np.arange(c0, c1)
+            # Pairs of two points in rows are only counted for the first point.
+            mask = ~in_rows[col_ids] | (col_ids > row_ids[:,np.newaxis])
+            diffs = points[row_ids][:,np.newaxis,:] - points[np.newaxis,c0:c1,:]
+            lengths = np.sqrt(np.sum(diffs*diffs, axis=2))[mask]
+            counts = _add_counts(counts, (lengths // stepsize).astype(int), sign)
+    return counts
+
+def pair_distance_distribution(points, stepsize, max_memory=None):
+    """
+    Like ftuv.pair_distance_distribution, but with bounded memory.
+    """
+    return pdd_from_counts(count_pairs(np.asarray(points, dtype=float).reshape(-1,3), stepsize,
+                                       max_memory=max_memory), stepsize)
+
+def pdd_from_counts(counts, stepsize):
+    """
+    Convert a histogram to the format returned by ftuv.pair_distance_distribution.
+
+    :returns: A tuple distances, counts without trailing empty bins.
+    """
+    nonzero = np.flatnonzero(counts)
+    length = nonzero[-1]+1 if len(nonzero) else 1
+    return np.arange(length)*stepsize, np.array(counts[:length])
+
+
+class IncrementalPDD(object):
+    """
+    A pair distance histogram, which is updated by only re-counting
+    the pairs that involve points which changed since the last call.
+    """
+    #: If more than this fraction of the points moved,
+    #: the histogram is recalculated from scratch.
+    max_changed_fraction = 0.5
+
+    def __init__(self, stepsize, max_memory=None):
+        """
+        :param max_memory: See count_pairs
+        """
+        self.stepsize = stepsize
+        self.max_memory = max_memory
+        self._points = None
+        self._counts = np.zeros(0, dtype=int)
+
+    def update(self, points):
+        """
+        :param points: A Nx3 array. The order of the points must be the same in every call.
+        :returns: The pair distance distribution of the points, like
+                  ftuv.pair_distance_distribution(points, stepsize)
+        """
+        points = np.array(points, dtype=float)
+        if self._points is None or self._points.shape != points.shape:
+            changed = np.arange(len(points))
+        else:
+            changed = np.flatnonzero(np.any(points != self._points, axis=1))
+        if len(changed) > self.max_changed_fraction*len(points):
+            self._counts = count_pairs(points, self.stepsize, max_memory=self.max_memory)
+        elif len(changed):
+            log.debug("Updating PDD for %d of %d points", len(changed), len(points))
+            self._counts = count_pairs(self._points, self.stepsize, changed, self._counts, -1,
+                                       max_memory=self.max_memory)
+            self._counts = count_pairs(points, self.stepsize, changed, self._counts, 1,
+                                       max_memory=self.max_memory)
+        self._points = points
+        return pdd_from_counts(self._counts, self.stepsize)
+
+
+class RunningWindow(object):
+    """
+    The last `size` histograms of equal length in a circular buffer,
+    together with their running sum.
+    """
+    def __init__(self, size, length):
+        self.size = size
+        self._buffer = np.zeros((size, length))
+        #: The row of the buffer that is overwritten next
+        self._next = 0
+        self._len = 0
+        self._sum = np.zeros(length)
+
+    def __len__(self):
+        return self._len
+
+    def append(self, histogram):
+        self._sum -= self._buffer[self._next]
+        self._buffer[self._next] = histogram
+        self._sum += self._buffer[self._next]
+        self._next = (self._next + 1) % self.size
+        self._len = min(self._len + 1, self.size)
+        if self._next == 0:
+            # Avoid the accumulation of rounding errors
+            self._sum = np.sum(self._buffer, axis=0)
+
+    def sum(self, last=None):
+        """
+        The sum of the last `last` histograms, or of all histograms in the window.
+        """
+        if last is None or last >= self._len:
+            return np.array(self._sum)
+        oldest = (self._next - self._len + np.arange(self._len - max(last, 0))) % self.size
+        return self._sum - np.sum(self._buffer[oldest], axis=0)
@@ -40,6 +40,9 @@ class MCMCSampler:
         log.info("Junction energy is %s", {k:v.shortname for k,v in sm.junction_constraint_energy.items()})
         #: Store the previouse constituing energies (for StatisticsCollector)
         self.prev_constituing = self.energy_function.constituing_energies
+        #: The state of the energy function for the last accepted structure.
+        #: Used to restore prev_energy after a rejected step without re-evaluation.
+        self._accepted_state = self.energy_function.snapshot()
 
         self.energy_function.accept_last_measure()
 
@@ -65,6 +68,8 @@ class MCMCSampler:
             if self.sm.constraint_energy is None:
                 self.last_clashes="no_energy"
             else:
+                # fulfills may stop at the first clash. Count all of them for the report.
+                self.sm.constraint_energy.eval_energy(self.sm.bg)
                 self.last_clashes=self.sm.constraint_energy.bad_bulges
             if self.sm.junction_constraint_energy is None:
                 self.last_bad_mls="no_energy"
@@ -81,7 +86,7 @@ class MCMCSampler:
         self.step_counter += 1
         if self.rerun_prev_energy:
             # The energy of staying may get worse with every reject step
-            self.prev_energy = self.energy_function.eval_energy(self.sm.bg , sampled_stats=self.sm.elem_defs)
+            self.prev_energy = self._restore_prev_energy()
         #Make a sinle move (i.e. change the Spatial Model)
         movestring = self.mover.move(self.sm)
         # Accept or reject the new spatial model based on the energy.
@@ -134,7 +139,15 @@ class MCMCSampler:
         # accept the new statistic
         self.prev_energy = energy
         self.prev_constituing =  self.energy_function.constituing_energies
+        if math.isinf(energy):
+            # The energy function was not evaluated for this structure.
+            self._accepted_state = None
+        else:
+            self._accepted_state = self.energy_function.snapshot()
         self.energy_function.accept_last_measure()
+        if self.sm.constraint_energy is not None:
+            # Lets stateful constraint energies (e.g. ICLASH) keep the accepted state
+            self.sm.constraint_energy.accept_last_measure()
         for e in self.energy_function.iterate_energies():
             if hasattr(e, "accepted_projDir"):
                 self.sm.bg.project_from=e.accepted_projDir
@@ -145,6 +158,8 @@ class MCMCSampler:
 
     def reject(self):
         self.energy_function.reject_last_measure()
+        if self.sm.constraint_energy is not None:
+            self.sm.constraint_energy.reject_last_measure()
         try:
             self.mover.revert(self.sm)
         except RuntimeError as e:
@@ -152,5 +167,22 @@ class MCMCSampler:
             #This warning will be ignored in ReplicaExchangeSimulations
             warnings.warn(e.message, NoopRevertWarning)
         # We need to recaluculate the prev_energy, because Energy might have been recalibrated.
-        log.debug("MCMCSampler After rejecting: reject calling eval_energy again")
-        self.prev_energy = self.energy_function.eval_energy(self.sm.bg, sampled_stats=self.sm.elem_defs)
+        # Only energies with changed distributions are re-evaluated.
+        self.prev_energy = self._restore_prev_energy()
+
+    def _restore_prev_energy(self):
+        """
+        The energy of the last accepted structure (which has to be self.sm).
+
+        Restores the state of the energy function when this structure was accepted.
+        Only energies whose distributions changed since then are re-evaluated.
+        """
+        if self._accepted_state is None:
+            log.debug("MCMCSampler calling eval_energy for the last accepted structure")
+            energy = self.energy_function.eval_energy(self.sm.bg, sampled_stats=self.sm.elem_defs)
+        else:
+            energy = self.energy_function.restore_energy(self._accepted_state, self.sm.bg,
+                                                         sampled_stats=self.sm.elem_defs)
+        self.prev_constituing = self.energy_function.constituing_energies
+        self._accepted_state = self.energy_function.snapshot()
+        return energy
@@ -20,6 +20,8 @@ import forgi.threedee.model.stats as ftmstats
 from fess import data_file
 from fess.builder import config
 import fess.motif.annotate as fma
+import fess.builder.angle_geometry as fbag
+import fess.builder.compiled_stats as fbcs
 
 log = logging.getLogger(__name__)
 try:
@@ -41,57 +43,111 @@ def patch_angtype(ang_type):
         return -math.copysign(6, ang_type)
     return ang_type
 
-def parse_stats_file(file_handle):
-    stats = {"stem": defaultdict(list),
-             "angle": defaultdict(list),
-             "loop": defaultdict(list), "3prime": defaultdict(list), "5prime": defaultdict(list)}
+def parse_stat_line(line):
+    """
+    Parse one line of a stats file.
+
+    :param line: A line without comments and surrounding whitespace.
+    :returns: A tuple (stat_type, key, stat) or None, if the stat should be ignored.
+    """
+    if line.startswith("stem"):
+        stem_stat = ftmstats.StemStat(line)
+        return "stem", stem_stat.bp_length, stem_stat
+    elif line.startswith("angle") or line.startswith("open") or line.startswith("pseudo"):
+        angle_stat = ftmstats.AngleStat()
+        try:
+            angle_stat.parse_line(line)
+        except Exception as e:
+            with log_to_exception(log, e):
+                log.error("Could not parse file due to error parsing line '{}'".format(line))
+            raise
+        if len(angle_stat.define) > 0 and angle_stat.define[0] == 1: #An angle at the beginning of a structure
+            #I guess this should never happen, if the stats do not stem from faulty bulge graphs.
+            log.error("Ignoring angle stat {} because it is at the beginning of a structure."
+                      " Does the stat come from a faulty BulgeGraph?".format(angle_stat.pdb_name))
+            return None
+        angle_stat.ang_type = patch_angtype(angle_stat.ang_type)
+        log.debug("Reading angle_stat with dimensions %s and %s, and type %s. With define %s", angle_stat.dim1, angle_stat.dim2, angle_stat.ang_type, angle_stat.define)
+        # Adding the reverse (-ang_type) does not work as intended and produces a lot of structures
+        # that do not fulfill the constraint energy.
+        # Note that CoarseGrainRNA.get_stats extracts two angle stats per angle.
+        return "angle", (angle_stat.dim1, angle_stat.dim2, angle_stat.ang_type), angle_stat
+    else:
+        key = line.split()[0]
+        if key not in ["3prime", "5prime", "loop"]:
+            raise ValueError("Illegal line in stats file: '{}'".format(line))
+        stat = ftmstats.LoopStat(line)
+        return key, stat.bp_length, stat
+
+def _iter_stat_records(file_handle):
+    """
+    Yield tuples (stat_type, key, line, stat) for all stats in the file.
+    """
     for line in file_handle:
         line=line.strip()
         if "#" in line:
             line = line.split('#')[0]
         if not line:
             continue
-        if line.startswith("stem"):
-            stem_stat = ftmstats.StemStat(line)
-            stats["stem"][stem_stat.bp_length].append(stem_stat)
-        elif line.startswith("angle") or line.startswith("open") or line.startswith("pseudo"):
-            angle_stat = ftmstats.AngleStat()
-            try:
-                angle_stat.parse_line(line)
-            except Exception as e:
-                with log_to_exception(log, e):
-                    log.error("Could not parse file due to error parsing line '{}'".format(line))
-                raise
-            if len(angle_stat.define) > 0 and angle_stat.define[0] == 1: #An angle at the beginning of a structure
-                #I guess this should never happen, if the stats do not stem from faulty bulge graphs.
-                log.error("Ignoring angle stat {} because it is at the beginning of a structure."
-                          " Does the stat come from a faulty BulgeGraph?".format(angle_stat.pdb_name))
-                continue
-            angle_stat.ang_type = patch_angtype(angle_stat.ang_type)
-            log.debug("Reading angle_stat with dimensions %s and %s, and type %s. With define %s", angle_stat.dim1, angle_stat.dim2, angle_stat.ang_type, angle_stat.define)
-            stats["angle"][(angle_stat.dim1, angle_stat.dim2, angle_stat.ang_type)].append(angle_stat)
-            # Adding the reverse does not work as intended and produces a lot of structures
-            # that do not fulfill the constraint energy.
-            # stats["angle"][(angle_stat.dim1, angle_stat.dim2, -angle_stat.ang_type)].append(angle_stat)
-            # Note that CoarseGrainRNA.get_stats extracts two angle stats per angle.
-        else:
-            key = line.split()[0]
-            if key not in ["3prime", "5prime", "loop"]:
-                raise ValueError("Illegal line in stats file: '{}'".format(line))
-            stat = ftmstats.LoopStat(line)
-            stats[key][stat.bp_length].append(stat)
+        parsed = parse_stat_line(line)
+        if parsed is not None:
+            stat_type, key, stat = parsed
+            yield stat_type, key, line, stat
+
+def _stats_from_records(records):
+    stats = {"stem": defaultdict(list),
+             "angle": defaultdict(list),
+             "loop": defaultdict(list), "3prime": defaultdict(list), "5prime": defaultdict(list)}
+    for stat_type, key, line, stat in records:
+        stats[stat_type][key].append(stat)
     return stats
 
-def read_stats_file(filename):
+def parse_stats_file(file_handle):
+    return _stats_from_records(_iter_stat_records(file_handle))
+
+def _read_stat_records(filename):
     log.info("Reading stats-file %s", filename)
     with open (filename) as f:
         try:
-            return parse_stats_file(f)
+            return list(_iter_stat_records(f))
         except Exception as e:
             with log_to_exception(log, e):
                 log.error("Failed to parse file %s", filename)
             raise
 
+def read_stats_file(filename, compiled=True):
+    """
+    Read a stats file.
+
+    :param compiled: If True, use the compiled binary version of the file
+                     (see fess.builder.compiled_stats). It is created on first
+                     use next to the stats file or, if that directory is not
+                     writable, in the user's cache directory.
+                     The stats are only parsed, when they are accessed.
+                     If the compiled version cannot be written at all,
+                     fall back to parsing the whole file.
+    :returns: A dictionary stat_type -> key -> list of stats
+    """
+    if not compiled:
+        return _stats_from_records(_read_stat_records(filename))
+    dirnames = fbcs.cache_dirnames(filename)
+    for dirname in dirnames:
+        if op.isdir(dirname):
+            log.info("Loading compiled stats from %s", dirname)
+            return fbcs.CompiledStats(dirname, parse_stat_line)
+    records = _read_stat_records(filename)
+    for dirname in dirnames:
+        log.info("Compiling stats-file %s to %s", filename, dirname)
+        try:
+            fbcs.compile_stats(records, dirname)
+        except (IOError, OSError) as e:
+            log.info("Could not store compiled stats at %s: %s", dirname, e)
+        else:
+            return fbcs.CompiledStats(dirname, parse_stat_line)
+    log.warning("Could not store compiled stats for %s. Every process "
+                "will parse the whole stats file.", filename)
+    return _stats_from_records(records)
+
 letter_to_stat_type = {
     "s": "stem",
     "h": "loop",
@@ -198,6 +254,20 @@ class StatStorage(object):
                   bg.get_node_dimensions(elem, with_missing=True))
         return key
 
+    def load_all(self):
+        """
+        Read the stats file and all fallback files now, instead of on first use.
+
+        Call this before starting worker processes. With compiled stats
+        (see read_stats_file) all processes then share the memory-mapped
+        files instead of every process reading the fallback files on its own.
+        Pickling the StatStorage only stores the locations of compiled stats.
+        """
+        if self._sources is None:
+            self._sources = [read_stats_file(self.filename)]
+        for fallback in self.fallbacks[len(self._sources)-1:]:
+            self._sources.append(read_stats_file(fallback))
+
     def _iter_stat_sources(self):
         if self._sources is None:
             self._sources = [read_stats_file(self.filename)]
@@ -369,6 +439,43 @@ class StatStorage(object):
             for stat in self.iterate_stats(letter_to_stat_type[elem[0]], key, min_entries):
                 yield stat
 
+    @lru_cache(maxsize = 128)
+    def _angle_geometry(self, key, min_entries=100):
+        weights, stats = self._possible_stats("angle", key, min_entries)
+        return np.array(weights), fbag.AngleStatGeometry(stats)
+
+    def angle_geometry_for(self, bg, elem, min_entries = 100):
+        """
+        The same stats as iterate_stats_for would yield for the interior loop
+        or multiloop segment elem, as a fess.builder.angle_geometry.AngleStatGeometry.
+
+        The geometry of all stats for a key is calculated only once.
+        """
+        if elem in self.continuouse:
+            raise ValueError("No fixed set of stats for continuouse element {}".format(elem))
+        key = self.key_from_bg_and_elem(bg, elem)
+        weights, geometry = self._angle_geometry(key, min_entries)
+        # Subsample fallback stats exactly like iterate_stats
+        mask = np.array([random.random()<=w for w in weights], dtype=bool)
+        if np.all(mask):
+            return geometry
+        return geometry.subset(mask)
+
+    def distance_range_for(self, bg, elem, min_entries = 100):
+        """
+        The smallest and largest distance (r1) between the two stems,
+        that any stat angle_geometry_for could return for elem places them at.
+
+        :returns: A tuple (min, max)
+        """
+        if elem in self.continuouse:
+            raise ValueError("No fixed set of stats for continuouse element {}".format(elem))
+        key = self.key_from_bg_and_elem(bg, elem)
+        _, geometry = self._angle_geometry(key, min_entries)
+        if len(geometry)==0:
+            return float("inf"), -float("inf")
+        return float(np.min(geometry.distances)), float(np.max(geometry.distances))
+
 
 
     def coverage_for(self, sampled_stat_names, bg, elem, min_entries = 100):
@@ -118,6 +118,9 @@ def main():
 def run(args, cg, main_dir, reference_cg):
     setup_rng(args)
     stat_source = fbstat.from_args(args, cg) #Uses sampling_output_dir
+    if args.parallel:
+        # Let all processes share the memory-mapped stats.
+        stat_source.load_all()
 
     # If we perform normal sampling with parallel=True,
     # we start sampling while we are building.
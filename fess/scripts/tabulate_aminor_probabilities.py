@@ -0,0 +1,34 @@
+#!python
+"""
+Tabulate the A-Minor interaction probabilities of forgi's default classifiers
+on a 3D grid and store them in fess/stats, where ernwin --aminor-grid finds them.
+"""
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install future
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip) #future package
+
+import argparse
+import os
+import logging
+
+import fess.builder.aminor as fba
+
+log = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(description=__doc__)
+parser.add_argument('--loop-types', default="".join(fba.IncrementalAMinor.LOOP_TYPES),
+                    help="The loop types to tabulate, e.g. 'ih'")
+parser.add_argument('--force', action="store_true",
+                    help="Recreate the grid, even if a grid for the current "
+                         "trainings data exists.")
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    for loop_type in args.loop_types:
+        filename = fba.default_grid_filename(loop_type)
+        if args.force and os.path.isfile(filename):
+            os.remove(filename)
+        fba.get_default_grid(loop_type)
+        print("Grid for loop type {} stored at {}".format(loop_type, filename))
@@ -0,0 +1,106 @@
+#!/usr/bin/python
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install future
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+__metaclass__=type
+
+import unittest
+import math
+import os.path
+import shutil
+import tempfile
+
+import numpy as np
+import numpy.testing as nptest
+
+import forgi.threedee.model.coarse_grain as ftmc
+import forgi.threedee.classification.aminor as ftca
+
+import fess.builder.aminor as fba
+
+
+class TestIncrementalAMinor(unittest.TestCase):
+    def setUp(self):
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+        self.aminor = fba.IncrementalAMinor()
+
+    def assert_same_interactions(self):
+        expected = sorted(tuple(pair) for pair in ftca.all_interactions(self.cg))
+        self.assertEqual(sorted(self.aminor.all_interactions(self.cg)), expected)
+
+    def test_same_as_forgi(self):
+        self.assert_same_interactions()
+        # Move a loop and a stem
+        for elem in ["h0", "s4"]:
+            self.cg.coords[elem] = self.cg.coords[elem][0]+[10., 0, 0], self.cg.coords[elem][1]+[10., 0, 0]
+            self.assert_same_interactions()
+
+    def test_only_moved_pairs_are_reclassified(self):
+        self.aminor.all_interactions(self.cg)
+        probs = dict(self.aminor._probs)
+        self.cg.coords["s4"] = self.cg.coords["s4"][0]+[3., 0, 0], self.cg.coords["s4"][1]+[3., 0, 0]
+        self.aminor.all_interactions(self.cg)
+        for (loop, stem), p in self.aminor._probs.items():
+            if stem != "s4" and p is not None:
+                self.assertIs(p, probs[(loop, stem)])
+
+
+class TestVectorizedProbabilities(unittest.TestCase):
+    def setUp(self):
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+
+    def test_relative_orientations_same_as_forgi(self):
+        for loop in ["h0", "i1", "i4"]:
+            stems = [s for s in self.cg.stem_iterator() if s not in self.cg.edges[loop]]
+            expected = [ ftca.get_relative_orientation(self.cg, loop, s) for s in stems ]
+            nptest.assert_allclose(fba.relative_orientations(self.cg, loop, stems), expected,
+                                   atol=1e-10)
+
+    def test_iter_probs(self):
+        prob_fun = lambda points: np.exp(-points[0]/10)
+        probs = list(fba.iter_probs("h0", self.cg, prob_fun, 30))
+        self.assertEqual(probs[-1], 0)
+        expected = [ math.exp(-ftca.get_relative_orientation(self.cg, "h0", s)[0]/10)
+                     for s in self.cg.stem_iterator()
+                     if s not in self.cg.edges["h0"] and
+                        ftca.get_relative_orientation(self.cg, "h0", s)[0] < 30 ]
+        nptest.assert_allclose(probs[:-1], expected)
+
+    def test_total_prob(self):
+        self.assertAlmostEqual(fba.total_prob([0.5, 0.5, 0]), 0.75)
+        self.assertAlmostEqual(fba.total_prob(iter([0.1, 0.2])), 0.1+0.9*0.2)
+        self.assertEqual(fba.total_prob([0]), 0)
+
+
+class TestProbabilityGrid(unittest.TestCase):
+    def setUp(self):
+        X, y = ftca.get_trainings_data("h")
+        X, y = np.concatenate([X[y==1][:100], X[y==0][:200]]), np.concatenate([y[y==1][:100], y[y==0][:200]])
+        self.clf = ftca.AMinorClassifier(kernel="gaussian", bandwidth=0.3)
+        self.clf.fit(X, y)
+        self.grid = fba.ProbabilityGrid.from_classifier(self.clf, "test")
+
+    def test_close_to_classifier(self):
+        X = np.random.RandomState(1).rand(200, 3)*[3, math.pi/2, 2*math.pi] - [0, 0, math.pi]
+        # The interpolation error is up to 0.04 (see ProbabilityGrid.step_per_bandwidth)
+        nptest.assert_allclose(self.grid.predict_proba(X), self.clf.predict_proba(X), atol=0.05)
+
+    def test_exact_at_grid_points(self):
+        X = self.grid.lower + self.grid.step*np.array([[0, 0, 0], [3, 2, 5], [7, 4, 20]])
+        nptest.assert_allclose(self.grid.predict_proba(X), self.clf.predict_proba(X))
+
+    def test_undefined_angles(self):
+        probs = self.grid.predict_proba([[0., float("nan"), float("nan")], [1., 1., 1.]])
+        self.assertEqual(probs[0], 0)
+        self.assertGreater(probs[1], 0)
+
+    def test_save_and_load(self):
+        tmpdir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, tmpdir)
+        fn = os.path.join(tmpdir, 'aminor_grid.npz')
+        self.grid.save(fn)
+        grid = fba.ProbabilityGrid.load(fn)
+        self.assertEqual(grid.source_hash, "test")
+        nptest.assert_allclose(grid.probs, self.grid.probs, atol=1e-6)
+        nptest.assert_array_equal(grid.step, self.grid.step)
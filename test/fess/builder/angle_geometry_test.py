@@ -0,0 +1,98 @@
+#!/usr/bin/python
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install future
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+__metaclass__=type
+
+import unittest
+
+import numpy as np
+import numpy.testing as nptest
+
+import forgi.threedee.model.coarse_grain as ftmc
+import forgi.threedee.model.stats as ftmstats
+import forgi.threedee.utilities.graph_pdb as ftug
+from forgi.threedee.utilities import cytvec
+
+import fess.builder.angle_geometry as fbag
+
+
+class TestBrokenMlDeviations(unittest.TestCase):
+    def setUp(self):
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/4GXY_A.cg')
+        # u, v, t, r1, u1, v1 of the stats in statsFor4way.stats
+        params = [(1.46221586114, 1.07019141946, 1.81979125628, 14.1930471393, 2.32790213289, 0.117799810062),
+                  (0.529510515241, -0.334410438913, 2.07715939278, 14.1930471393, 0.717476947987, 1.01937202652),
+                  (1.27682491652, 0.145921690726, 1.12813639059, 6.09170868129, 1.47998317492, 0.738803103919),
+                  (1.56220270905, 0.32714420923, 1.14835981787, 6.09170868129, 2.17504840009, -0.12247558003),
+                  (0.723814980473, 1.57365413187, 1.52664711174, 18.1725111029, 2.09017131993, 0.383401322009),
+                  (0.0420504890299, 1.61583197578, 0.801987481027, 18.1725111028, 0.676017869646, 1.82667462295)]
+        self.stats = [ ftmstats.AngleStat(stat_type="angle", pdb_name="test:m_{}".format(i),
+                                          dim1=0, dim2=1000, u=u, v=v, t=t, r1=r1, u1=u1, v1=v1,
+                                          ang_type=6, define=[], seq="", vres={})
+                       for i, (u, v, t, r1, u1, v1) in enumerate(params) ]
+
+    def test_geometry_in_stem_frame(self):
+        geometry = fbag.AngleStatGeometry(self.stats)
+        self.assertEqual(len(geometry), len(self.stats))
+        for i, stat in enumerate(self.stats):
+            pos, orient, twist = ftug._virtual_stem_from_bulge(np.eye(3), stat)
+            nptest.assert_allclose(geometry.positions[i], pos)
+            nptest.assert_allclose(geometry.orientations[i], orient)
+            nptest.assert_allclose(geometry.twists[i], twist)
+
+    def test_same_as_cytvec(self):
+        geometry = fbag.AngleStatGeometry(self.stats)
+        for stem in self.cg.edges["m2"]:
+            pdev, adev, tdev = fbag.broken_ml_deviations(self.cg, "m2", stem, geometry)
+            for i, stat in enumerate(self.stats):
+                expected = cytvec.get_broken_ml_deviation(self.cg, "m2", stem, stat)
+                nptest.assert_allclose([pdev[i], adev[i], tdev[i]], expected, atol=1e-9)
+
+    def test_subset(self):
+        geometry = fbag.AngleStatGeometry(self.stats)
+        sub = geometry.subset(np.array([False, True, True, False, False, True]))
+        self.assertEqual(sub.stats, [self.stats[1], self.stats[2], self.stats[5]])
+        nptest.assert_array_equal(sub.twists, geometry.twists[[1, 2, 5]])
+
+    def test_within_same_as_brute_force(self):
+        geometry = fbag.AngleStatGeometry(self.stats)
+        for position in geometry.positions:
+            for max_distance in [0.1, 5, 10, 20]:
+                expected = np.where(np.linalg.norm(geometry.positions-position, axis=1)<=max_distance)[0]
+                nptest.assert_array_equal(geometry.within(position, max_distance), expected)
+
+    def test_within_subset(self):
+        geometry = fbag.AngleStatGeometry(self.stats)
+        sub = geometry.subset(np.array([False, True, True, False, False, True]))
+        for position in geometry.positions:
+            expected = np.where(np.linalg.norm(sub.positions-position, axis=1)<=10)[0]
+            nptest.assert_array_equal(sub.within(position, 10), expected)
+        self.assertIs(sub.subset([0, 2])._parent, geometry)
+
+    def test_nearest(self):
+        geometry = fbag.AngleStatGeometry(self.stats)
+        sub = geometry.subset([0, 4, 5])
+        for i, position in enumerate(geometry.positions):
+            self.assertEqual(geometry.nearest(position+0.01), i)
+        self.assertEqual(sub.nearest(geometry.positions[5]), 2)
+
+    def test_query(self):
+        geometry = fbag.AngleStatGeometry(self.stats)
+        s1, s2 = sorted(self.cg.edges["m2"], key=self.cg.buildorder_of)
+        position, direction, twist = fbag.broken_ml_target(self.cg, "m2", s1)
+        pdev, adev, tdev = fbag.broken_ml_deviations(self.cg, "m2", s1, geometry)
+        for max_dist, max_angle in [(10, 2), (20, 2.8), (30, 2.8), (40, 1.6), (5, 3)]:
+            expected, = np.where((pdev<=max_dist)&(adev<=max_angle)&(tdev<=max_angle))
+            nptest.assert_array_equal(geometry.query(position, direction, twist,
+                                                     max_dist, max_angle), expected)
+
+    def test_junction_build_order(self):
+        order = fbag.junction_build_order(self.cg, "m2")
+        self.assertEqual(sorted(ml for _, ml, _ in order),
+                         sorted(set(self.cg.shortest_mlonly_multiloop("m2"))-set(["m2"])))
+        for triple in order:
+            self.assertIn(triple, self.cg.traverse_graph())
+        # This loop contains more than one broken segment
+        self.assertIsNone(fbag.junction_build_order(self.cg, "m4"))
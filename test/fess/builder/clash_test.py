@@ -0,0 +1,57 @@
+#!/usr/bin/python
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install future
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+__metaclass__=type
+
+import unittest
+
+import numpy as np
+
+import forgi.threedee.model.coarse_grain as ftmc
+
+import fess.builder.clash as fbc
+
+
+class TestCellList(unittest.TestCase):
+    def setUp(self):
+        self.cells = fbc.CellList(2.)
+        self.cells.update([0, 1, 2], [[0., 0., 0.], [1.5, 0., 0.], [5., 5., 5.]])
+
+    def test_neighbors(self):
+        self.assertEqual(self.cells.neighbors(0, 2.), [1])
+        self.assertEqual(self.cells.neighbors(2, 2.), [])
+        self.assertEqual(self.cells.neighbors(0, 1.), [])
+
+    def test_move_points(self):
+        self.cells.update([2], [[-1., 1., 0.]])
+        self.assertEqual(sorted(self.cells.neighbors(0, 2.)), [1, 2])
+        self.cells.update([1], [[10., 0., 0.]])
+        self.assertEqual(self.cells.neighbors(0, 2.), [2])
+        self.assertEqual(self.cells.neighbors(1, 2.), [])
+
+    def test_remove(self):
+        self.cells.remove([1])
+        self.assertNotIn(1, self.cells)
+        self.assertEqual(len(self.cells), 2)
+        self.assertEqual(self.cells.neighbors(0, 2.), [])
+
+    def test_radius_larger_than_cells(self):
+        with self.assertRaises(ValueError):
+            self.cells.neighbors(0, 3.)
+
+
+class TestCellListVirtualAtomArray(unittest.TestCase):
+    def setUp(self):
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A-clash.coord')
+        self.cg.add_all_virtual_residues()
+        self.stems = list(self.cg.stem_iterator())
+
+    def test_same_cg_with_different_diameters(self):
+        atom_array = fbc.CellListVirtualAtomArray(self.cg, 1.8)
+        reference = fbc.VirtualAtomArray(self.cg)
+        for diameter in [1.8, 4., 1.8]:
+            expected = reference.clashes(self.cg, self.stems, diameter)[0]
+            self.assertGreater(expected, 0)
+            self.assertEqual(atom_array.clashes(self.cg, self.stems, diameter)[0], expected)
@@ -0,0 +1,76 @@
+#!/usr/bin/python
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install future
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+__metaclass__=type
+
+import unittest
+
+import numpy as np
+import numpy.testing as nptest
+
+import forgi.threedee.model.coarse_grain as ftmc
+import forgi.projection.projection2d as fpp
+import forgi.projection.hausdorff as fph
+
+import fess.builder.fpp as fbfpp
+
+
+class TestCombinedDistance(unittest.TestCase):
+    def test_same_as_forgi(self):
+        ref_img = np.random.rand(30, 30)<0.1
+        distance = fbfpp.CombinedDistance(ref_img)
+        for _ in range(10):
+            img = np.random.rand(30, 30)<0.1
+            self.assertEqual(distance(img), fph.combined_distance(img, ref_img))
+        self.assertEqual(distance(ref_img), 1)
+
+    def test_no_overlap(self):
+        ref_img = np.zeros((10, 10))
+        ref_img[2,3] = 1
+        img = np.zeros((10, 10))
+        img[4,3] = 1
+        distance = fbfpp.CombinedDistance(ref_img)
+        self.assertEqual(distance(img), float("inf"))
+        self.assertEqual(distance.hausdorff_distance(img), 2)
+
+
+class TestCachedProjection(unittest.TestCase):
+    def setUp(self):
+        self.cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A-structure1.coord')
+        self.cg.project_from = np.array([1., 0.45, 0.25])
+        ref_cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A-structure2.coord')
+        proj = fpp.Projection2D(ref_cg, [1., 0.5, 0.2], project_virtual_atoms="selected")
+        self.ref_img, _ = proj.rasterize(40, fph.get_box(proj, 120), warn=False)
+
+    def test_same_image_as_forgi(self):
+        points = fbfpp.ProjectionPoints(self.cg)
+        expected = fpp.Projection2D(self.cg, project_virtual_atoms="selected",
+                                    project_virtual_residues=[1, 21])
+        actual = fbfpp.CachedProjection2D(points, self.cg.project_from,
+                                          project_virtual_residues=[1, 21])
+        nptest.assert_allclose(actual.get_vres_by_position(21), expected.get_vres_by_position(21))
+        box = fph.get_box(expected, 120)
+        nptest.assert_array_equal(actual.rasterize(40, box, warn=False, rotate=20)[0],
+                                  expected.rasterize(40, box, warn=False, rotate=20)[0])
+
+    def test_key_changes_with_structure(self):
+        key = fbfpp.ProjectionPoints.key_for(self.cg)
+        self.assertEqual(fbfpp.ProjectionPoints(self.cg).key, key)
+        self.cg.coords["s0"] = self.cg.coords["s0"][0]+1, self.cg.coords["s0"][1]
+        self.assertNotEqual(fbfpp.ProjectionPoints.key_for(self.cg), key)
+
+    def test_locally_minimal_distance_same_as_forgi(self):
+        expected = fph.locally_minimal_distance(self.ref_img, 120, self.cg, 10, np.array([2, 1]),
+                                                None, distance=fph.combined_distance,
+                                                maxiter=50, virtual_atoms="selected")
+        actual = fbfpp.locally_minimal_distance(fbfpp.CombinedDistance(self.ref_img), 120,
+                                                fbfpp.ProjectionPoints(self.cg), 10,
+                                                np.array([2, 1]),
+                                                fph.to_polar(self.cg.project_from)[1:], maxiter=50)
+        self.assertEqual(actual[0], expected[0])
+        nptest.assert_array_equal(actual[1], expected[1])
+        nptest.assert_allclose(actual[2][0], expected[2][0])
+        self.assertEqual(actual[2][1], expected[2][1])
+        nptest.assert_array_equal(actual[2][2], expected[2][2])
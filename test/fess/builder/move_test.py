@@ -8,6 +8,7 @@ __metaclass__=type
 import unittest
 from collections import Counter
 import copy
+import random
 import logging
 import numpy as np
 import numpy.testing as nptest
@@ -140,6 +141,57 @@ class TestMoverBaseClassPublicAPI(unittest.TestCase):
             self.mover.revert(self.sm)
             self.assertEqual(self.sm.bg.coords, coords_old)
 
+class _FakeJunctionEnergy(object):
+    """
+    A junction energy for the junction m0, m1, m2 (broken),
+    which is fulfilled by a fixed set of stat combinations.
+    """
+    def __init__(self, sm, valid, query):
+        self.sm = sm
+        self.valid = valid
+        self.energies = [self] if query else []
+    def _closing(self):
+        return [ c for a, b, c in self.valid
+                 if (a, b)==(self.sm.elem_defs["m0"], self.sm.elem_defs["m1"]) ]
+    def closing_stats(self, cg, elem_defs=None):
+        return self._closing()
+    def eval_energy(self, cg, nodes=None, sampled_stats=None):
+        return 0 if sampled_stats["m2"] in self._closing() else 1
+
+class TestEnergeticJunctionMoverClosingStats(unittest.TestCase):
+    def setUp(self):
+        random.seed(1)
+        stats = { "m0": ["a0", "a1"], "m1": ["b0", "b1"], "m2": ["c0", "c1", "c2", "c3"] }
+        self.stat_source = mock.Mock()
+        self.stat_source.iterate_stats_for.side_effect = lambda cg, elem: stats[elem]
+        self.sm = mock.Mock()
+        self.sm.bg.shortest_mlonly_multiloop.return_value = ("m0", "m1", "m2")
+        self.sm.bg.traverse_graph.return_value = [("s0", "m0", "s1"), ("s1", "m1", "s2"), ("s2", "m2", "s0")]
+        self.sm.new_traverse_and_build.return_value = []
+        self.sm.elem_defs = {}
+        # (a1, b1) is closed by 1 stat, (a0, b0) by 3 stats.
+        self.valid = [("a0", "b0", "c0"), ("a0", "b0", "c1"), ("a0", "b0", "c2"), ("a1", "b1", "c3")]
+
+    def sample(self, query):
+        self.sm.junction_constraint_energy = {"m2": _FakeJunctionEnergy(self.sm, self.valid, query)}
+        mover = fbmov.EnergeticJunctionMover(-1, self.stat_source)
+        counts = Counter()
+        for i in range(2000):
+            stats = mover._find_stats_for(["m0", "m1", "m2"], self.sm)
+            counts[(stats["m0"], stats["m1"], stats["m2"])]+=1
+        return counts
+
+    def test_closing_stats_are_found_as_often_as_without_query(self):
+        with_query = self.sample(True)
+        without_query = self.sample(False)
+        self.assertEqual(set(with_query), set(self.valid))
+        self.assertEqual(set(without_query), set(self.valid))
+        # Every valid combination is equally likely.
+        # Picking among the closing stats of (a1, b1) would give c3 half of the moves.
+        for counts in [with_query, without_query]:
+            _, p = chisquare([counts[v] for v in self.valid])
+            self.assertGreater(p, 0.001)
+
 class TestConvenienceFunctions(unittest.TestCase):
     def setUp(self):
         self.stat_source = StatStorage("test/fess/data/test1.stats")
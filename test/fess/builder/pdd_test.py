@@ -0,0 +1,101 @@
+#!/usr/bin/python
+from __future__ import absolute_import, division, print_function, unicode_literals
+from builtins import (ascii, bytes, chr, dict, filter, hex, input, #pip install future
+                      int, map, next, oct, open, pow, range, round,
+                      str, super, zip)
+__metaclass__=type
+
+import unittest
+try:
+    from unittest import mock #python3
+except ImportError:
+    import mock
+
+import numpy as np
+import numpy.testing as nptest
+
+import forgi.threedee.model.coarse_grain as ftmc
+import forgi.threedee.utilities.vector as ftuv
+
+import fess.builder.pdd as fbpdd
+
+
+class TestPairDistanceDistribution(unittest.TestCase):
+    def test_same_as_forgi_for_small_tiles(self):
+        points = np.random.rand(200, 3)*50
+        expected = ftuv.pair_distance_distribution(points, 2)
+        for max_memory in [1, 64*17**2, 64*200**2, None]:
+            actual = fbpdd.pair_distance_distribution(points, 2, max_memory)
+            nptest.assert_allclose(actual[0], expected[0])
+            nptest.assert_array_equal(actual[1], expected[1])
+
+    def test_pairs_with_rows(self):
+        points = np.random.rand(30, 3)*50
+        all_counts = fbpdd.count_pairs(points, 1, max_memory=64*7**2)
+        rows = np.array([2, 5, 6, 20])
+        counts = fbpdd.count_pairs(points, 1, rows, max_memory=64*7**2)
+        self.assertEqual(sum(counts), 4*26+6)
+        others = np.setdiff1d(np.arange(30), rows)
+        # The remaining pairs are those without any point in rows
+        counts = fbpdd.count_pairs(points[others], 1, counts=counts)
+        nptest.assert_array_equal(counts, all_counts)
+
+
+class TestIncrementalPDD(unittest.TestCase):
+    def assert_same_pdd(self, pdd, points, stepsize):
+        expected = ftuv.pair_distance_distribution(points, stepsize)
+        actual = pdd.update(points)
+        nptest.assert_allclose(actual[0], expected[0])
+        nptest.assert_array_equal(actual[1], expected[1])
+
+    def test_same_as_forgi_after_moves(self):
+        points = np.random.rand(100, 3)*50
+        pdd = fbpdd.IncrementalPDD(2)
+        self.assert_same_pdd(pdd, points, 2)
+        for moved in [slice(0, 10), slice(40, 45), slice(99, 100), slice(20, 90)]:
+            points = np.array(points)
+            points[moved] += [5., -3., 20.]
+            self.assert_same_pdd(pdd, points, 2)
+        # Nothing moved
+        self.assert_same_pdd(pdd, points, 2)
+        # The histogram shrinks
+        points[:50] = points[50:]+0.1
+        self.assert_same_pdd(pdd, points, 2)
+
+    def test_only_moved_points_are_recounted(self):
+        points = np.random.rand(50, 3)*50
+        pdd = fbpdd.IncrementalPDD(1)
+        pdd.update(points)
+        points = np.array(points)
+        points[3] += 1.
+        count_pairs = fbpdd.count_pairs
+        calls = []
+        def spy(points, stepsize, rows=None, counts=None, sign=1, max_memory=None):
+            before = 0 if counts is None else np.sum(counts)
+            counts = count_pairs(points, stepsize, rows, counts, sign, max_memory)
+            calls.append((list(rows), np.sum(counts)-before))
+            return counts
+        with mock.patch.object(fbpdd, "count_pairs", side_effect=spy):
+            pdd.update(points)
+        # The pairs of the old position are removed, those of the new one added.
+        self.assertEqual(calls, [([3], -49), ([3], 49)])
+        self.assertEqual(sum(pdd._counts), 50*49/2)
+
+    def test_pdd_points(self):
+        cg = ftmc.CoarseGrainRNA.from_bg_file('test/fess/data/1GID_A.cg')
+        points = fbpdd.pdd_points(cg, "R")
+        self.assertEqual(points.shape, (cg.seq_length, 3))
+        nptest.assert_array_equal(points[4], cg.get_virtual_residue(5, allow_single_stranded=True))
+
+
+class TestRunningWindow(unittest.TestCase):
+    def test_sum_of_last(self):
+        histograms = np.random.rand(25, 7)
+        window = fbpdd.RunningWindow(10, 7)
+        for i, h in enumerate(histograms):
+            window.append(h)
+            self.assertEqual(len(window), min(i+1, 10))
+            nptest.assert_allclose(window.sum(), np.sum(histograms[max(0, i-9):i+1], axis=0))
+            nptest.assert_allclose(window.sum(3), np.sum(histograms[max(0, i-2):i+1], axis=0))
+            nptest.assert_allclose(window.sum(9), np.sum(histograms[max(0, i-8):i+1], axis=0))
+        nptest.assert_allclose(window.sum(0), np.zeros(7), atol=1e-12)
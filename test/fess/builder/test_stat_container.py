@@ -5,11 +5,17 @@ from builtins import (ascii, bytes, chr, dict, filter, hex, input,
 from future.utils import viewkeys
 import unittest
 import sys
+import random
+import os
+import shutil
+import tempfile
+import pickle
 try: #py 3K
     from io import StringIO
 except ImportError:
     from StringIO import StringIO
 import fess.builder.stat_container as fbstat
+import fess.builder.compiled_stats as fbcs
 import forgi.threedee.model.stats as ftmstats
 import forgi.threedee.model.coarse_grain as ftmc
 from collections import Counter
@@ -45,7 +51,8 @@ class ReadFileTests(unittest.TestCase):
     def setUp(self):
         pass
     def test_read_stats_file(self):
-        stats = fbstat.read_stats_file("test/fess/data/test1.stats")
+        # The compiled version is tested in CompiledStatsTests, without writing to test/fess/data
+        stats = fbstat.read_stats_file("test/fess/data/test1.stats", compiled=False)
         log.info(stats)
         self.assertEqual(len(stats["stem"]), 1)
         self.assertEqual(len(stats["angle"]), 3)
@@ -69,6 +76,77 @@ class ReadFileTests(unittest.TestCase):
         self.assertEqual(stats["5prime"][4],
                          [ftmstats.LoopStat("5prime test:f_0 4 20.4034805163 1.47912394946 -0.0715301558972")])
 
+class CompiledStatsTests(unittest.TestCase):
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.tmpdir, "test1.stats")
+        shutil.copy("test/fess/data/test1.stats", self.filename)
+        # Do not use the cache directory of the user running the tests.
+        self.environ = patch.dict(os.environ, {"XDG_CACHE_HOME": os.path.join(self.tmpdir, "cache")})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.tmpdir)
+
+    def test_same_as_parsed(self):
+        expected = fbstat.read_stats_file(self.filename, compiled=False)
+        fbstat.read_stats_file(self.filename) # Compiles the file
+        self.assertTrue(os.path.isdir(fbcs.cache_dirname(self.filename)))
+        stats = fbstat.read_stats_file(self.filename)
+        self.assertIsInstance(stats, fbcs.CompiledStats)
+        for stat_type in expected:
+            self.assertEqual(sorted(viewkeys(stats[stat_type])), sorted(viewkeys(expected[stat_type])))
+            for key in expected[stat_type]:
+                self.assertEqual(len(stats[stat_type][key]), len(expected[stat_type][key]))
+                self.assertEqual(list(stats[stat_type][key]), expected[stat_type][key])
+                self.assertEqual(stats[stat_type][key], expected[stat_type][key])
+                self.assertEqual(expected[stat_type][key], stats[stat_type][key])
+        self.assertAlmostEqual(stats["angle"][(5, 2, 1)].columns["r1"][0], 17.134279)
+
+    def test_recompiled_if_file_changes(self):
+        dirname = fbcs.cache_dirname(self.filename)
+        fbstat.read_stats_file(self.filename)
+        with open(self.filename, "a") as f:
+            f.write("stem test:s_1 6 10.388 2.43294047108 1 6 10 15 GCAUGG CUGCAU\n")
+        self.assertNotEqual(fbcs.cache_dirname(self.filename), dirname)
+        stats = fbstat.read_stats_file(self.filename)
+        self.assertEqual(stats["stem"][6][0].pdb_name, "test:s_1")
+
+    def test_pickle_does_not_copy_stats(self):
+        stats = fbstat.read_stats_file(self.filename)
+        unpickled = pickle.loads(pickle.dumps(stats))
+        self.assertEqual(unpickled.dirname, stats.dirname)
+        self.assertEqual(list(unpickled["stem"][5]), list(stats["stem"][5]))
+
+    def test_parse_if_compilation_fails(self):
+        with patch.object(fbcs, "compile_stats", side_effect=OSError("Read-only")):
+            stats = fbstat.read_stats_file(self.filename)
+        self.assertNotIsInstance(stats, fbcs.CompiledStats)
+        self.assertEqual(stats["stem"][5][0].pdb_name, "test:s_0")
+
+    def test_user_cache_dir_if_not_writable(self):
+        compile_stats = fbcs.compile_stats
+        def fail_next_to_file(records, dirname):
+            if dirname.startswith(self.tmpdir+os.sep+"test1.stats"):
+                raise OSError("Read-only")
+            compile_stats(records, dirname)
+        with patch.object(fbcs, "compile_stats", side_effect=fail_next_to_file):
+            stats = fbstat.read_stats_file(self.filename)
+        self.assertEqual(os.path.dirname(stats.dirname), fbcs.user_cache_dir())
+        self.assertEqual(fbstat.read_stats_file(self.filename).dirname, stats.dirname)
+
+    def test_load_all_shares_compiled_stats(self):
+        fallback = os.path.join(self.tmpdir, "fallback.stats")
+        shutil.copy("test/fess/data/fallback1.stats", fallback)
+        st = fbstat.StatStorage(self.filename, [fallback])
+        st.load_all()
+        self.assertEqual(len(st._sources), 2)
+        unpickled = pickle.loads(pickle.dumps(st))
+        for source, unpickled_source in zip(st._sources, unpickled._sources):
+            self.assertIsInstance(unpickled_source, fbcs.CompiledStats)
+            self.assertEqual(unpickled_source.dirname, source.dirname)
+
 class StatStorageTest(unittest.TestCase):
     def test_stat_files_are_loaded_lazily(self):
         stats_open = mock_open()
@@ -186,6 +264,21 @@ class StatStoragePublicAPITests(unittest.TestCase):
         cov = self.st.coverage_for(set(["test:i_0", "fallback1:i_0"]), self.cg2, "i0", 2)
         self.assertAlmostEqual(cov, 1.) # The file fallback2 is not needed at all.
 
+    def test_angle_geometry_for(self):
+        # The same stats as iterate_stats_for, including the sampling of fallback stats
+        for min_entries in [2, 3]:
+            random.seed(1)
+            expected = [ stat.pdb_name for stat in self.st.iterate_stats_for(self.cg2, "i0", min_entries) ]
+            random.seed(1)
+            geometry = self.st.angle_geometry_for(self.cg2, "i0", min_entries)
+            self.assertEqual([ stat.pdb_name for stat in geometry.stats ], expected)
+            self.assertEqual(geometry.positions.shape, (len(expected), 3))
+
+    def test_distance_range_for(self):
+        r1s = [ stat.r1 for stat in self.st.iterate_stats_for(self.cg2, "i0", 1) ]
+        self.assertEqual(self.st.distance_range_for(self.cg2, "i0", 1),
+                         (min(r1s), max(r1s)))
+
 class SequenceDependentStatStorageTests(unittest.TestCase):
     def setUp(self):
         self.st = fbstat.SequenceDependentStatStorage("test/fess/data/test1.stats", ["test/fess/data/fallback1.stats", "test/fess/data/fallback2.stats"])